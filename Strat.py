@@ -1,5 +1,8 @@
+import time
+
 import backtrader as bt
-from support import DonchianChannels
+from events import EventRecorder, bt_microseconds, print_event
+from support import DonchianChannels, StoredDonchianChannels, StoredIchimoku
 
 
 class MyStrategy(bt.Strategy):
@@ -19,81 +22,138 @@ class MyStrategy(bt.Strategy):
         ('stop_distance_factor', 0.01),
         ('take_profit_distance_factor', 0.01),
         ('take_profit_trigger_factor', 0.4),
+
+        # IndicatorStore with the indicator lines precomputed for the data, None to calculate them in the run
+        ('indicator_store', None),
+
+        # Print orders and trades. Fitness runs turn it off, log() then returns before formatting anything
+        ('printlog', True),
+        # Called with every order, trade and log() event instead of printing them, see events.EventRecorder
+        ('event_sink', None),
+
+        # Pruning of hopeless runs: stop once the drawdown exceeds prune_drawdown (percent), or once the
+        # broker value falls below prune_floor, the checkpoints of another run. With prune_interval
+        # set, the broker value is recorded in self.checkpoints every prune_interval bars.
+        ('prune_drawdown', None),
+        ('prune_floor', None),
+        ('prune_interval', None),
     )
 
     def __init__(self):
         """Initializes all variables to be used in this strategy"""
+        # Times the run reached each stage, for the instrumentation of the evaluations
+        self.timings = {'init': time.perf_counter()}
 
         self.starting_value = self.broker.getvalue()  # Store the initial value at the start
         self.order = None
         self.stop_price = None
         self.take_profit_price = None
         self.trailing_profit_price = None
-        self.last_value = None
         self.risk_per_trade = self.params.risk_per_trade
 
         self.total_candles = self.params.total_candles
 
+        # Orders and trades, recorded without formatting and printed by the sink
+        sink = self.params.event_sink or (print_event if self.params.printlog else None)
+        self.events = EventRecorder(sink=sink)
+
         # Set the indicators
 
         # Set the indicators for the secondary timeframe
-        self.donchian = DonchianChannels(self.data1, plot=False)
-        self.donchian1 = DonchianChannels(self.data2, plot=False)
-        self.ichimoku = bt.indicators.Ichimoku(self.data1, plot=False)
-        self.ichimoku1 = bt.indicators.Ichimoku(self.data2, plot=False)
+        donchian_period = int(self.params.Donchian_Period)
+        store = self.params.indicator_store
+        if store is None:
+            self.donchian = DonchianChannels(self.data1, period=donchian_period, plot=False)
+            self.donchian1 = DonchianChannels(self.data2, period=donchian_period, plot=False)
+            self.ichimoku = bt.indicators.Ichimoku(self.data1, plot=False)
+            self.ichimoku1 = bt.indicators.Ichimoku(self.data2, plot=False)
+        else:
+            # Read the lines from the store, keyed by the compression of each resampled feed
+            self.donchian, self.donchian1 = (
+                StoredDonchianChannels(data, values=store.get(data._compression, 'donchian', donchian_period),
+                                       minperiod=store.minperiod('donchian', donchian_period), plot=False)
+                for data in (self.data1, self.data2))
+            self.ichimoku, self.ichimoku1 = (
+                StoredIchimoku(data, values=store.get(data._compression, 'ichimoku'),
+                               minperiod=store.minperiod('ichimoku'), plot=False)
+                for data in (self.data1, self.data2))
+
+        self.timings['indicators'] = time.perf_counter()
 
         # Set Flags, Checks, Conditions
         self.uptrend = self.downtrend = self.notrend = False
 
+        # Pruning
+        self.pruning = any(p is not None for p in (self.params.prune_drawdown, self.params.prune_interval))
+        self.pruned = False
+        self.peak_value = self.starting_value
+        self.checkpoints = [] if self.params.prune_interval else None
 
-    def total_pnl_percentage(self):
-        pnl = self.broker.getvalue() - self.starting_value
-        pnl_percentage = (pnl / self.starting_value) * 100
-        return pnl, pnl_percentage
 
-    def log(self, txt, doprint=True):
-        """Logs any given text with the time and date as long as doprint=True"""
-        date = self.data.datetime.date(0)
-        time = self.data.datetime.time(0)
-        if doprint:
-            print(str(date) + ' ' + str(time) + '--' + txt)
+    def log(self, txt, *args, doprint=True):
+        """Passes txt and args, formatted by the event sink if there is one, with the time and date"""
+        if not doprint or self.events.sink is None:
+            return
+        self.events.note(bt_microseconds(self.data.datetime[0]), txt, *args)
 
     def notify_order(self, order):
-        """Run on every next iteration. Checks order status and logs accordingly"""
+        """Run on every next iteration. Records completed and rejected orders"""
         if order.status in [order.Submitted, order.Accepted]:
             # Order has been submitted or accepted but not yet completed
             return
 
-        # Log only when order is completed or rejected/margin issue
         if order.status == order.Completed:
-            if order.isbuy():
-                self.log('BUY   price: {:.2f}, size: {:.2f}, commission: {:.2f}'.format(
-                    order.executed.price, order.executed.size, order.executed.comm))
-            elif order.issell():
-                self.log('SELL  price: {:.2f}, size: {:.2f}, commission: {:.2f}'.format(
-                    order.executed.price, order.executed.size, order.executed.comm))
+            executed = order.executed
+            self.events.order(bt_microseconds(self.data.datetime[0]), executed.size, executed.price,
+                              executed.value, executed.comm, order.status)
         elif order.status in [order.Rejected, order.Margin]:
-            # Log only for rejected or margin issues
-            self.log('ORDER REJECTED/MARGIN ISSUE - {}'.format(order.status))
-
-        # Update the last_value only if the order was completed
-        if order.status == order.Completed:
-            self.last_value = order.executed.value
+            self.events.order(bt_microseconds(self.data.datetime[0]), order.created.size, order.created.price,
+                              0.0, 0.0, order.status)
 
         # Change the order variable back to None to indicate no pending order
         self.order = None
 
     def notify_trade(self, trade):
-        """Run on every next iteration. Logs data on every trade when closed."""
-        trade_pnl = (trade.pnlcomm / self.last_value) * 100
+        """Run on every next iteration. Records every trade when closed"""
         if trade.isclosed:
-            pnl, pnl_percentage = self.total_pnl_percentage()
-            self.log('CLOSED   Gross P/L: {:.2f}, Net P/L: {:.2f}, P/L Percentage: {:.2f}%, Current Capital: {:.2f}, Total P/L: {:.2f}, Total P/L Percentage: {:.2f}%'.format(trade.pnl, trade.pnlcomm, trade_pnl, self.broker.getvalue(), pnl, pnl_percentage))
-            if trade.pnlcomm > 0: self.log('TAKE PROFIT')
-            if trade.pnlcomm <= 0: self.log('STOP LOSS')
+            self.events.trade(bt_microseconds(trade.dtopen), bt_microseconds(trade.dtclose), trade.long,
+                              trade.price, trade.pnl, trade.pnlcomm, trade.commission, trade.barlen)
+
+    def start(self):
+        self.timings['start'] = time.perf_counter()
 
     def stop(self):
-        pass
+        self.timings['stop'] = time.perf_counter()
+
+    def prune(self):
+        """
+        Stops the run if the drawdown or the equity show the parameters are not worth finishing.
+
+        :return: True if the run was stopped
+        """
+        value = self.broker.getvalue()
+        self.peak_value = max(self.peak_value, value)
+        if self.params.prune_drawdown is not None:
+            if 100.0 * (self.peak_value - value) / self.peak_value > self.params.prune_drawdown:
+                self.pruned = True
+
+        interval = self.params.prune_interval
+        bars = len(self.data0)
+        # The cycle that flushes the resampled bars at the end has no new 1-minute bar
+        if interval and not self.pruned and bars % interval == 0 and len(self.checkpoints) < bars // interval:
+            checkpoint = len(self.checkpoints)
+            self.checkpoints.append(value)
+            floor = self.params.prune_floor
+            if floor is not None and checkpoint < len(floor) and value < floor[checkpoint]:
+                self.pruned = True
+
+        if self.pruned:
+            self.env.runstop()
+        return self.pruned
+
+    def prenext(self):
+        if self.pruning:
+            self.prune()
 
     def define_trend(self):
         senkou_span_a = self.ichimoku1.lines.senkou_span_a[0]
@@ -209,6 +269,8 @@ class MyStrategy(bt.Strategy):
 
         """Runs on each candle and handles the entire trading logic."""
 
+        if self.pruning and self.prune(): return
+
         # Check if there is an active order
         if self.order: return
 
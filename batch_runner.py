@@ -0,0 +1,221 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import sys
+import time
+import warnings
+from collections import OrderedDict
+from functools import partial
+
+import pandas as pd
+
+from events import won_trades
+from support import read_data_frame
+from vector_engine import MarketData, run_backtest
+
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+RESULT_FIELDS = ('ticker', 'start', 'end', 'bars', 'params', 'final_value', 'return_pct', 'max_drawdown',
+                 'trades', 'won', 'seconds', 'error')
+
+# MarketData of the last (file, start, end) ranges a worker ran on. Jobs that only differ in their
+# params are scheduled next to each other, so workers mostly reuse the resampled data.
+_market_data = OrderedDict()
+MARKET_DATA_CACHE_SIZE = 4
+
+
+def job_file(job):
+    return job.get('file_name') or f"{job['ticker']}_data.csv"
+
+
+def select_range(df, start, end):
+    """:return: the rows of df from start to end, both included. Either of them can be None."""
+    return df.loc[start or None:end or None]
+
+
+def load_jobs(file_name):
+    """
+    Reads a jobs file, a CSV with one backtest per row: the ticker, the start and end of the date
+    range (empty for the whole data) and one column per MyStrategy parameter (empty for its default).
+    An optional file_name column points to the data, {ticker}_data.csv otherwise.
+
+    :return: list of job dicts with ticker, start, end, file_name and params
+    """
+    jobs = []
+    text_columns = {'ticker': str, 'start': str, 'end': str, 'file_name': str}
+    for row in pd.read_csv(file_name, dtype=text_columns).to_dict('records'):
+        row = {name: value for name, value in row.items() if not pd.isna(value)}
+        job = {name: row.pop(name, None) for name in ('ticker', 'start', 'end', 'file_name')}
+        if 'Donchian_Period' in row:
+            row['Donchian_Period'] = int(row['Donchian_Period'])
+        job['params'] = row
+        jobs.append(job)
+    return jobs
+
+
+def count_job_bars(jobs):
+    """
+    Counts the 1-minute bars of every job, which is what a backtest takes time on. This also builds
+    the columnar cache of every data file here, before the workers would race to build it.
+
+    :return: list with the number of bars of each job, 0 if its data cannot be read
+    """
+    bars = {}
+    for job in jobs:
+        key = (job_file(job), job['start'], job['end'])
+        if key not in bars:
+            try:
+                bars[key] = len(select_range(read_data_frame(key[0]), job['start'], job['end']))
+            except (OSError, KeyError, ValueError) as e:
+                print(f"Cannot read {key[0]}: {e}")
+                bars[key] = 0
+    return [bars[(job_file(job), job['start'], job['end'])] for job in jobs]
+
+
+def market_data_for(file_name, start, end):
+    key = (file_name, start, end)
+    if key in _market_data:
+        _market_data.move_to_end(key)
+    else:
+        df = select_range(read_data_frame(file_name), start, end)
+        if not len(df):
+            raise ValueError('no bars in the date range')
+        _market_data[key] = MarketData(df)
+        if len(_market_data) > MARKET_DATA_CACHE_SIZE:
+            _market_data.popitem(last=False)
+    return _market_data[key]
+
+
+def run_cerebro(market, starting_capital, commission, total_candles, params):
+    """:return: (final value, max drawdown, closed trades, won trades) of a fitness setup Cerebro run"""
+    import backtrader as bt
+    from Strat import MyStrategy
+    from support import FixedRiskSizer, MetricsAnalyzer
+
+    cerebro = bt.Cerebro(stdstats=False)
+    for feed in market.feeds():
+        cerebro.adddata(feed)
+    cerebro.broker.setcash(starting_capital)
+    cerebro.broker.setcommission(commission=commission)
+    cerebro.addsizer(FixedRiskSizer)
+    cerebro.addanalyzer(MetricsAnalyzer, _name='metrics')
+    cerebro.addstrategy(MyStrategy, total_candles=total_candles, indicator_store=market.indicators,
+                        printlog=False, **params)
+    strategy = cerebro.run()[0]
+
+    metrics = strategy.analyzers.metrics.get_analysis()
+    return strategy.broker.getvalue(), metrics['max_drawdown'], metrics['trades'], metrics['won']
+
+
+def run_job(job, engine='vector', starting_capital=10000, commission=0.00035):
+    """
+    Runs the backtest of one job. Errors are reported in the result instead of raised, so that
+    one bad ticker does not stop the batch.
+
+    :return: result dict with the RESULT_FIELDS
+    """
+    start_time = time.perf_counter()
+    result = {'ticker': job['ticker'], 'start': job['start'] or '', 'end': job['end'] or '',
+              'params': json.dumps(job['params'], sort_keys=True)}
+    try:
+        market = market_data_for(job_file(job), job['start'], job['end'])
+        total_candles = len(market)
+        if engine == 'vector':
+            backtest = run_backtest(market, starting_capital=starting_capital, commission=commission,
+                                    total_candles=total_candles, **job['params'])
+            final_value, drawdown = backtest.final_value, backtest.max_drawdown
+            trades = len(backtest.trades)
+            won = int(won_trades([pnlcomm for _, _, _, pnlcomm in backtest.trades]).sum())
+        else:
+            final_value, drawdown, trades, won = run_cerebro(market, starting_capital, commission, total_candles,
+                                                             job['params'])
+        result.update(bars=total_candles, final_value=final_value,
+                      return_pct=(final_value - starting_capital) / starting_capital * 100,
+                      max_drawdown=drawdown, trades=trades, won=won, error='')
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+
+def summarize(results):
+    """
+    Aggregates the results per ticker.
+
+    :return: DataFrame indexed by ticker with the number of jobs and failed jobs, bars, mean, best and
+        worst return, mean and worst drawdown, closed trades and win rate
+    """
+    df = pd.DataFrame(list(results), columns=RESULT_FIELDS)
+    df['failed'] = df['error'].fillna('') != ''
+    ok = df[~df['failed']].astype({'bars': int, 'return_pct': float, 'max_drawdown': float,
+                                   'trades': int, 'won': int})
+
+    summary = pd.DataFrame({'jobs': df.groupby('ticker').size(), 'failed': df.groupby('ticker')['failed'].sum()})
+    grouped = ok.groupby('ticker')
+    summary['bars'] = grouped['bars'].sum()
+    summary['mean_return_pct'] = grouped['return_pct'].mean()
+    summary['best_return_pct'] = grouped['return_pct'].max()
+    summary['worst_return_pct'] = grouped['return_pct'].min()
+    summary['mean_drawdown'] = grouped['max_drawdown'].mean()
+    summary['worst_drawdown'] = grouped['max_drawdown'].max()
+    summary['trades'] = grouped['trades'].sum()
+    summary['win_rate'] = grouped['won'].sum() / summary['trades'].where(summary['trades'] > 0) * 100
+    return summary
+
+
+def run_batch(jobs, results_file='batch_results.csv', summary_file='batch_summary.csv', processes=None,
+              engine='vector', starting_capital=10000, commission=0.00035):
+    """
+    Runs the jobs on a process pool, longest job first so that a long one does not start last and keep
+    the pool waiting for it. Every result is appended to results_file as soon as it arrives, so an
+    interrupted batch keeps what it ran. The per ticker summary is written to summary_file at the end.
+
+    :return: the summary DataFrame
+    """
+    bars = count_job_bars(jobs)
+    # Longest first; jobs on the same data stay together so that workers reuse their MarketData
+    order = sorted(range(len(jobs)), key=lambda k: (-bars[k], job_file(jobs[k]), str(jobs[k]['start']),
+                                                    str(jobs[k]['end'])))
+    print(f"Running {len(jobs)} jobs, {sum(bars)} bars in total")
+
+    run = partial(run_job, engine=engine, starting_capital=starting_capital, commission=commission)
+    results = []
+    start_time = time.time()
+    with open(results_file, 'w', newline='') as f, multiprocessing.Pool(processes) as pool:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for result in pool.imap_unordered(run, (jobs[k] for k in order), chunksize=1):
+            writer.writerow(result)
+            f.flush()
+            results.append(result)
+            status = result['error'] or f"return {result['return_pct']:.2f}%, drawdown {result['max_drawdown']:.2f}%"
+            print(f"[{len(results)}/{len(jobs)}] {result['ticker']} {result['start']} {result['end']}: {status}")
+
+    summary = summarize(results)
+    summary.to_csv(summary_file)
+    print(summary.to_string())
+    print(f"Elapsed Time: {time.time() - start_time:.2f} seconds")
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Backtests MyStrategy on every (ticker, date range, params) job of a jobs CSV file')
+
+    parser.add_argument('jobs', help='CSV file with ticker, start, end and MyStrategy parameter columns')
+    parser.add_argument('--results', default='batch_results.csv', help='Results of every job')
+    parser.add_argument('--summary', default='batch_summary.csv', help='Results aggregated per ticker')
+    parser.add_argument('--processes', type=int, default=None, help='Pool size, the number of CPUs by default')
+    parser.add_argument('--engine', choices=('vector', 'cerebro'), default='vector', help='Backtest engine')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    if sys.platform.startswith("win"):
+        multiprocessing.freeze_support()  # Required on Windows
+    args = parse_args()
+    run_batch(load_jobs(args.jobs), results_file=args.results, summary_file=args.summary,
+              processes=args.processes, engine=args.engine)
@@ -0,0 +1,463 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import backtrader as bt
+import numpy as np
+import pandas as pd
+
+import support
+from support import DonchianChannels, FixedRiskSizer, SortinoRatio, read_data_frame
+from vector_engine import COMPRESSIONS, MarketData, run_backtest
+
+SUITES = ('donchian', 'ichimoku', 'strategy', 'sizer', 'sortino', 'evaluate', 'startup', 'live')
+DATA_FILES = ('AMZN_data.csv', 'AMZN_data_4-2024-4months.csv')
+
+# Seconds spent in the prenext/next/once methods of timed() indicator classes, by benchmark label
+indicator_times = defaultdict(float)
+
+
+def timed(cls, label, methods=('prenext', 'next', 'once')):
+    """
+    :return: subclass of the indicator or analyzer class cls that adds the time spent in its own
+        `methods` to indicator_times[label].
+    """
+    def wrap(method):
+        def timed_method(self, *args):
+            start = time.perf_counter()
+            method(self, *args)
+            indicator_times[label] += time.perf_counter() - start
+        return timed_method
+
+    return type(f'Timed{cls.__name__}', (cls,), {name: wrap(getattr(cls, name)) for name in methods})
+
+
+def synthetic_data(bars, seed=0, start='2024-01-02'):
+    """
+    1-minute OHLCV bars of a random walk, in sessions from 04:00 to 20:00 on weekdays like the
+    extended hours data of Alpha Vantage, so that the resampled feeds see the same session breaks.
+
+    :return: DataFrame indexed by 'Date' with the open, high, low, close and volume columns
+    """
+    rng = np.random.default_rng(seed)
+    days = pd.bdate_range(start, periods=bars // 960 + 1)
+    minutes = pd.to_timedelta(np.arange(4 * 60, 20 * 60), unit='min')
+    index = (days.values[:, None] + minutes.values[None, :]).ravel()[:bars]
+
+    close = 100.0 * np.exp(np.cumsum(rng.normal(0.0, 0.0005, bars)))
+    open_ = np.concatenate([[100.0], close[:-1]])
+    spread = np.abs(rng.normal(0.0, 0.0003, bars)) * close
+    return pd.DataFrame({'open': open_, 'high': np.maximum(open_, close) + spread,
+                         'low': np.minimum(open_, close) - spread, 'close': close,
+                         'volume': rng.integers(100, 10000, bars).astype(float)},
+                        index=pd.DatetimeIndex(index, name='Date'))
+
+
+def minute_feed(df):
+    return bt.feeds.PandasData(dataname=df, datetime=None, timeframe=bt.TimeFrame.Minutes, compression=1)
+
+
+def datasets(bars):
+    """:return: list of (name, DataFrame) of the data files that exist and of synthetic data of every size in bars"""
+    data = [(file_name, read_data_frame(file_name)) for file_name in DATA_FILES if os.path.exists(file_name)]
+    return data + [('synthetic', synthetic_data(size)) for size in bars]
+
+
+def best_of(repeat, run):
+    """:return: the smallest of `repeat` timings returned by run(), with the result of its last call"""
+    timings = []
+    for _ in range(repeat):
+        seconds, result = run()
+        timings.append(seconds)
+    return min(timings), result
+
+
+def record(suite, name, data, bars, seconds, unit='bars', count=None, **extra):
+    """:return: a benchmark result, with its throughput in `unit` per second"""
+    count = bars if count is None else count
+    return {'suite': suite, 'name': name, 'data': data, 'bars': bars, 'seconds': seconds,
+            'rate': count / seconds if seconds else None, 'unit': f'{unit}/s', **extra}
+
+
+class HighestLowestDonchian(bt.Indicator):
+    """The previous DonchianChannels, which rescans the whole window with Highest/Lowest on every bar"""
+
+    lines = ('dcm', 'dch', 'dcl',)
+    params = dict(
+        period=20,
+        lookback=-1,
+    )
+
+    def __init__(self):
+        hi, lo = self.data.high, self.data.low
+        if self.p.lookback:
+            hi, lo = hi(self.p.lookback), lo(self.p.lookback)
+
+        self.l.dch = timed(bt.ind.Highest, 'Highest/Lowest')(hi, period=self.p.period)
+        self.l.dcl = timed(bt.ind.Lowest, 'Highest/Lowest')(lo, period=self.p.period)
+        self.l.dcm = (self.l.dch + self.l.dcl) / 2.0
+
+
+class IndicatorRun(bt.Strategy):
+    """Only builds the indicator on the data"""
+
+    params = dict(
+        indicator=DonchianChannels,
+        period=20,
+    )
+
+    def __init__(self):
+        self.indicator = self.p.indicator(self.data, period=self.p.period)
+
+
+def time_indicator(indicator, label, df, period, runonce):
+    """
+    :return: (seconds, lines) of `indicator` over the 1-minute data of df, in runonce
+        (vectorized once()) or next (bar by bar) mode. Only the time spent in the indicator counts.
+    """
+    cerebro = bt.Cerebro(stdstats=False, runonce=runonce)
+    cerebro.adddata(minute_feed(df))
+    cerebro.addstrategy(IndicatorRun, indicator=indicator, period=period)
+
+    indicator_times[label] = 0.0
+    strategy = cerebro.run()[0]
+    lines = [np.array(line.array) for line in (strategy.indicator.l.dch, strategy.indicator.l.dcl)]
+    return indicator_times[label], lines
+
+
+def bench_donchian(bars=(), repeat=1, periods=(20, 50, 200)):
+    """Times DonchianChannels against HighestLowestDonchian and checks that both give the same lines"""
+    records = []
+    for data, df in datasets(bars):
+        for period in periods:
+            for runonce in (True, False):
+                mode = 'once' if runonce else 'next'
+                old_time, old_lines = best_of(repeat, lambda: time_indicator(
+                    HighestLowestDonchian, 'Highest/Lowest', df, period, runonce))
+                new_time, new_lines = best_of(repeat, lambda: time_indicator(
+                    timed(DonchianChannels, 'deques/once'), 'deques/once', df, period, runonce))
+                equal = all(np.array_equal(old, new, equal_nan=True) for old, new in zip(old_lines, new_lines))
+                records.append(record('donchian', f'Highest/Lowest {mode} period {period}', data, len(df), old_time))
+                records.append(record('donchian', f'DonchianChannels {mode} period {period}', data, len(df), new_time,
+                                      equal=equal))
+    return records
+
+
+class IchimokuRun(bt.Strategy):
+    """Builds Ichimoku on the resampled feeds, as MyStrategy does, or nothing for the baseline"""
+
+    params = dict(
+        indicator=None,
+    )
+
+    def __init__(self):
+        if self.p.indicator is not None:
+            self.ichimoku = [self.p.indicator(data) for data in self.datas[1:]]
+
+
+def bench_ichimoku(bars=(), repeat=1):
+    """
+    Times bt.indicators.Ichimoku on the resampled feeds: the time of the run with it less the time of the
+    same run without indicators, since its lines are built from other indicators and line operations.
+    """
+    def run(df, indicator):
+        cerebro = bt.Cerebro(stdstats=False)
+        data = minute_feed(df)
+        cerebro.adddata(data)
+        for compression in COMPRESSIONS:
+            cerebro.resampledata(data, timeframe=bt.TimeFrame.Minutes, compression=compression)
+        cerebro.addstrategy(IchimokuRun, indicator=indicator)
+        start = time.perf_counter()
+        cerebro.run()
+        return time.perf_counter() - start, None
+
+    records = []
+    for data, df in datasets(bars):
+        baseline, _ = best_of(repeat, lambda: run(df, None))
+        seconds, _ = best_of(repeat, lambda: run(df, bt.indicators.Ichimoku))
+        records.append(record('ichimoku', 'Ichimoku on the resampled feeds', data, len(df), max(seconds - baseline, 0.0),
+                              run_seconds=seconds, baseline_seconds=baseline))
+    return records
+
+
+def bench_strategy(bars=(), repeat=1):
+    """Times full MyStrategy runs: Cerebro with the indicators of the run and of the store, and vector_engine"""
+    from Strat import MyStrategy
+
+    def cerebro_run(market, store):
+        cerebro = bt.Cerebro(stdstats=False)
+        for feed in market.feeds():
+            cerebro.adddata(feed)
+        cerebro.broker.setcash(10000)
+        cerebro.broker.setcommission(commission=0.00035)
+        cerebro.addsizer(FixedRiskSizer)
+        cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')
+        cerebro.addstrategy(MyStrategy, total_candles=len(market), printlog=False,
+                            indicator_store=market.indicators if store else None)
+        start = time.perf_counter()
+        strategy = cerebro.run()[0]
+        return time.perf_counter() - start, strategy.broker.getvalue()
+
+    def vector_run(market):
+        start = time.perf_counter()
+        result = run_backtest(market, total_candles=len(market))
+        return time.perf_counter() - start, result.final_value
+
+    records = []
+    for data, df in datasets(bars):
+        start = time.perf_counter()
+        market = MarketData(df)
+        records.append(record('strategy', 'MarketData resampling', data, len(df), time.perf_counter() - start))
+
+        seconds, value = best_of(repeat, lambda: cerebro_run(market, False))
+        records.append(record('strategy', 'Cerebro MyStrategy', data, len(df), seconds, final_value=value))
+        seconds, value = best_of(repeat, lambda: cerebro_run(market, True))
+        records.append(record('strategy', 'Cerebro MyStrategy, indicator store', data, len(df), seconds,
+                              final_value=value))
+        seconds, value = best_of(repeat, lambda: vector_run(market))
+        records.append(record('strategy', 'vector_engine run_backtest', data, len(df), seconds, final_value=value))
+    return records
+
+
+def bench_sizer(calls=1000000, repeat=1):
+    """Times FixedRiskSizer._getsizing alone, on stand-ins for the broker, strategy and data"""
+    sizer = FixedRiskSizer()
+    sizer.broker = SimpleNamespace(getvalue=lambda: 10000.0)
+    sizer.strategy = SimpleNamespace(risk_per_trade=0.003, stop_price=99.0)
+    data = SimpleNamespace(close=[100.0])
+
+    def run():
+        start = time.perf_counter()
+        for k in range(calls):
+            sizer._getsizing(None, 10000.0, data, k % 2 == 0)
+        return time.perf_counter() - start, None
+
+    seconds, _ = best_of(repeat, run)
+    return [record('sizer', 'FixedRiskSizer._getsizing', 'stand-ins', 0, seconds, unit='calls', count=calls)]
+
+
+def bench_sortino(bars=(), repeat=1):
+    """Times SortinoRatio, with its TimeReturn subanalyzer, on daily returns of a run over the 1-minute data"""
+    methods = ('start', 'prenext', 'next', 'notify_fund', 'notify_cashvalue', 'stop')
+
+    def run(df):
+        cerebro = bt.Cerebro(stdstats=False)
+        cerebro.adddata(minute_feed(df))
+        cerebro.addstrategy(bt.Strategy)
+        cerebro.addanalyzer(timed(SortinoRatio, 'SortinoRatio', methods), timeframe=bt.TimeFrame.Days,
+                            _name='sortino')
+        indicator_times['SortinoRatio'] = 0.0
+        time_return, support.TimeReturn = support.TimeReturn, timed(support.TimeReturn, 'SortinoRatio', methods)
+        try:
+            cerebro.run()
+        finally:
+            support.TimeReturn = time_return
+        return indicator_times['SortinoRatio'], None
+
+    records = []
+    for data, df in datasets(bars):
+        seconds, _ = best_of(repeat, lambda: run(df))
+        records.append(record('sortino', 'SortinoRatio daily', data, len(df), seconds))
+    return records
+
+
+def bench_evaluate(evaluations=40, processes=None, engines=('vector', 'cerebro')):
+    """
+    Evaluations per second of main_program.evaluate on a pool, on the data main_program loads, with
+    distinct random individuals so that none is answered from the cache.
+    """
+    import main_program
+    from support import EvaluationCache, setup_database
+
+    records = []
+    main_program.load_market_data()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Forked workers inherit these settings
+        main_program.cache_tolerance = (0,) * len(main_program.param_space)
+        shared, handle = main_program.market_data.share()
+        try:
+            for engine in engines:
+                main_program.backtest_engine = engine
+                random.seed(0)
+                individuals = main_program.toolbox.population(evaluations if engine == 'vector' else evaluations // 4)
+                db_file = os.path.join(tmp, f'{engine}.db')
+                setup_database(db_file)
+                cache = EvaluationCache.start(db_file)
+                with multiprocessing.get_context('fork').Pool(processes, initializer=main_program.init_worker,
+                                                              initargs=(handle, cache)) as pool:
+                    start = time.perf_counter()
+                    pool.map(main_program.evaluate, individuals, chunksize=1)
+                    seconds = time.perf_counter() - start
+                cache.close()
+                records.append(record('evaluate', f'evaluate {engine} on a pool of {processes or os.cpu_count()}',
+                                      'AMZN_data.csv', main_program.total_candles, seconds, unit='evaluations',
+                                      count=len(individuals)))
+        finally:
+            shared.close()
+            shared.unlink()
+    return records
+
+
+def bench_startup(processes=None, repeat=1):
+    """
+    Import time of main_program in a new interpreter, which every spawned worker and the forkserver pay, and
+    seconds until a pool of main_program.start_pool is ready, for every start method. The first forkserver
+    pool also starts the server, the next ones reuse it.
+    """
+    import main_program
+
+    code = 'import time; start = time.perf_counter(); import main_program; print(time.perf_counter() - start)'
+    seconds, _ = best_of(repeat, lambda: (float(subprocess.run([sys.executable, '-c', code], capture_output=True,
+                                                                text=True, check=True).stdout), None))
+    records = [record('startup', 'import main_program', '', 0, seconds, unit='imports', count=1)]
+
+    processes = processes or os.cpu_count()
+    main_program.load_market_data()
+    shared, handle = main_program.market_data.share()
+
+    def start(method):
+        pool, seconds = main_program.start_pool(processes, handle, None, context=main_program.worker_context(method))
+        pool.close()
+        pool.join()
+        return seconds, None
+
+    try:
+        for method in ('fork', 'spawn', 'forkserver'):
+            if method not in multiprocessing.get_all_start_methods():
+                continue
+            runs = repeat
+            if method == 'forkserver':
+                seconds, _ = start(method)
+                records.append(record('startup', 'start_pool forkserver, server start included', 'AMZN_data.csv', 0,
+                                      seconds, unit='workers', count=processes))
+                runs -= 1
+            if runs > 0:
+                seconds, _ = best_of(runs, lambda: start(method))
+                records.append(record('startup', f'start_pool {method}', 'AMZN_data.csv', 0, seconds, unit='workers',
+                                      count=processes))
+    finally:
+        shared.close()
+        shared.unlink()
+    return records
+
+
+def bench_live(bars=(), repeat=1):
+    """Times the live trader on the bar lines of every dataset, with its per-bar decision latencies"""
+    import live
+
+    def live_run(lines):
+        trader = live.LiveTrader()
+        start = time.perf_counter()
+        stats = live.trade(lines, trader)
+        return time.perf_counter() - start, (trader.value, stats.summary())
+
+    records = []
+    for data, df in datasets(bars):
+        times = df.index.values.astype('datetime64[us]').astype(np.int64).tolist()
+        lines = [live.format_bar(*bar) for bar in
+                 zip(times, *(df[column].tolist() for column in ('open', 'high', 'low', 'close', 'volume')))]
+        seconds, (value, summary) = best_of(repeat, lambda: live_run(lines))
+        records.append(record('live', 'LiveTrader decisions', data, len(df), seconds, final_value=value,
+                              **{name: summary[name] for name in ('decision_p50_us', 'decision_p99_us',
+                                                                  'decision_max_us')}))
+    return records
+
+
+def environment():
+    """:return: what the results depend on besides the code: versions, machine and commit"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'backtrader': bt.__version__, 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def result_key(result):
+    return result['suite'], result['name'], result['data'], result['bars']
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change of every result against the same benchmark in baseline.
+
+    :return: list of the results more than `tolerance` (a fraction) slower than in baseline
+    """
+    previous = {result_key(result): result for result in baseline}
+    slower = []
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None or not before['seconds']:
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        flag = 'SLOWER' if change > tolerance else ''
+        if flag:
+            slower.append(result)
+        print(f"{result['suite']:>9} {result['name']:<45} {result['data']:<30} {result['bars']:>8} "
+              f"{before['seconds']:>9.3f}s -> {result['seconds']:>9.3f}s {change:>+7.1%} {flag}")
+    return slower
+
+
+def print_results(results):
+    for result in results:
+        extra = '' if result.get('equal', True) else '  LINES DIFFER'
+        print(f"{result['suite']:>9} {result['name']:<45} {result['data']:<30} {result['bars']:>8} "
+              f"{result['seconds']:>9.3f}s {result['rate'] or 0:>14,.2f} {result['unit']}{extra}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmarks of the indicators, the strategy and the optimizer throughput')
+
+    parser.add_argument('--suite', nargs='+', choices=SUITES, default=list(SUITES), help='Benchmarks to run')
+    parser.add_argument('--bars', nargs='*', type=int, default=[100000],
+                        help='Sizes of the synthetic data, on top of the data files')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every timing, the best one counts')
+    parser.add_argument('--evaluations', type=int, default=40, help='Evaluations of the evaluate benchmark')
+    parser.add_argument('--processes', type=int, default=None, help='Pool size of the evaluate benchmark')
+    parser.add_argument('--json', help='Write the results and the environment to this file')
+    parser.add_argument('--compare', help='Results file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Slowdown against --compare, as a fraction, that fails the run')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # python benchmarks.py --suite donchian strategy --bars 100000 1000000 --json results.json
+    args = parse_args()
+    random.seed(0)
+
+    results = []
+    for suite in args.suite:
+        if suite == 'sizer':
+            results += bench_sizer(repeat=args.repeat)
+        elif suite == 'evaluate':
+            results += bench_evaluate(args.evaluations, args.processes)
+        elif suite == 'startup':
+            results += bench_startup(args.processes, repeat=args.repeat)
+        else:
+            results += globals()[f'bench_{suite}'](bars=args.bars, repeat=args.repeat)
+        print_results([result for result in results if result['suite'] == suite])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f)['results'], args.tolerance)
+        if slower:
+            print(f"{len(slower)} benchmarks are more than {args.tolerance:.0%} slower")
+            sys.exit(1)
@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+# The first days of AMZN_data.csv, long enough for the indicators and executions with the parameters of the tests
+SLICE_BARS = 6000
+
+
+@pytest.fixture(scope='session')
+def data_file(tmp_path_factory):
+    """:return: name of a CSV file of the first SLICE_BARS bars of AMZN_data.csv"""
+    file_name = str(tmp_path_factory.mktemp('data') / 'AMZN_slice.csv')
+    with open(os.path.join(os.path.dirname(__file__), 'AMZN_data.csv')) as source, open(file_name, 'w') as f:
+        for _, line in zip(range(SLICE_BARS + 1), source):  # And the header
+            f.write(line)
+    return file_name
@@ -0,0 +1,169 @@
+import os
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+# Names of the bt.Order.Status codes stored with the order events
+ORDER_STATUS = ('Created', 'Submitted', 'Accepted', 'Partial', 'Completed', 'Canceled', 'Expired', 'Margin',
+                'Rejected')
+COMPLETED = ORDER_STATUS.index('Completed')
+
+# Datetimes are integer microseconds since the Unix epoch
+ORDER_DTYPE = np.dtype([('datetime', 'i8'), ('size', 'f8'), ('price', 'f8'), ('value', 'f8'),
+                        ('commission', 'f8'), ('status', 'i1')])
+TRADE_DTYPE = np.dtype([('open_datetime', 'i8'), ('close_datetime', 'i8'), ('long', '?'), ('price', 'f8'),
+                        ('pnl', 'f8'), ('pnlcomm', 'f8'), ('commission', 'f8'), ('bars', 'i8')])
+
+
+def bt_microseconds(dt):
+    """
+    :return: the microseconds since the Unix epoch of a backtrader datetime, days since 0001-01-01. Their
+        float only has a precision of about 10 microseconds nowadays, so they are rounded to the millisecond.
+    """
+    return round((dt - 719163.0) * 86400e3) * 1000
+
+
+def won_trades(pnlcomm):
+    """
+    :return: boolean array of which of the net profits pnlcomm are won trades. A break-even trade is won, as
+        bt.analyzers.TradeAnalyzer counts it, and every count of won trades uses this rule
+    """
+    return np.asarray(pnlcomm, dtype=float) >= 0.0
+
+
+def format_datetime(microseconds):
+    return str(pd.Timestamp(microseconds, unit='us'))
+
+
+def print_event(kind, event):
+    """Sink printing the events the way MyStrategy.log did"""
+    if kind == 'order':
+        if event['status'] == COMPLETED:
+            text = (f"{'BUY ' if event['size'] > 0 else 'SELL'}  price: {event['price']:.2f}, "
+                    f"size: {event['size']:.2f}, commission: {event['commission']:.2f}")
+        else:
+            text = f"ORDER REJECTED/MARGIN ISSUE - {ORDER_STATUS[event['status']]}"
+        print(format_datetime(event['datetime']) + '--' + text)
+    elif kind == 'trade':
+        print(format_datetime(event['close_datetime'])
+              + f"--CLOSED   Gross P/L: {event['pnl']:.2f}, Net P/L: {event['pnlcomm']:.2f}, "
+                f"Commission: {event['commission']:.2f}, Bars: {event['bars']}, "
+                f"{'TAKE PROFIT' if event['pnlcomm'] > 0 else 'STOP LOSS'}")
+    else:
+        datetime, text, args = event
+        print(format_datetime(datetime) + '--' + text.format(*args))
+
+
+def trade_summary(trades):
+    """
+    :param trades: array or DataFrame of closed trades with pnlcomm, bars and commission fields
+    :return: dict of the closed trade statistics of the report, counted as bt.analyzers.TradeAnalyzer does
+    """
+    pnlcomm = np.asarray(trades['pnlcomm'], dtype=float)
+    won = pnlcomm[won_trades(pnlcomm)]
+    lost = pnlcomm[~won_trades(pnlcomm)]
+    return {'total': len(pnlcomm), 'won': len(won), 'lost': len(lost), 'net_profit': float(pnlcomm.sum()),
+            'max_win': float(max(won.max(), 0.0)) if len(won) else 0.0,
+            'average_win': float(won.mean()) if len(won) else 0.0,
+            'max_loss': float(min(lost.min(), 0.0)) if len(lost) else 0.0,
+            'average_loss': float(lost.mean()) if len(lost) else 0.0,
+            'average_bars': float(np.mean(trades['bars'])) if len(pnlcomm) else 0.0,
+            'commission': float(np.sum(trades['commission']))}
+
+
+class EventRecorder:
+    """
+    Order and trade events of a run, appended to preallocated structured arrays that double when they are
+    full. Recording an event formats nothing, so it is cheap enough for every GA evaluation, and the events
+    are exported to CSV, Parquet or SQLite after the run.
+
+    The sink, if there is one, gets every event for human-readable output: sink(kind, event) with kind
+    'order' or 'trade' and the record just stored, or kind 'note' and the (datetime, text, args) of a
+    message, whose text is only formatted by the sink.
+    """
+
+    def __init__(self, capacity=64, sink=None):
+        self.orders = np.empty(capacity, ORDER_DTYPE)
+        self.trades = np.empty(capacity, TRADE_DTYPE)
+        self.order_count = 0
+        self.trade_count = 0
+        self.sink = sink
+
+    def order(self, datetime, size, price, value, commission, status=COMPLETED):
+        n = self.order_count
+        if n == len(self.orders):
+            self.orders = np.concatenate([self.orders, np.empty_like(self.orders)])
+        self.orders[n] = (datetime, size, price, value, commission, status)
+        self.order_count = n + 1
+        if self.sink is not None:
+            self.sink('order', self.orders[n])
+
+    def trade(self, open_datetime, close_datetime, long, price, pnl, pnlcomm, commission, bars):
+        n = self.trade_count
+        if n == len(self.trades):
+            self.trades = np.concatenate([self.trades, np.empty_like(self.trades)])
+        self.trades[n] = (open_datetime, close_datetime, long, price, pnl, pnlcomm, commission, bars)
+        self.trade_count = n + 1
+        if self.sink is not None:
+            self.sink('trade', self.trades[n])
+
+    def note(self, datetime, text, *args):
+        """A message for the sink only, formatted with args by the sink"""
+        if self.sink is not None:
+            self.sink('note', (datetime, text, args))
+
+    def trade_summary(self):
+        """:return: trade_summary of the closed trades"""
+        return trade_summary(self.trades[:self.trade_count])
+
+    def order_frame(self):
+        df = pd.DataFrame(self.orders[:self.order_count])
+        df['datetime'] = pd.to_datetime(df['datetime'], unit='us')
+        df['status'] = pd.Categorical.from_codes(df['status'], categories=ORDER_STATUS)
+        return df
+
+    def trade_frame(self):
+        df = pd.DataFrame(self.trades[:self.trade_count])
+        for column in ('open_datetime', 'close_datetime'):
+            df[column] = pd.to_datetime(df[column], unit='us')
+        return df
+
+    def export(self, file_name, run=None):
+        """:return: list of the files export_events wrote the events to"""
+        return export_events({'orders': self.order_frame(), 'trades': self.trade_frame()}, file_name, run)
+
+
+def export_events(frames, file_name, run=None):
+    """
+    Writes the orders and trades frames by the extension of file_name: a .csv or .parquet name gets a _orders and
+    a _trades file next to it, and a .db or .sqlite file gets the rows appended to its orders and trades tables.
+
+    :param frames: dict of table name: DataFrame
+    :param run: label of the run, stored in a run column of every row if given
+    :return: list of the files written
+    """
+    if run is not None:
+        for df in frames.values():
+            df.insert(0, 'run', str(run))
+
+    stem, extension = os.path.splitext(file_name)
+    if extension in ('.db', '.sqlite'):
+        with closing(sqlite3.connect(file_name)) as conn:
+            for table, df in frames.items():
+                df.astype({'status': str} if 'status' in df else {}).to_sql(table, conn, if_exists='append',
+                                                                            index=False)
+        return [file_name]
+
+    files = []
+    for table, df in frames.items():
+        name = f'{stem}_{table}{extension}'
+        if extension == '.parquet':
+            df.to_parquet(name, index=False)  # Needs pyarrow or fastparquet
+        elif extension == '.csv':
+            df.to_csv(name, index=False)
+        else:
+            raise ValueError(f"Unknown event file type: {file_name}")
+        files.append(name)
+    return files
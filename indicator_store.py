@@ -0,0 +1,209 @@
+import math
+from collections import OrderedDict, deque
+
+import numpy as np
+
+# Default periods of bt.indicators.Ichimoku
+TENKAN_PERIOD = 9
+KIJUN_PERIOD = 26
+SENKOU_PERIOD = 52
+SENKOU_LEAD = 26
+
+# Donchian_Period range searched by the optimizer, computed together on the first request
+DONCHIAN_PERIODS = range(20, 51)
+
+# Bars needed on a feed before the indicators deliver values, as backtrader calculates it
+ICHIMOKU_MINPERIOD = SENKOU_PERIOD + SENKOU_LEAD
+
+
+def donchian_minperiod(period):
+    return period + 1  # lookback=-1 looks one bar further back
+
+
+def rolling_max(values, period, delay=0):
+    """Highest value over the last `period` bars, `delay` bars back. NaN until there is enough data."""
+    result = np.full(len(values), np.nan)
+    if len(values) >= period + delay:
+        windows = np.lib.stride_tricks.sliding_window_view(values, period)
+        result[period - 1 + delay:] = windows.max(axis=1)[:len(values) - period + 1 - delay]
+    return result
+
+
+def rolling_min(values, period, delay=0):
+    """Lowest value over the last `period` bars, `delay` bars back. NaN until there is enough data."""
+    result = np.full(len(values), np.nan)
+    if len(values) >= period + delay:
+        windows = np.lib.stride_tricks.sliding_window_view(values, period)
+        result[period - 1 + delay:] = windows.min(axis=1)[:len(values) - period + 1 - delay]
+    return result
+
+
+def shift(values, periods):
+    result = np.full(len(values), np.nan)
+    if periods < len(values):
+        result[periods:] = values[:len(values) - periods]
+    return result
+
+
+def donchian_channels(highs, lows, periods):
+    """
+    Upper and lower bands of DonchianChannels (lookback=-1) for several periods in a single
+    rolling pass: every window of the longest period is reduced from its newest bar
+    backwards, so column p - 1 holds the extreme of the last p bars.
+
+    :return: dict of period -> (dch, dcl) arrays, NaN until the indicator has enough data.
+    """
+    longest = max(periods)
+    n = len(highs)
+    padded_highs = np.concatenate([np.full(longest, -np.inf), highs[:-1]])
+    padded_lows = np.concatenate([np.full(longest, np.inf), lows[:-1]])
+    running_highs = np.maximum.accumulate(
+        np.lib.stride_tricks.sliding_window_view(padded_highs, longest)[:, ::-1], axis=1)
+    running_lows = np.minimum.accumulate(
+        np.lib.stride_tricks.sliding_window_view(padded_lows, longest)[:, ::-1], axis=1)
+
+    channels = {}
+    for period in periods:
+        dch = running_highs[:n, period - 1].copy()
+        dcl = running_lows[:n, period - 1].copy()
+        dch[:period] = dcl[:period] = np.nan
+        channels[period] = dch, dcl
+    return channels
+
+
+def ichimoku_senkou(highs, lows):
+    """Senkou span A and B of bt.indicators.Ichimoku, computed with the same operations."""
+    tenkan_sen = (rolling_max(highs, TENKAN_PERIOD) + rolling_min(lows, TENKAN_PERIOD)) / 2.0
+    kijun_sen = (rolling_max(highs, KIJUN_PERIOD) + rolling_min(lows, KIJUN_PERIOD)) / 2.0
+    senkou_span_a = shift((tenkan_sen + kijun_sen) / 2.0, SENKOU_LEAD)
+    senkou_span_b = shift((rolling_max(highs, SENKOU_PERIOD) + rolling_min(lows, SENKOU_PERIOD)) / 2.0, SENKOU_LEAD)
+    return senkou_span_a, senkou_span_b
+
+
+class RollingExtremes:
+    """Highest high and lowest low of the last `period` bars, updated bar by bar in amortized O(1)"""
+
+    def __init__(self, period):
+        self.period = period
+        # (bar, value) of the window in decreasing high / increasing low order, so the extremes are at the front
+        self.highs = deque()
+        self.lows = deque()
+        self.bars = 0
+
+    def add(self, high, low):
+        """:return: (highest, lowest) of the window ending with this bar, NaN until it has `period` bars"""
+        bar = self.bars
+        self.bars += 1
+        highs, lows = self.highs, self.lows
+        while highs and highs[-1][1] <= high:
+            highs.pop()
+        highs.append((bar, high))
+        while lows and lows[-1][1] >= low:
+            lows.pop()
+        lows.append((bar, low))
+
+        oldest = bar - self.period + 1
+        if highs[0][0] < oldest:
+            highs.popleft()
+        if lows[0][0] < oldest:
+            lows.popleft()
+        if oldest < 0:
+            return math.nan, math.nan
+        return highs[0][1], lows[0][1]
+
+
+class StreamingDonchian:
+    """The (dch, dcl) bands of donchian_channels, one bar at a time"""
+
+    def __init__(self, period):
+        self.window = RollingExtremes(period)
+        self.last = (math.nan, math.nan)
+
+    def add(self, high, low):
+        """:return: (dch, dcl) of this bar, which are the extremes of the `period` bars before it"""
+        bands = self.last
+        self.last = self.window.add(high, low)
+        return bands
+
+
+class StreamingIchimoku:
+    """The (senkou_span_a, senkou_span_b) spans of ichimoku_senkou, one bar at a time"""
+
+    def __init__(self):
+        self.tenkan = RollingExtremes(TENKAN_PERIOD)
+        self.kijun = RollingExtremes(KIJUN_PERIOD)
+        self.senkou = RollingExtremes(SENKOU_PERIOD)
+        self.leading = deque(maxlen=SENKOU_LEAD + 1)  # spans of the last bars, the oldest is the current one
+
+    def add(self, high, low):
+        """:return: (senkou_span_a, senkou_span_b) of this bar"""
+        tenkan_high, tenkan_low = self.tenkan.add(high, low)
+        kijun_high, kijun_low = self.kijun.add(high, low)
+        senkou_high, senkou_low = self.senkou.add(high, low)
+        tenkan_sen = (tenkan_high + tenkan_low) / 2.0
+        kijun_sen = (kijun_high + kijun_low) / 2.0
+        self.leading.append(((tenkan_sen + kijun_sen) / 2.0, (senkou_high + senkou_low) / 2.0))
+        if len(self.leading) <= SENKOU_LEAD:
+            return math.nan, math.nan
+        return self.leading[0]
+
+
+class IndicatorStore:
+    """
+    Indicator lines of the resampled feeds of one dataset, computed once and shared by
+    every backtest that runs on it. Series are keyed by (timeframe, indicator, period)
+    and the least recently used ones are evicted once more than `maxsize` are stored.
+
+    `frames` maps a timeframe (the resampling compression in minutes) to the (highs, lows)
+    arrays of its bars, in the order the resampled feed delivers them.
+    """
+
+    def __init__(self, frames, maxsize=128):
+        self.frames = frames
+        self.maxsize = maxsize
+        self._series = OrderedDict()
+
+    def __len__(self):
+        return len(self._series)
+
+    def __contains__(self, key):
+        return key in self._series
+
+    def get(self, timeframe, indicator, period=None):
+        """
+        :param indicator: 'donchian' for the (dch, dcl) bands of `period` or 'ichimoku' for
+            the (senkou_span_a, senkou_span_b) spans.
+        :return: tuple of arrays indexed by bar of the `timeframe` feed.
+        """
+        key = (timeframe, indicator, period)
+        if key in self._series:
+            self._series.move_to_end(key)
+            return self._series[key]
+
+        highs, lows = self.frames[timeframe]
+        if indicator == 'donchian':
+            # One pass serves the whole optimizer range, so compute it all on the first miss
+            periods = DONCHIAN_PERIODS if period in DONCHIAN_PERIODS else [period]
+            channels = donchian_channels(highs, lows, periods)
+            for p in periods:
+                if p != period:
+                    self._store((timeframe, indicator, p), channels[p])
+            lines = self._store(key, channels[period])
+        elif indicator == 'ichimoku':
+            lines = self._store(key, ichimoku_senkou(highs, lows))
+        else:
+            raise ValueError(f"Unknown indicator: {indicator}")
+        return lines
+
+    @staticmethod
+    def minperiod(indicator, period=None):
+        if indicator == 'donchian':
+            return donchian_minperiod(period)
+        return ICHIMOKU_MINPERIOD
+
+    def _store(self, key, lines):
+        self._series[key] = lines
+        self._series.move_to_end(key)
+        while len(self._series) > self.maxsize:
+            self._series.popitem(last=False)
+        return lines
@@ -0,0 +1,103 @@
+import cProfile
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+
+# Phases of an evaluation, in seconds
+PHASES = ('cache_lookup', 'data_setup', 'indicators', 'bar_loop', 'analyzers', 'cache_store')
+
+
+class EvaluationProfiler:
+    """
+    Timing records of the evaluations. Workers append one record per evaluation to a list shared through
+    a manager, and the main process collects them after every generation: they are written to log_file as
+    JSON lines with the generation, followed by a summary line of the generation that is also printed.
+    With profile_every set, every profile_every-th evaluation of each worker runs under cProfile and its
+    stats are dumped to profile_dir.
+    """
+
+    def __init__(self, records, log_file='evaluation_log.jsonl', profile_every=0, profile_dir='profiles'):
+        self.records = records
+        self.log_file = log_file
+        self.profile_every = profile_every
+        self.profile_dir = profile_dir
+        self.evaluations = 0  # Evaluations of this process, for profile_every
+
+    @classmethod
+    def start(cls, log_file='evaluation_log.jsonl', profile_every=0, profile_dir='profiles'):
+        """Starts the manager of the shared record list and truncates the log file"""
+        manager = multiprocessing.Manager()
+        profiler = cls(manager.list(), log_file, profile_every, profile_dir)
+        profiler._manager = manager
+        open(log_file, 'w').close()
+        return profiler
+
+    def close(self):
+        self._manager.shutdown()
+
+    def __getstate__(self):
+        return {'records': self.records, 'log_file': self.log_file, 'profile_every': self.profile_every,
+                'profile_dir': self.profile_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def record(self, **fields):
+        """Adds the record of an evaluation: its phase times, cache outcome and anything else worth keeping"""
+        fields.update(time=time.time(), pid=os.getpid())
+        self.records.append(fields)
+
+    def profile(self):
+        """:return: an enabled cProfile.Profile if this evaluation is to be profiled, else None"""
+        self.evaluations += 1
+        if not self.profile_every or self.evaluations % self.profile_every:
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def save_profile(self, profile):
+        """Stops the profile and dumps its stats, for pstats or snakeviz, next to the other profiles"""
+        profile.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        file_name = os.path.join(self.profile_dir, f'evaluation_{os.getpid()}_{self.evaluations}.prof')
+        profile.dump_stats(file_name)
+        return file_name
+
+    def collect(self, generation, elapsed, processes):
+        """
+        Writes the records added since the last collect with their generation and a summary of them.
+
+        :param elapsed: wall time of the generation, for the utilization of the workers
+        :param processes: number of workers
+        :return: the summary dict
+        """
+        count = len(self.records)
+        records = self.records[:count]
+        del self.records[:count]
+
+        totals = defaultdict(float)
+        hits = 0
+        for record in records:
+            hits += record['cache'] == 'hit'
+            for phase in PHASES:
+                totals[phase] += record.get(phase, 0.0)
+            totals['total'] += record['total']
+
+        summary = {'type': 'generation', 'generation': generation, 'evaluations': len(records),
+                   'cache_hits': hits, 'cache_misses': len(records) - hits, 'elapsed': elapsed,
+                   'utilization': totals['total'] / (elapsed * processes) if elapsed else 0.0}
+        summary.update({f'{phase}_seconds': totals[phase] for phase in PHASES + ('total',)})
+
+        with open(self.log_file, 'a') as f:
+            for record in records:
+                f.write(json.dumps({'type': 'evaluation', 'generation': generation, **record}) + '\n')
+            f.write(json.dumps(summary) + '\n')
+
+        busy = totals['total'] or 1.0
+        print(f"Generation {generation}: {len(records)} evaluations, {hits} cache hits, "
+              f"utilization {summary['utilization']:.0%} - "
+              + ', '.join(f"{phase} {totals[phase] / busy:.0%}" for phase in PHASES))
+        return summary
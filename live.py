@@ -0,0 +1,427 @@
+import argparse
+import csv
+import math
+import queue
+import socket
+import sys
+import threading
+import time
+from array import array
+
+import numpy as np
+
+from events import EventRecorder
+from indicator_store import IndicatorStore, StreamingDonchian, StreamingIchimoku
+from support import read_data_frame
+from vector_engine import COMPRESSIONS, MINUTE, MarketData, Resampler, _split, run_backtest
+
+# Decisions slower than this, in seconds, are reported
+LATENCY_TARGET = 0.001
+
+# MyStrategy parameters the trader reads, with their defaults
+DEFAULT_PARAMS = {'Donchian_Period': 40, 'risk_per_trade': 0.003, 'stop_distance_factor': 0.01,
+                  'take_profit_distance_factor': 0.01, 'take_profit_trigger_factor': 0.4}
+
+
+# Bars travel as text lines: the timestamp in integer microseconds, open, high, low, close, volume and the
+# time.time_ns() the line was sent at, for the transport latency
+def format_bar(t, o, h, l, c, v):
+    return f"{t},{o!r},{h!r},{l!r},{c!r},{v!r},{time.time_ns()}\n".encode()
+
+
+def parse_bar(line):
+    """:return: (timestamp, open, high, low, close, volume, sent_ns) of a bar line"""
+    t, o, h, l, c, v, sent = line.split(b',')
+    return int(t), float(o), float(h), float(l), float(c), float(v), int(sent)
+
+
+def socket_lines(host='127.0.0.1', port=5555):
+    """Bar lines read from a replay server or any other source that writes them to a TCP connection"""
+    with socket.create_connection((host, port)) as connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with connection.makefile('rb') as stream:
+            yield from stream
+
+
+def queue_lines(bar_queue):
+    """Bar lines taken from a queue.Queue or multiprocessing queue until a None"""
+    while True:
+        line = bar_queue.get()
+        if line is None:
+            return
+        yield line
+
+
+def data_bars(file_name):
+    """:return: list of the (timestamp, open, high, low, close, volume) bars of a data file"""
+    df = read_data_frame(file_name)
+    times = df.index.values.astype('datetime64[us]').astype(np.int64)
+    return list(zip(times.tolist(), *(df[column].tolist() for column in ('open', 'high', 'low', 'close', 'volume'))))
+
+
+def replay_bars(bars, send, speed=0.0):
+    """
+    Sends bar lines with send(line), `speed` times faster than real time. The pause between two bars is
+    the time between them, up to a minute, so nights and weekends do not stall the replay. A speed of 0
+    sends the bars as fast as possible.
+    """
+    start = time.perf_counter()
+    elapsed = 0.0
+    last = None
+    for bar in bars:
+        if speed and last is not None:
+            elapsed += min(bar[0] - last, MINUTE) / 1e6 / speed
+            delay = start + elapsed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        last = bar[0]
+        send(format_bar(*bar))
+
+
+def serve_replay(file_name, host='127.0.0.1', port=5555, speed=0.0, clients=1):
+    """Replays the bars of a data file to each of `clients` connections to host:port, one after the other"""
+    bars = data_bars(file_name)
+    with socket.create_server((host, port)) as server:
+        print(f"Replaying {len(bars)} bars of {file_name} on {host}:{port}")
+        for _ in range(clients):
+            connection, address = server.accept()
+            with connection:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                replay_start = time.time()
+                replay_bars(bars, connection.sendall, speed)
+            print(f"Replayed to {address[0]}:{address[1]} in {time.time() - replay_start:.2f} seconds")
+
+
+class LiveTrader:
+    """
+    MyStrategy on a stream of 1-minute bars, with a paper broker. Every bar updates the 15 and 60-minute bars
+    being built, the indicators of a resampled bar it completes, the broker, and then makes the decisions of
+    MyStrategy.next. The broker works as the one of run_backtest: orders are checked against the cash at the
+    price they were made at and fill at the open of the next bar. A replay of a data file makes the same
+    orders as run_backtest on it, except that no trade is closed at the end.
+    """
+
+    def __init__(self, params=None, starting_capital=10000, commission=0.00035, event_sink=None):
+        params = {**DEFAULT_PARAMS, **(params or {})}
+        self.risk_per_trade = params['risk_per_trade']
+        self.stop_distance_factor = params['stop_distance_factor']
+        self.take_profit_distance_factor = params['take_profit_distance_factor']
+        self.take_profit_trigger_factor = params['take_profit_trigger_factor']
+        donchian_period = int(params['Donchian_Period'])
+        self.commission = commission
+
+        # Resampled timeframes and their indicators, as MyStrategy builds them on data1 and data2
+        self.resamplers = [Resampler(compression) for compression in COMPRESSIONS]
+        self.donchians = [StreamingDonchian(donchian_period) for _ in COMPRESSIONS]
+        self.ichimokus = [StreamingIchimoku() for _ in COMPRESSIONS]
+        self.frame_bars = [0] * len(COMPRESSIONS)
+        self.minperiod = max(IndicatorStore.minperiod('ichimoku'), IndicatorStore.minperiod('donchian', donchian_period))
+        self.active = False  # every timeframe has its minimum period
+        # dch, dcl, senkou_span_a and senkou_span_b of the last completed bar of the first timeframe
+        self.dch = self.dcl = self.span_a = self.span_b = math.nan
+
+        self.cash = self.value = float(starting_capital)
+        self.position = 0
+        self.position_price = 0.0
+        self.has_position_entry = False
+        self.submitted = []  # (size, price) of the orders made on the last bar
+        self.order = False  # MyStrategy.order is set
+        self.stop_price = self.take_profit_price = self.trailing_profit_price = None
+        self.events = EventRecorder(sink=event_sink)  # Every execution
+
+    def on_bar(self, t, o, h, l, c, v):
+        """
+        Takes the next 1-minute bar.
+
+        :return: list of the (size, price) orders decided on this bar, filled at the open of the next one
+        """
+        for k, resampler in enumerate(self.resamplers):
+            bar = resampler.add(t, o, h, l, c, v)
+            if bar is not None:
+                bands = self.donchians[k].add(bar[2], bar[3])
+                spans = self.ichimokus[k].add(bar[2], bar[3])
+                self.frame_bars[k] += 1
+                if not k:
+                    (self.dch, self.dcl), (self.span_a, self.span_b) = bands, spans
+                if not self.active:
+                    self.active = min(self.frame_bars) >= self.minperiod
+
+        completed = self.fill(t, o) if self.submitted else False
+        if self.has_position_entry:
+            position_value = self.position * c
+            unrealized = self.position * (c - self.position_price)
+            # Not position_value in floating point: the operations of BackBroker.getvalue, as run_backtest does
+            # them, so the value and the order sizes derived from it match to the last bit. Do not simplify
+            self.value = self.cash + (position_value - unrealized + unrealized if position_value > 0 else position_value)
+        else:
+            self.value = self.cash
+        if completed:
+            self.order = False
+
+        if self.active and not self.order:
+            self.decide(c)
+        return self.submitted
+
+    def fill(self, t, price):
+        """Checks the orders of the last bar against the cash and executes them at `price`. :return: True"""
+        self.has_position_entry = True
+        check_cash, check_position = self.cash, self.position
+        accepted = []
+        for size, created_price in self.submitted:
+            opened, closed = _split(check_position, size)
+            check_position += size
+            if closed:
+                check_cash += -closed * created_price
+                check_cash -= abs(closed) * self.commission * created_price
+            if opened:
+                check_cash -= opened * created_price
+                check_cash -= abs(opened) * self.commission * created_price
+            if check_cash >= 0.0:
+                accepted.append(size)
+        self.submitted = []
+
+        for size in accepted:
+            position = self.position
+            opened, closed = _split(position, size)
+            closed_comm = opened_comm = 0.0
+            if closed:
+                pnl = -closed * (price - self.position_price)
+                self.cash += -closed * self.position_price + pnl
+                closed_comm = abs(closed) * self.commission * price
+                self.cash -= closed_comm
+            if opened:
+                opened_comm = abs(opened) * self.commission * price
+                opened_cash = self.cash - opened * price - opened_comm
+                if opened_cash < 0.0:
+                    opened, opened_comm = 0, 0.0
+                else:
+                    self.cash = opened_cash
+
+            executed = closed + opened
+            if executed:
+                # The price averaged the way bt.Order does it, as run_backtest records it
+                self.events.order(t, executed, executed * price / executed, executed * price,
+                                  closed_comm + opened_comm)
+                new_position = position + executed
+                if not new_position:
+                    self.position_price = 0.0
+                elif not position or (position > 0) != (new_position > 0):
+                    self.position_price = price
+                elif (executed > 0) == (position > 0):
+                    self.position_price = (self.position_price * position + executed * price) / new_position
+                self.position = new_position
+        return True
+
+    def size(self, close, stop_loss_distance):
+        """FixedRiskSizer"""
+        if stop_loss_distance <= 0:
+            return 0
+        size = self.value * self.risk_per_trade / stop_loss_distance
+        if size > self.value:
+            size = self.value / close
+        return math.floor(size)
+
+    def decide(self, close):
+        """MyStrategy.next on the bar closing at `close`"""
+        position = self.position
+        if not position:
+            if close > max(self.span_a, self.span_b):
+                self.stop_price = self.dcl * (1 - self.stop_distance_factor)
+                self.take_profit_price = self.dch * (1 + self.take_profit_distance_factor)
+                size = self.size(close, close - self.stop_price)
+                if size:
+                    self.submitted.append((size, close))
+                    self.order = True
+                return
+            elif close < min(self.span_a, self.span_b):
+                self.stop_price = self.dch * (1 + self.stop_distance_factor)
+                self.take_profit_price = self.dcl * (1 - self.take_profit_distance_factor)
+                size = self.size(close, self.stop_price - close)
+                if size:
+                    self.submitted.append((-size, close))
+                    self.order = True
+                return
+
+        # Stop loss
+        if position > 0 and close <= self.stop_price or position < 0 and close >= self.stop_price:
+            self.submitted.append((-position, close))
+            return
+
+        # Trailing take profit
+        if position > 0:
+            if self.take_profit_price and close >= self.take_profit_price * (1 - self.take_profit_trigger_factor):
+                self.take_profit_price = close
+                self.trailing_profit_price = close - close * self.take_profit_distance_factor
+            if self.trailing_profit_price and close <= self.trailing_profit_price:
+                self.submitted.append((-position, close))
+                self.trailing_profit_price = self.take_profit_price = None
+        elif position < 0:
+            if self.take_profit_price and close <= self.take_profit_price * (1 + self.take_profit_trigger_factor):
+                self.take_profit_price = close
+                self.trailing_profit_price = close + close * self.take_profit_distance_factor
+            if self.trailing_profit_price and close >= self.trailing_profit_price:
+                self.submitted.append((-position, close))
+                self.trailing_profit_price = self.take_profit_price = None
+
+
+class LatencyStats:
+    """Decision latency (bar line received to orders decided) and transport latency (sent to received) of every bar"""
+
+    def __init__(self):
+        self.decision = array('q')
+        self.transport = array('q')
+
+    def add(self, decision_ns, transport_ns):
+        self.decision.append(decision_ns)
+        self.transport.append(transport_ns)
+
+    def summary(self):
+        """:return: dict of the bar count and the mean, median, 99th percentile and max latencies in microseconds"""
+        summary = {'bars': len(self.decision)}
+        for name, values in (('decision', self.decision), ('transport', self.transport)):
+            values = np.frombuffer(values, dtype=np.int64) / 1000.0 if len(values) else np.zeros(1)
+            summary.update({f'{name}_mean_us': float(values.mean()), f'{name}_p50_us': float(np.percentile(values, 50)),
+                            f'{name}_p99_us': float(np.percentile(values, 99)), f'{name}_max_us': float(values.max())})
+        return summary
+
+
+def trade(lines, trader, stats=None, on_orders=None):
+    """
+    Runs the trader on a stream of bar lines. The decision latency of a bar runs from the moment its line is
+    taken from the stream until the trader has decided on it, so on_orders(t, orders), called with the orders
+    of every bar that has some, is not part of it.
+
+    :return: LatencyStats
+    """
+    stats = stats or LatencyStats()
+    perf_counter_ns, time_ns = time.perf_counter_ns, time.time_ns
+    for line in lines:
+        received = perf_counter_ns()
+        t, o, h, l, c, v, sent = parse_bar(line)
+        orders = trader.on_bar(t, o, h, l, c, v)
+        stats.add(perf_counter_ns() - received, time_ns() - sent)
+        if orders and on_orders is not None:
+            on_orders(t, orders)
+    return stats
+
+
+def compare_with_backtest(file_name, **params):
+    """
+    Replays the bars of a data file through LiveTrader and runs run_backtest on it, and reports any difference
+    in the executions or the final value. LiveTrader is a copy of the logic of MyStrategy and run_backtest,
+    so this is the check that it has not drifted from them.
+
+    :return: True if both agree.
+    """
+    trader = LiveTrader(params)
+    for bar in data_bars(file_name):
+        trader.on_bar(*bar)
+    result = run_backtest(MarketData(read_data_frame(file_name)), **params)
+
+    executions = trader.events.orders[:trader.events.order_count]
+    expected = {
+        'final value': result.final_value,
+        'executions': [(dt.value // 1000, size, price, comm) for dt, size, price, comm in result.orders],
+    }
+    actual = {
+        'final value': trader.value,
+        'executions': [(int(e['datetime']), float(e['size']), float(e['price']), float(e['commission']))
+                       for e in executions],
+    }
+
+    equal = True
+    for key in expected:
+        if expected[key] != actual[key]:
+            print(f"{key} differs: run_backtest {expected[key]} / live {actual[key]}")
+            equal = False
+    print(f"{file_name}: {len(executions)} executions, final value {trader.value:.2f} - "
+          f"{'equivalent' if equal else 'NOT equivalent'}")
+    return equal
+
+
+def load_params(file_name='best_metrics.csv'):
+    """:return: the MyStrategy parameters in a best_metrics.csv written by main_program"""
+    with open(file_name, newline='') as f:
+        return {row['Parameter']: float(row['Value']) for row in csv.DictReader(f) if row['Parameter'] in DEFAULT_PARAMS}
+
+
+def print_orders(t, orders):
+    date = np.datetime64(t, 'us').astype('datetime64[s]')
+    for size, price in orders:
+        print(f"{date} {'BUY ' if size > 0 else 'SELL'} size: {abs(size)}, close: {price:.2f}")
+
+
+def report(trader, stats):
+    summary = stats.summary()
+    print(f"{summary['bars']} bars, {trader.events.order_count} executions, position {trader.position}, "
+          f"value {trader.value:.2f}")
+    for name in ('decision', 'transport'):
+        print(f"{name.capitalize()} latency: mean {summary[f'{name}_mean_us']:.1f} us, "
+              f"p50 {summary[f'{name}_p50_us']:.1f} us, p99 {summary[f'{name}_p99_us']:.1f} us, "
+              f"max {summary[f'{name}_max_us']:.1f} us")
+    if summary['decision_p99_us'] > LATENCY_TARGET * 1e6:
+        print(f"Warning: the 99th percentile decision latency is over the {LATENCY_TARGET * 1e6:.0f} us target")
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Paper trades MyStrategy on 1-minute bars streamed from a socket, and replays data files to it')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    replay = subparsers.add_parser('replay', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                   help='Serve the bars of a data file on a local socket')
+    replay.add_argument('file', help='Data CSV file')
+    replay.add_argument('--speed', type=float, default=0.0,
+                        help='Times faster than real time, 0 for as fast as possible')
+    replay.add_argument('--clients', type=int, default=1, help='Connections to serve before exiting')
+
+    trader = subparsers.add_parser('trade', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                   help='Paper trade the bars read from a replay server')
+    trader.add_argument('--replay', metavar='FILE', default=None,
+                        help='Replay this data file in a thread through a queue instead of reading a socket')
+    trader.add_argument('--speed', type=float, default=0.0, help='Speed of the --replay')
+    trader.add_argument('--params', default='best_metrics.csv', help='best_metrics.csv with the parameters, '
+                                                                     'or none for the defaults')
+    trader.add_argument('--quiet', action='store_true', help='Do not print the orders')
+    trader.add_argument('--events', default=None, help='Write the executions to this .csv, .parquet or .db file')
+
+    check = subparsers.add_parser('check', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help='Check that the trader makes the executions of run_backtest on a data file')
+    check.add_argument('file', help='Data CSV file')
+    check.add_argument('--params', default='none', help='best_metrics.csv with the parameters, '
+                                                        'or none for the defaults')
+
+    for subparser in (replay, trader):
+        subparser.add_argument('--host', default='127.0.0.1')
+        subparser.add_argument('--port', type=int, default=5555)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'replay':
+        serve_replay(args.file, args.host, args.port, args.speed, args.clients)
+        sys.exit()
+    if args.command == 'check':
+        sys.exit(0 if compare_with_backtest(args.file, **(load_params(args.params) if args.params != 'none' else {}))
+                 else 1)
+
+    params = load_params(args.params) if args.params != 'none' else {}
+    trader = LiveTrader(params)
+    if args.replay:
+        bar_queue = queue.Queue()
+        bars = data_bars(args.replay)
+
+        def producer():
+            replay_bars(bars, bar_queue.put, args.speed)
+            bar_queue.put(None)
+
+        threading.Thread(target=producer, daemon=True).start()
+        lines = queue_lines(bar_queue)
+    else:
+        lines = socket_lines(args.host, args.port)
+    report(trader, trade(lines, trader, on_orders=None if args.quiet else print_orders))
+    if args.events:
+        print(f"Executions written to {', '.join(trader.events.export(args.events))}")
@@ -1,107 +1,577 @@
-import csv
+import functools
+import math
 import multiprocessing
+import os
+import pickle
+import queue
 import random
 import sys
 import time
 import warnings
 
 import backtrader as bt
-import quantstats
+import numpy as np
+import pandas as pd
 from deap import base, creator, tools, algorithms
 
 from Strat import MyStrategy
-from support import FixedRiskSizer, CommissionAnalyzer, define_data_alphavantage, load_cache_db, update_cache_db, \
-    setup_database
+from events import won_trades
+from instrumentation import EvaluationProfiler
+from results_store import ResultsStore, backtest_events, dataset_hash, recorder_events, write_pareto, write_report
+from support import FixedRiskSizer, MetricsAnalyzer, EvaluationCache, Surrogate, define_data_alphavantage, \
+    quantize_params, setup_database
+from vector_engine import MarketData, run_backtest, run_backtests
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-setup_database()
-
-data, total_candles = define_data_alphavantage('AMZN', start_year=2023, start_month=5, months=15, interval='1min')
-param_cache = load_cache_db()
-
-
-def create_data():
-    cerebro = bt.Cerebro()
-    cerebro.adddata(data)
-    cerebro.resampledata(data, timeframe=bt.TimeFrame.Minutes, compression=15)
-    cerebro.resampledata(data, timeframe=bt.TimeFrame.Minutes, compression=60)
+# Importing this module has no side effects: the forkserver and spawned workers import it too. The main process
+# loads the data with load_market_data, and pool workers attach to it in init_worker instead of loading it again
+
+
+def load_market_data():
+    """Loads the data of the optimization into the market_data and total_candles globals of the main process"""
+    global data, total_candles, market_data
+    data, total_candles = define_data_alphavantage('AMZN', start_year=2023, start_month=5, months=15, interval='1min')
+    market_data = MarketData(data.p.dataname)
+
+
+def init_worker(market_data_handle, cache, profiler=None, started=None, store=None):
+    """
+    Pool initializer: attaches the market data, the evaluation cache, profiler and results store shared by the
+    main process.
+
+    :param started: shared counter of the workers that are ready, for start_pool
+    """
+    global market_data, total_candles, evaluation_cache, evaluation_profiler, results_store
+    market_data = MarketData.attach(market_data_handle)
+    total_candles = len(market_data)
+    evaluation_cache = cache
+    evaluation_profiler = profiler
+    results_store = store
+    if started is not None:
+        with started.get_lock():
+            started.value += 1
+
+
+def worker_context(method=None):
+    """
+    :return: the multiprocessing context of the `method` start method, start_method by default and spawn where
+        it is not available. With forkserver, the server imports this module once, and with it numpy, pandas,
+        backtrader and deap, and every worker is a fork of it that only has to attach the shared data.
+    """
+    method = method or start_method
+    if method not in multiprocessing.get_all_start_methods():
+        method = 'spawn'
+    context = multiprocessing.get_context(method)
+    if method == 'forkserver':
+        # Preloading '__main__' does not work (the server never gets the path of the script), so the module is
+        # preloaded by its name. Workers still run the script as __mp_main__, but with everything imported already
+        context.set_forkserver_preload([os.path.splitext(os.path.basename(__file__))[0]])
+    return context
+
+
+def start_pool(processes, market_data_handle, cache, profiler=None, context=None, store=None):
+    """
+    Starts the worker pool in context, worker_context() by default, and waits until every worker has run
+    init_worker.
+
+    :return: (pool, seconds until all the workers were ready)
+    """
+    context = context or worker_context()
+    processes = processes or os.cpu_count()
+
+    start_time = time.perf_counter()
+    started = context.Value('i', 0)
+    pool = context.Pool(processes, initializer=init_worker,
+                        initargs=(market_data_handle, cache, profiler, started, store))
+    while started.value < processes and time.perf_counter() - start_time < 60:
+        time.sleep(0.005)
+    return pool, time.perf_counter() - start_time
+
+
+def create_data(fitness=False):
+    """
+    :param fitness: lean setup for GA evaluations, without observers and with only the analyzers
+        the fitness reads. The full setup adds the observers, for runs that are plotted.
+    """
+    cerebro = bt.Cerebro(stdstats=not fitness)
+    # 1 minute data plus the 15 and 60 minute bars, resampled once when the data is loaded
+    for feed in market_data.feeds():
+        cerebro.adddata(feed)
 
     cerebro.broker.setcash(starting_capital)
     cerebro.broker.setcommission(commission=commission)
     cerebro.addsizer(FixedRiskSizer)
-    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')
-    cerebro.addanalyzer(bt.analyzers.Returns, _name='returns')
-    cerebro.addanalyzer(CommissionAnalyzer, _name='commissions')
-    cerebro.addanalyzer(bt.analyzers.PyFolio, _name='PyFolio')
-    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trade_analyzer')
-
+    # Drawdown for the fitness, and the ratios, daily returns and commissions for the report
+    cerebro.addanalyzer(MetricsAnalyzer, _name='metrics')
+    # The trade statistics of the report come from the events MyStrategy records
     return cerebro
 
 
-# Fitness function
-def evaluate(individual):
-    cerebro = create_data()
-
-    params = tuple(individual)  # Convert params to tuple for caching
-
-    # Check if the parameters already exist in cache
-    if params in param_cache:
-        print(f"Using cached result for parameters: {params}")
-        return param_cache[params]  # Return cached result
-
-    donchian_period = max(20, min(individual[0], 50))  # Clamped between 20 and 50
-    order_factor = max(0.01, min(individual[1], 0.05))  # Clamped between 0.01 and 0.05
-    ichimoku_trend_factor = max(0.01, min(individual[2], 0.05))  # Clamped between 0.01 and 0.05
-    risk_per_trade = max(0.001, min(individual[3], 0.01))  # Clamped between 0.001 and 0.01
-    stop_distance_factor = max(0.01, min(individual[4], 0.05))  # Clamped between 0.01 and 0.05
-    take_profit_distance_factor = max(0.01, min(individual[5], 0.05))  # Clamped between 0.01 and 0.05
-    take_profit_trigger_factor = max(0.2, min(individual[6], 0.7))  # Clamped between 0.2 and 0.7
-
-    cerebro.addstrategy(MyStrategy,
-                        total_candles=total_candles,
-                        Donchian_Period=donchian_period,
-                        order_factor=order_factor,
-                        ichimoku_trend_factor=ichimoku_trend_factor,
-                        risk_per_trade=risk_per_trade,
-                        stop_distance_factor=stop_distance_factor,
-                        take_profit_distance_factor=take_profit_distance_factor,
-                        take_profit_trigger_factor=take_profit_trigger_factor,
-                        )
-
-    result = cerebro.run()
-
-    # Get results from analyzers
-    drawdown = result[0].analyzers.drawdown.get_analysis().max.drawdown
-    returns = result[0].broker.getvalue() - starting_capital
+def strategy_params_of(params):
+    """:return: MyStrategy keyword arguments of quantized parameters"""
+    return {name: value for (name, _, _, _), value in zip(param_space, params)}
+
+
+def backtest_window(market, end, strategy_params):
+    """:return: (returns, max drawdown) of a vector_engine run on a MarketData or MarketWindow ending at bar `end`"""
+    result = run_backtest(market, starting_capital=starting_capital, commission=commission,
+                          total_candles=end, **strategy_params)
+    return result.final_value - starting_capital, result.max_drawdown
+
+
+def trade_counts(trades):
+    """:return: dict of the closed trades of a vector_engine run and of the won ones, as the events count them"""
+    return {'trades': len(trades), 'won': int(won_trades([trade[3] for trade in trades]).sum())}
+
+
+def cached_fitness(key, tolerance):
+    """
+    :return: the cached fitness of key or of a configuration within tolerance of it, or None when the caller
+        has claimed key and must evaluate it
+    """
+    # Reuse the result of the same or a close enough configuration
+    cached = evaluation_cache.nearest(key, tolerance)
+    if cached is None:
+        # Check if the parameters already exist in cache, waiting for them if another worker is evaluating them
+        cached = evaluation_cache.claim(key)
+    return cached
+
+
+def store_fitness(key, fidelity, returns, drawdown, pruned, checkpoints, timings):
+    """
+    Penalizes a pruned run, prints the result and caches it, timing the store in timings['cache_store'].
+
+    :return: the fitness (returns, -drawdown)
+    """
+    params = key[:len(param_space)]
+    if pruned:
+        # Penalized so that NSGA-II ranks it behind the runs that completed. Its partial equity is no floor.
+        returns -= prune_penalty
+        drawdown = max(drawdown, prune_drawdown or 0)
+        checkpoints = None
 
     # Print parameters and results
-    print(f"\nParameters:")
-    print(f"  donchian_period: {individual[0]}")
-    print(f"  Order Factor: {individual[1]}")
-    print(f"  Ichimoku Trend Factor: {individual[2]}")
-    print(f"  Risk per Trade: {individual[3]}")
-    print(f"  Stop Distance Factor: {individual[4]}")
-    print(f"  Take Profit Distance Factor: {individual[5]}")
-    print(f"  Take Profit Trigger Factor: {individual[6]}")
-    print(f"Returns: ${returns:.2f}")
+    print(f"\nParameters{f' (on {fidelity:.0%} of the data)' if fidelity < 1 else ''}:")
+    print(f"  donchian_period: {params[0]}")
+    print(f"  Order Factor: {params[1]}")
+    print(f"  Ichimoku Trend Factor: {params[2]}")
+    print(f"  Risk per Trade: {params[3]}")
+    print(f"  Stop Distance Factor: {params[4]}")
+    print(f"  Take Profit Distance Factor: {params[5]}")
+    print(f"  Take Profit Trigger Factor: {params[6]}")
+    print(f"Returns: ${returns:.2f}{' (pruned)' if pruned else ''}")
     print(f"Drawdown: {-drawdown:.2f}%\n")
 
-    # Cache the new result
-    param_cache[params] = (returns, -drawdown)  # Cache in memory
-    update_cache_db(params, (returns, -drawdown))
+    # Cache the new result, shared with the other workers and persisted in batches by the cache writer. A pruned
+    # result is only shared for this run: its penalty depends on the pruning settings and the equity floor of
+    # the generation, and is no fitness for runs with other ones
+    store_time = time.perf_counter()
+    evaluation_cache.put(key, (returns, -drawdown), checkpoints, persist=fidelity == 1 and not pruned)
+    timings['cache_store'] = time.perf_counter() - store_time
     # Return as a tuple since DEAP minimizes the fitness function
     return returns, -drawdown
 
 
+def store_result(params, result, timings, engine='vector'):
+    """
+    Keeps a completed run on the whole data in results_store, timing it into timings['cache_store'].
+
+    :param result: (final value, max drawdown, daily values, orders, trades) of the run
+    """
+    store_time = time.perf_counter()
+    results_store.put(strategy_params_of(params), *result, engine=engine)
+    timings['cache_store'] += time.perf_counter() - store_time
+
+
+# Fitness function
+def evaluate(individual, prune_floor=None, fidelity=1.0):
+    """
+    :param prune_floor: equity checkpoints of the worst surviving individual of the last generation,
+        runs that fall below them are stopped when prune_equity is set.
+    :param fidelity: fraction of the data, the most recent bars, the individual is evaluated on
+    """
+    params = quantize_params(individual, param_space)  # Clamped and quantized, also the cache key
+    # Results on part of the data are cached apart, with the fidelity in their key
+    key, tolerance = (params, cache_tolerance) if fidelity == 1 else (params + (fidelity,), cache_tolerance + (0,))
+
+    start_time = time.perf_counter()
+    timings = {}  # Seconds spent in each instrumentation.PHASES of the evaluation
+
+    cached = cached_fitness(key, tolerance)
+    timings['cache_lookup'] = time.perf_counter() - start_time
+    if cached is not None:
+        print(f"Using cached result for parameters: {key}")
+        if evaluation_profiler is not None:
+            evaluation_profiler.record(params=key, cache='hit', total=timings['cache_lookup'], **timings)
+        return cached  # Return cached result
+
+    try:
+        return backtest_claimed(key, fidelity, prune_floor, start_time, timings)
+    except BaseException:
+        # Without a result the workers waiting for key would wait for the whole timeout of the claim
+        evaluation_cache.release(key)
+        raise
+
+
+def backtest_claimed(key, fidelity, prune_floor, start_time, timings):
+    """The backtest of evaluate once it has claimed key, which stores its result. :return: the fitness"""
+    params = key[:len(param_space)]
+    strategy_params = strategy_params_of(params)
+    pruning = dict(prune_drawdown=prune_drawdown, prune_floor=prune_floor,
+                   prune_interval=prune_interval if prune_equity else None)
+    profile = evaluation_profiler.profile() if evaluation_profiler is not None else None
+
+    stored = None  # What results_store keeps of a completed run on the whole data
+    setup_time = time.perf_counter()
+    if fidelity < 1:
+        # Partial evaluations run on the vector engine, on a window that reuses the indicators of the whole data
+        window = market_data.window(int(total_candles * (1 - fidelity)), total_candles)
+        timings['data_setup'] = time.perf_counter() - setup_time
+        result = run_backtest(window, starting_capital=starting_capital, commission=commission,
+                              total_candles=total_candles, prune_drawdown=prune_drawdown, **strategy_params)
+        drawdown = result.max_drawdown
+        returns = result.final_value - starting_capital
+        pruned, checkpoints = result.pruned, None
+        trades = trade_counts(result.trades)
+        timings.update(result.timings)
+    elif backtest_engine == 'vector':
+        result = run_backtest(market_data, starting_capital=starting_capital, commission=commission,
+                              total_candles=total_candles, daily=results_store is not None, **strategy_params,
+                              **pruning)
+        drawdown = result.max_drawdown
+        returns = result.final_value - starting_capital
+        pruned, checkpoints = result.pruned, result.checkpoints
+        trades = trade_counts(result.trades)
+        timings.update(result.timings)
+        if results_store is not None and not pruned:
+            stored = (result.final_value, drawdown, result.daily, *backtest_events(result, market_data.index))
+    else:
+        cerebro = create_data(fitness=True)
+        cerebro.addstrategy(MyStrategy, total_candles=total_candles, indicator_store=market_data.indicators,
+                            printlog=False, **strategy_params, **pruning)
+
+        run_time = time.perf_counter()
+        result = cerebro.run()
+
+        # Get results from analyzers
+        drawdown = result[0].analyzers.metrics.get_analysis()['max_drawdown']
+        returns = result[0].broker.getvalue() - starting_capital
+        pruned, checkpoints = result[0].pruned, result[0].checkpoints
+        summary = result[0].events.trade_summary()
+        trades = {'trades': summary['total'], 'won': summary['won']}
+        if results_store is not None and not pruned:
+            stored = (result[0].broker.getvalue(), drawdown, result[0].analyzers.metrics.period_equity(),
+                      *recorder_events(result[0].events))
+
+        # Cerebro loads the feeds before it creates the strategy, and stops the analyzers after the strategy
+        marks = result[0].timings
+        timings.update(data_setup=marks['init'] - setup_time, indicators=marks['indicators'] - marks['init'],
+                       bar_loop=marks['stop'] - marks['start'], analyzers=time.perf_counter() - marks['stop'])
+    if profile is not None:
+        evaluation_profiler.save_profile(profile)
+
+    fitness = store_fitness(key, fidelity, returns, drawdown, pruned, checkpoints, timings)
+    if stored is not None:
+        store_result(params, stored, timings, backtest_engine)
+    if evaluation_profiler is not None:
+        evaluation_profiler.record(params=key, cache='miss', engine='vector' if fidelity < 1 else backtest_engine,
+                                   fidelity=fidelity, pruned=pruned, profiled=profile is not None,
+                                   total=time.perf_counter() - start_time, **trades, **timings)
+    return fitness
+
+
+def evaluate_batch(individuals, prune_floor=None, fidelity=1.0):
+    """
+    evaluate for a batch of individuals on the vector engine: the ones that are not cached are backtested
+    together by vector_engine.run_backtests in one pass over the data, or one by one if there are fewer than
+    batch_min of them. Individuals of the batch with the same parameters are backtested once, and ones within
+    cache_tolerance of each other are all backtested.
+
+    :return: list of the fitness of every individual
+    """
+    fitnesses = [None] * len(individuals)
+    claimed = {}  # key: indices of the individuals with that key
+    for k, individual in enumerate(individuals):
+        params = quantize_params(individual, param_space)
+        key, tolerance = (params, cache_tolerance) if fidelity == 1 else (params + (fidelity,), cache_tolerance + (0,))
+        if key in claimed:
+            claimed[key].append(k)
+            continue
+
+        start_time = time.perf_counter()
+        cached = cached_fitness(key, tolerance)
+        lookup_time = time.perf_counter() - start_time
+        if cached is not None:
+            print(f"Using cached result for parameters: {key}")
+            if evaluation_profiler is not None:
+                evaluation_profiler.record(params=key, cache='hit', total=lookup_time, cache_lookup=lookup_time)
+            fitnesses[k] = cached
+        else:
+            claimed[key] = [k]
+    if not claimed:
+        return fitnesses
+
+    try:
+        backtest_batch(claimed, fitnesses, prune_floor, fidelity)
+    except BaseException:
+        # Releases the keys that have no result yet, the workers waiting for them would wait for the whole timeout
+        for key in claimed:
+            evaluation_cache.release(key)
+        raise
+    return fitnesses
+
+
+def backtest_batch(claimed, fitnesses, prune_floor, fidelity):
+    """
+    The backtests of evaluate_batch once it has claimed their keys, which store their results.
+
+    :param claimed: dict of key: indices of the individuals with that key, whose fitnesses are set
+    """
+    start_time = time.perf_counter()
+    keys = list(claimed)
+    runs = [strategy_params_of(key[:len(param_space)]) for key in keys]
+    if fidelity < 1:
+        market = market_data.window(int(total_candles * (1 - fidelity)), total_candles)
+        pruning = dict(prune_drawdown=prune_drawdown)
+    else:
+        market = market_data
+        pruning = dict(prune_drawdown=prune_drawdown, prune_floor=prune_floor,
+                       prune_interval=prune_interval if prune_equity else None)
+    daily = fidelity == 1 and results_store is not None
+    if len(runs) >= batch_min:
+        results = run_backtests(market, runs, starting_capital=starting_capital, commission=commission,
+                                total_candles=total_candles, daily=daily, **pruning)
+    else:
+        results = [run_backtest(market, starting_capital=starting_capital, commission=commission,
+                                total_candles=total_candles, daily=daily, **strategy_params, **pruning)
+                   for strategy_params in runs]
+    share = (time.perf_counter() - start_time) / len(keys)
+
+    for key, result in zip(keys, results):
+        timings = dict(result.timings)
+        fitness = store_fitness(key, fidelity, result.final_value - starting_capital, result.max_drawdown,
+                                result.pruned, result.checkpoints if fidelity == 1 else None, timings)
+        if daily and not result.pruned:
+            store_result(key, (result.final_value, result.max_drawdown, result.daily,
+                               *backtest_events(result, market_data.index)), timings)
+        if evaluation_profiler is not None:
+            evaluation_profiler.record(params=key, cache='miss', engine='vector', fidelity=fidelity,
+                                       pruned=result.pruned, batch=len(keys), total=share + timings['cache_store'],
+                                       **trade_counts(result.trades), **timings)
+        for k in claimed[key]:
+            fitnesses[k] = fitness
+
+
+def select_survivors(individuals, k):
+    """
+    NSGA-II selection. With prune_equity, the equity of the worst surviving individual becomes the
+    floor below which the evaluations of the next generation are stopped.
+    """
+    survivors = tools.selNSGA2(individuals, k)
+    if prune_equity:
+        curves = [(ind.fitness.values[0], evaluation_cache.checkpoints(quantize_params(ind, param_space)))
+                  for ind in survivors if ind.fitness.valid]
+        curves = [(returns, checkpoints) for returns, checkpoints in curves if checkpoints is not None]
+        if curves:
+            toolbox.register("evaluate", evaluate, prune_floor=min(curves, key=lambda curve: curve[0])[1])
+    return survivors
+
+
+def batched_map(map_func, evaluate_func, individuals):
+    """
+    Population-batched evaluation, used as the map under multi_fidelity_map: with batch_evaluations on the
+    vector engine and at least batch_min individuals per worker, the individuals are split into one batch per
+    worker and every batch is evaluated by evaluate_batch in a single pass over the data. evaluate_func is
+    toolbox.evaluate with the keywords (prune_floor, fidelity) it was given, which evaluate_batch gets too.
+    Anything else is mapped one individual at a time.
+
+    :return: list of the fitness of every individual
+    """
+    individuals = list(individuals)
+    # The partials of toolbox.register are not flattened into the ones on top of them
+    func, keywords = evaluate_func, {}
+    while isinstance(func, functools.partial) and not func.args:
+        func, keywords = func.func, {**func.keywords, **keywords}
+    vector = backtest_engine == 'vector' or keywords.get('fidelity', 1.0) < 1
+    processes = pool_processes or os.cpu_count()
+    if not batch_evaluations or func is not evaluate or not vector or len(individuals) < batch_min * processes:
+        return map_func(evaluate_func, individuals)
+
+    size = math.ceil(len(individuals) / processes)
+    results = map_func(functools.partial(evaluate_batch, **keywords),
+                       [individuals[start:start + size] for start in range(0, len(individuals), size)])
+    return [fitness for batch in results for fitness in batch]
+
+
+def multi_fidelity_map(map_func, evaluate_func, individuals):
+    """
+    Successive halving, used as toolbox.map: the individuals are evaluated on the first of the fidelities,
+    the best 1/fidelity_eta of them by NSGA-II rank on the next one, and so on up to the whole data.
+    The ones left behind get the fitness of the last fidelity they ran on, capped below the worst
+    individual that ran on the whole data and penalized by prune_penalty per fidelity they missed.
+
+    :return: list of the fitness of every individual
+    """
+    individuals = list(individuals)
+    fitnesses = [None] * len(individuals)
+    reached = [0] * len(individuals)
+    remaining = list(range(len(individuals)))
+
+    for level, fidelity in enumerate(fidelities):
+        results = map_func(functools.partial(evaluate_func, fidelity=fidelity), [individuals[k] for k in remaining])
+        candidates = []
+        for k, fitness in zip(remaining, results):
+            fitnesses[k], reached[k] = fitness, level
+            candidate = creator.Individual(individuals[k])
+            candidate.fitness.values = fitness
+            candidate.index = k
+            candidates.append(candidate)
+        if level < len(fidelities) - 1:
+            graduates = tools.selNSGA2(candidates, math.ceil(len(candidates) / fidelity_eta))
+            remaining = [candidate.index for candidate in graduates]
+
+    last = len(fidelities) - 1
+    evaluated = [fitnesses[k] for k in remaining]
+    for k in range(len(individuals)):
+        if reached[k] < last:
+            fitnesses[k] = rank_behind(fitnesses[k], evaluated, prune_penalty * (last - reached[k]))
+    return fitnesses
+
+
+def rank_behind(fitness, evaluated, penalty):
+    """:return: fitness capped below the worst returns and drawdown of the evaluated fitnesses, less penalty"""
+    returns, drawdown = fitness
+    return (min(returns, min(f[0] for f in evaluated)) - penalty, min(drawdown, min(f[1] for f in evaluated)))
+
+
+def surrogate_map(map_func, evaluate_func, individuals):
+    """
+    Surrogate pre-screening, used as toolbox.map in front of map_func. The Surrogate, trained on every full
+    result in the evaluation cache, predicts the fitness of the individuals that are not cached, and only the
+    surrogate_keep fraction NSGA-II ranks best on an optimistic prediction (mean plus one standard deviation
+    of the neighbours) is backtested. The others get their predicted fitness ranked behind the backtested
+    ones by rank_behind, and are not cached. Until the cache holds surrogate_min_samples results, all are
+    backtested.
+
+    :return: list of the fitness of every individual
+    """
+    global surrogate
+    if surrogate_keep >= 1:
+        return map_func(evaluate_func, individuals)
+    if surrogate is None:
+        surrogate = Surrogate([high - low for _, low, high, _ in param_space])
+    surrogate.sync(evaluation_cache.completed)
+
+    individuals = list(individuals)
+    keys = [quantize_params(ind, param_space) for ind in individuals]
+    new = [k for k, key in enumerate(keys) if key not in evaluation_cache.results]
+    if len(surrogate) < surrogate_min_samples or len(new) < 2:
+        return map_func(evaluate_func, individuals)
+
+    means, stds = surrogate.predict([keys[k] for k in new])
+    candidates = []
+    for k, mean, std in zip(new, means, stds):
+        candidate = creator.Individual(individuals[k])
+        candidate.fitness.values = tuple(mean + std)
+        candidate.index = k
+        candidates.append(candidate)
+    screened = {k: tuple(mean) for k, mean in zip(new, means)}
+    for candidate in tools.selNSGA2(candidates, math.ceil(len(candidates) * surrogate_keep)):
+        del screened[candidate.index]
+
+    backtested = [k for k in range(len(individuals)) if k not in screened]
+    fitnesses = [None] * len(individuals)
+    for k, fitness in zip(backtested, map_func(evaluate_func, [individuals[k] for k in backtested])):
+        fitnesses[k] = fitness
+    evaluated = [fitnesses[k] for k in backtested]
+    for k, prediction in screened.items():
+        fitnesses[k] = rank_behind(prediction, evaluated, prune_penalty)
+    print(f"Surrogate: backtested {len(backtested)} of {len(individuals)} individuals, "
+          f"trained on {len(surrogate)} results")
+    return fitnesses
+
+
 starting_capital = 10000
 commission = 0.00035
+backtest_engine = 'vector'  # 'vector' runs vector_engine.run_backtest, 'cerebro' a full backtrader run
 n_population = 2
 n_gen = 2
-
-# Define the fitness function: maximize returns and minimize drawdown
-creator.create("FitnessMulti", base.Fitness, weights=(1.0, -2.0))  # Maximize returns, minimize drawdown
-creator.create("Individual", list, fitness=creator.FitnessMulti)
+# 'full' optimizes on the whole data generation by generation, 'steady_state' without generation barriers,
+# 'walk_forward' on rolling windows
+optimization_mode = 'full'
+pool_processes = None  # Worker processes, one per CPU by default
+wf_train_fraction = 0.45  # Fraction of the 1-minute bars of the data each walk-forward window is optimized on
+wf_test_fraction = 0.15  # and then tested on
+prune_drawdown = None  # Stop evaluations once their drawdown exceeds this percentage, None to run them all
+prune_equity = False  # Stop evaluations whose equity falls below the worst surviving individual's
+prune_interval = 1000  # 1-minute bars between the equity checks
+prune_penalty = 100  # Taken off the returns of a stopped evaluation
+# Successive halving: fractions of the data, the most recent bars, the offspring are evaluated on in turn,
+# with only the best 1/fidelity_eta of them moving on to the next one, e.g. (0.25, 0.5, 1.0). Off by default:
+# with it, only part of every generation is backtested on the whole data, and the others get fitness values
+# from fewer bars in the hall of fame and the Pareto front. (1.0,) evaluates all on the whole data
+fidelities = (1.0,)
+fidelity_eta = 2
+# Surrogate pre-screening: fraction of the new offspring that is backtested, e.g. 0.5, once the cache holds
+# surrogate_min_samples results. Off by default: the others get predicted fitness values, which reach the hall
+# of fame and the Pareto front. 1.0 backtests all of them
+surrogate_keep = 1.0
+surrogate_min_samples = 50
+surrogate = None  # Surrogate over the evaluation cache, created by surrogate_map
+# Population-batched evaluation: every worker backtests its share of the offspring together in one pass over
+# the data, once it gets batch_min of them. Fewer are faster one by one. On by default, as it changes no fitness:
+# run_backtests gives the results of run_backtest. The only difference is that offspring of the same batch
+# within cache_tolerance of each other are all backtested instead of sharing one result. Small populations
+# such as the default one never reach batch_min per worker
+batch_evaluations = True
+batch_min = 32
+# Timing of every evaluation, written to evaluation_log.jsonl with a summary per generation
+profile_evaluations = True
+profile_every = 0  # Also run every Nth evaluation of each worker under cProfile, into profiles/. 0 for none
+evaluation_profiler = None  # EvaluationProfiler shared by the main process and the workers
+# Start method of the workers. 'forkserver' forks them from a server that has imported everything once,
+# 'spawn' starts each from scratch and 'fork' copies the main process. Worker startup over startup_target
+# seconds is reported, as it dominates short optimizations
+start_method = 'forkserver'
+startup_target = 2.0
+# The optimizer state is saved here after every generation, and an interrupted run resumes from it. It is deleted
+# once the optimization finishes; delete it to start over. Steady-state mode is not checkpointed
+checkpoint_file = 'optimizer_checkpoint.pkl'
+optimizer_log_file = 'optimizer_log.csv'  # Statistics of every generation
+# Orders and trades of the best run: .csv or .parquet for best_run_orders and best_run_trades files, or a .db file
+events_file = 'best_run.csv'
+# Every completed evaluation on the whole data keeps its daily values, orders and trades in a ResultsStore in
+# results_dir, and the reports are written from it without running the backtests again, in a background process
+# with report_in_background
+store_results = True
+results_dir = 'results_store'
+results_store = None  # ResultsStore of the evaluations, None when store_results is off
+report_in_background = True
+metrics_file = 'best_metrics.csv'
+report_file = 'stats.html'  # QuantStats report of the best run
+pareto_file = 'pareto_front.csv'  # Metrics of the runs on the Pareto front of the final population
+
+# Parameters of an individual: (name, low, high, resolution). Values are clamped to the range and rounded
+# to the resolution before they are backtested, so configurations that only differ below it share a result
+param_space = (
+    ('Donchian_Period', 20, 50, 1),
+    ('order_factor', 0.01, 0.05, 0.0005),
+    ('ichimoku_trend_factor', 0.01, 0.05, 0.0005),
+    ('risk_per_trade', 0.001, 0.01, 0.0001),
+    ('stop_distance_factor', 0.01, 0.05, 0.0005),
+    ('take_profit_distance_factor', 0.01, 0.05, 0.0005),
+    ('take_profit_trigger_factor', 0.2, 0.7, 0.005),
+)
+# Largest difference on each parameter for which a cached result of a neighbouring configuration is reused
+cache_tolerance = (0, 0.0005, 0.0005, 0.0001, 0.0005, 0.0005, 0.005)
+
+# Define the fitness function: maximize returns and minimize drawdown. Workers import this module twice, as
+# main_program preloaded by the forkserver and as the __mp_main__ script, and both share deap.creator
+if not hasattr(creator, "FitnessMulti"):
+    creator.create("FitnessMulti", base.Fitness, weights=(1.0, -2.0))  # Maximize returns, minimize drawdown
+if not hasattr(creator, "Individual"):
+    creator.create("Individual", list, fitness=creator.FitnessMulti)
 
 toolbox = base.Toolbox()
 
@@ -123,90 +593,339 @@ toolbox.register("population", tools.initRepeat, list, toolbox.individual)
 toolbox.register("evaluate", evaluate)
 toolbox.register("mate", tools.cxBlend, alpha=0.5)
 toolbox.register("mutate", tools.mutGaussian, mu=0, sigma=0.1, indpb=0.2)
-toolbox.register("select", tools.selNSGA2)  # Multi-objective selection
-
-
-def main():
-    pop = toolbox.population(n_population)  # Population size
-    hof = tools.HallOfFame(1)  # Hall of Fame to keep track of best individual
-
-    # Evolve the population
-    algorithms.eaSimple(pop, toolbox, cxpb=0.7, mutpb=0.3, ngen=n_gen, halloffame=hof, verbose=True)
-
-    # Generate and save QuantStats report for the best result
-    best_params = hof[0]
-    cerebro = create_data()
-
-    cerebro.addstrategy(MyStrategy,
-                        total_candles=total_candles,
-                        Donchian_Period=best_params[0],
-                        order_factor=best_params[1],
-                        ichimoku_trend_factor=best_params[2],
-                        risk_per_trade=best_params[3],
-                        stop_distance_factor=best_params[4],
-                        take_profit_distance_factor=best_params[5],
-                        take_profit_trigger_factor=best_params[6])
-
-    result = cerebro.run()
-
-    trade_analyzer = result[0].analyzers.trade_analyzer.get_analysis()
-    drawdown = result[0].analyzers.drawdown.get_analysis().max.drawdown
-
-    # Access and print metrics from custom analyzers
-    portfolio_stats = result[0].analyzers.getbyname('PyFolio')
-    ret, positions, transactions, gross_lev = portfolio_stats.get_pf_items()
-    ret.index = ret.index.tz_convert(None)
-
-    total_trades = trade_analyzer.total.total or 0
-    won_trades = trade_analyzer.won.total or 0
-    lost_trades = trade_analyzer.lost.total or 0
-    net_profit = trade_analyzer.pnl.net.total or 0
-    win_rate = (won_trades / total_trades * 100) if total_trades > 0 else 0
-    max_win = trade_analyzer.won.pnl.max or 0
-    avg_win = trade_analyzer.won.pnl.average or 0
-    max_loss = trade_analyzer.lost.pnl.max or 0
-    avg_loss = trade_analyzer.lost.pnl.average or 0
-    avg_duration = trade_analyzer.len.average or 0
-
-    print('---Best run---')
-    print(f"Net Profit: {net_profit:.2f} / Net Profit Percentage: {(net_profit / starting_capital * 100):.2f}%")
+toolbox.register("select", select_survivors)  # Multi-objective selection
+
+
+def save_checkpoint(file_name, state):
+    """Pickles the optimizer state through a temporary file, so an interruption never leaves a partial checkpoint"""
+    with open(file_name + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def write_log(logbook, file_name):
+    """Writes the statistics of every generation of the logbook as a CSV file"""
+    rows = []
+    for entry, *chapters in zip(logbook, *(logbook.chapters[name] for name in ('returns', 'drawdown'))):
+        row = {'gen': entry['gen'], 'nevals': entry['nevals']}
+        for name, chapter in zip(('returns', 'drawdown'), chapters):
+            row.update({f'{name}_{stat}': chapter[stat] for stat in ('avg', 'min', 'max')})
+        rows.append(row)
+    pd.DataFrame(rows).to_csv(file_name + '.tmp', index=False)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def fitness_statistics():
+    """:return: MultiStatistics of the returns and drawdown of a population"""
+    stats = tools.MultiStatistics(returns=tools.Statistics(lambda ind: ind.fitness.values[0]),
+                                  drawdown=tools.Statistics(lambda ind: ind.fitness.values[1]))
+    stats.register("avg", np.mean)
+    stats.register("min", np.min)
+    stats.register("max", np.max)
+    return stats
+
+
+def timed_evaluate(evaluate_func, individual):
+    """:return: (fitness, seconds the evaluation took in the worker)"""
+    start = time.perf_counter()
+    fitness = evaluate_func(individual)
+    return fitness, time.perf_counter() - start
+
+
+def optimize_steady_state(population_size, n_evaluations, pool, processes=None, cxpb=0.7, mutpb=0.3):
+    """
+    Asynchronous steady-state evolution. Evaluations are submitted to the pool one by one and, as each
+    returns, its individual joins the population, toolbox.select (NSGA-II) keeps the best population_size,
+    and one new offspring bred from them is submitted. Workers never wait for a whole generation: there is
+    always an evaluation submitted for every worker. The run starts with population_size random individuals,
+    and the workers they leave idle get offspring of them. Offspring are evaluated on the whole data.
+
+    :return: (population, hall of fame, logbook), with a logbook record every population_size evaluations
+    """
+    processes = processes or os.cpu_count()
+    stats = fitness_statistics()
+    hof = tools.HallOfFame(1)
+    logbook = tools.Logbook()
+    logbook.header = ['evals'] + stats.fields
+    for name in stats.fields:
+        logbook.chapters[name].header = 'avg', 'min', 'max'
+
+    done = queue.Queue()  # (individual, (fitness, seconds) or exception), filled by the pool's result thread
+
+    def submit(individual):
+        pool.apply_async(timed_evaluate, (toolbox.evaluate, individual),
+                         callback=lambda result: done.put((individual, result)),
+                         error_callback=lambda error: done.put((individual, error)))
+
+    def breed(candidates):
+        parents = [toolbox.clone(ind) for ind in random.sample(candidates, 2)]
+        if random.random() < cxpb:
+            toolbox.mate(*parents)
+        if random.random() < mutpb:
+            toolbox.mutate(parents[0])
+        del parents[0].fitness.values
+        return parents[0]
+
+    population = []
+    seeds = toolbox.population(min(n_evaluations, population_size))
+    offspring = [breed(seeds) if len(seeds) >= 2 else toolbox.individual()
+                 for _ in range(min(n_evaluations, processes) - len(seeds))]
+    for individual in seeds + offspring:
+        submit(individual)
+    submitted = len(seeds) + len(offspring)
+
+    busy = 0.0
+    start_time = collected = time.time()
+    for evaluations in range(1, n_evaluations + 1):
+        individual, result = done.get()
+        if isinstance(result, BaseException):
+            raise result
+        individual.fitness.values, seconds = result
+        busy += seconds
+
+        hof.update([individual])
+        population = toolbox.select(population + [individual], population_size)
+        if submitted < n_evaluations:
+            submit(breed(population) if len(population) >= 2 else toolbox.individual())
+            submitted += 1
+
+        if evaluations % population_size == 0 or evaluations == n_evaluations:
+            logbook.record(evals=evaluations, **stats.compile(population))
+            print(logbook.stream)
+            if evaluation_profiler is not None:
+                now = time.time()
+                evaluation_profiler.collect(math.ceil(evaluations / population_size), now - collected, processes)
+                collected = now
+
+    elapsed = time.time() - start_time
+    print(f"Worker utilization: {busy / (elapsed * processes):.0%} of {processes} workers over {elapsed:.2f} seconds")
+    return population, hof, logbook
+
+
+def optimize(population_size, ngen, cxpb=0.7, mutpb=0.3, checkpoint=None, log_file=None):
+    """
+    The generational loop of algorithms.eaSimple, checkpointed. After every generation the population, hall of
+    fame, logbook and random state are saved to `checkpoint`, and when it exists the optimization resumes from
+    it with the same generations it would have run uninterrupted. The checkpoint is deleted once the last
+    generation is done. The statistics of every generation are printed and written to log_file.
+
+    :return: (population, hall of fame, logbook)
+    """
+    stats = fitness_statistics()
+    names = [name for name, _, _, _ in param_space]
+
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            state = pickle.load(f)
+        if state['params'] != names:
+            raise ValueError(f"{checkpoint} is an optimization of other parameters, delete it to start a new one")
+        population, hof, logbook, start_gen = state['population'], state['halloffame'], state['logbook'], state['gen']
+        random.setstate(state['random_state'])
+        # The cached results and equity floor of the pruning as they were when the checkpoint was taken
+        evaluation_cache.update(state['results'])
+        evaluation_cache.equity.update(state['equity'])
+        toolbox.register("evaluate", evaluate, **state['evaluate_keywords'])
+        print(f"Resuming from generation {start_gen} of {checkpoint}")
+        print(logbook.stream)
+    else:
+        population = toolbox.population(population_size)
+        hof = tools.HallOfFame(1)  # Hall of Fame to keep track of best individual
+        logbook = tools.Logbook()
+        logbook.header = ['gen', 'nevals'] + stats.fields
+        for name in stats.fields:
+            logbook.chapters[name].header = 'avg', 'min', 'max'
+        start_gen = 0
+
+    # Results of this optimization. Some are not in the database, like the ones on part of the data or pruned, and
+    # the writer may not have stored the last ones yet, so the checkpoint keeps them all
+    produced = dict(state['results']) if start_gen else {}
+    known = len(evaluation_cache.completed)
+
+    for gen in range(start_gen, ngen + 1):
+        gen_start = time.time()
+        if gen == 0:
+            offspring = population
+        else:
+            offspring = toolbox.select(population, len(population))
+            offspring = algorithms.varAnd(offspring, toolbox, cxpb, mutpb)
+
+        # Evaluate the individuals with an invalid fitness
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+        for ind, fit in zip(invalid_ind, fitnesses):
+            ind.fitness.values = fit
+        if evaluation_profiler is not None:
+            evaluation_profiler.collect(gen, time.time() - gen_start, pool_processes or os.cpu_count())
+
+        hof.update(offspring)
+        population[:] = offspring
+        logbook.record(gen=gen, nevals=len(invalid_ind), **stats.compile(population))
+        print(logbook.stream)
+
+        if checkpoint:
+            # Only the results stored since the last generation are fetched from the manager
+            items = evaluation_cache.completed[known:]
+            known += len(items)
+            produced.update(items)
+
+            keys = {quantize_params(ind, param_space) for ind in population}
+            equity = {key: evaluation_cache.checkpoints(key) for key in keys}
+            save_checkpoint(checkpoint, {
+                'params': names, 'gen': gen + 1, 'population': population, 'halloffame': hof, 'logbook': logbook,
+                'random_state': random.getstate(), 'results': produced,
+                'equity': {key: value for key, value in equity.items() if value is not None},
+                'evaluate_keywords': getattr(toolbox.evaluate, 'keywords', {}),
+            })
+        if log_file:
+            write_log(logbook, log_file)
+
+    if checkpoint and os.path.exists(checkpoint):
+        # Finished, so the next run starts a new optimization instead of resuming this one
+        os.remove(checkpoint)
+    return population, hof, logbook
+
+
+def main(pool=None):
+    """
+    Optimizes on the whole data and writes the reports of the result.
+
+    :return: the process writing the report of the best run, None if it was written already
+    """
+    if optimization_mode == 'steady_state':
+        # The same number of evaluations as the generational loop, without waiting between generations
+        pop, hof, logbook = optimize_steady_state(n_population, n_population * (n_gen + 1), pool,
+                                                  processes=pool_processes)
+    else:
+        # Evolve the population, resuming from the checkpoint of an interrupted run
+        pop, hof, logbook = optimize(n_population, n_gen, cxpb=0.7, mutpb=0.3, checkpoint=checkpoint_file,
+                                     log_file=optimizer_log_file)
+
+    # The reports of the best result and the Pareto front are written from the stored runs
+    store = results_store or ResultsStore(results_dir, dataset_hash(market_data), starting_capital, commission)
+    best_params = strategy_params_of(quantize_params(hof[0], param_space))  # The parameters it was evaluated with
+    best = store.get(best_params)
+    if best is None:
+        # Only the run of a configuration served from the cache of a close one, or with store_results off, is
+        # missing from the store, and the report needs the run itself
+        result = run_backtest(market_data, starting_capital=starting_capital, commission=commission,
+                              total_candles=total_candles, daily=True, **best_params)
+        store.put(best_params, result.final_value, result.max_drawdown, result.daily,
+                  *backtest_events(result, market_data.index), engine='vector')
+        best = store.get(best_params)
+
+    front = tools.sortNondominated(pop, len(pop), first_front_only=True)[0]
+    stored = [store.get(strategy_params_of(quantize_params(ind, param_space))) for ind in front]
+    write_pareto([entry for entry in stored if entry is not None], pareto_file)
+    print(f"Pareto front of {len(front)} individuals written to {pareto_file}, "
+          f"{sum(entry is None for entry in stored)} of them were not stored")
+
+    if not report_in_background:
+        write_report(best, metrics_file, events_file, report_file)
+        return None
+    report = worker_context().Process(target=write_report, args=(best, metrics_file, events_file, report_file))
+    report.start()
+    return report
+
+
+def walk_forward_windows(bars, train_bars, test_bars):
+    """
+    Rolling walk-forward split: every window trains on train_bars 1-minute bars and is tested on the
+    test_bars that follow, then the windows move forward by test_bars so that the test ranges are
+    contiguous. The last test range is shorter if the bars run out.
+
+    :return: list of (train start, test start, test end) bar indices
+    """
+    return [(start, start + train_bars, min(start + train_bars + test_bars, bars))
+            for start in range(0, bars - train_bars, test_bars)]
+
+
+def evaluate_window(window, results, individual):
+    """Fitness of an individual on a training window. Results are only reused within the window."""
+    params = quantize_params(individual, param_space)
+    if params not in results:
+        returns, drawdown = backtest_window(window, window.end, strategy_params_of(params))
+        results[params] = (returns, -drawdown)
+    return results[params]
+
+
+def optimize_window(bounds):
+    """
+    Runs the genetic optimization on the training range of a walk-forward window and backtests the best
+    individual on its test range. Windows run in parallel, so the evaluations of a window are serial.
+
+    :return: dict with the window dates, the best parameters, their in-sample and out-of-sample
+        returns and drawdowns, and the out-of-sample equity curve
+    """
+    train_start, test_start, test_end = bounds
+    random.seed(train_start)  # Every window gets its own reproducible population
+
+    train = market_data.window(train_start, test_start)
+    window_toolbox = base.Toolbox()
+    for name in ('individual', 'population', 'mate', 'mutate'):
+        window_toolbox.register(name, getattr(toolbox, name))
+    window_toolbox.register("select", tools.selNSGA2)
+    window_toolbox.register("evaluate", evaluate_window, train, {})
+
+    pop = window_toolbox.population(n_population)
+    hof = tools.HallOfFame(1)
+    algorithms.eaSimple(pop, window_toolbox, cxpb=0.7, mutpb=0.3, ngen=n_gen, halloffame=hof, verbose=False)
+
+    params = quantize_params(hof[0], param_space)
+    in_sample_returns, in_sample_drawdown = hof[0].fitness.values
+    test = run_backtest(market_data.window(test_start, test_end), starting_capital=starting_capital,
+                        commission=commission, total_candles=test_end, equity=True, **strategy_params_of(params))
+    index = market_data.index
+    print(f"Window {index[train_start]} - {index[test_end - 1]}: in-sample ${in_sample_returns:.2f}, "
+          f"out-of-sample ${test.final_value - starting_capital:.2f}")
+    return {
+        'train_start': index[train_start], 'test_start': index[test_start], 'test_end': index[test_end - 1],
+        'params': params,
+        'in_sample_returns': in_sample_returns, 'in_sample_drawdown': in_sample_drawdown,
+        'out_of_sample_returns': test.final_value - starting_capital, 'out_of_sample_drawdown': -test.max_drawdown,
+        'equity': test.equity,
+    }
+
+
+def stitch_equity(curves):
+    """
+    Chains the out-of-sample equity curves of consecutive windows, each starting from the capital the
+    previous one ended with, as if the capital was traded through all of them.
+
+    :return: Series of the stitched broker value
+    """
+    capital = starting_capital
+    stitched = []
+    for curve in curves:
+        curve = curve * (capital / starting_capital)
+        capital = curve.iloc[-1]
+        stitched.append(curve)
+    return pd.concat(stitched)
+
+
+def walk_forward(pool):
+    """
+    Walk-forward mode: optimizes every window of walk_forward_windows in parallel on the pool and
+    writes the windows to walk_forward_windows.csv and the stitched out-of-sample equity curve to
+    walk_forward_equity.csv. Runs on the vector engine, whatever backtest_engine is.
+    """
+    train_bars, test_bars = int(total_candles * wf_train_fraction), int(total_candles * wf_test_fraction)
+    windows = walk_forward_windows(total_candles, train_bars, test_bars) if test_bars > 0 else []
+    if not windows:
+        raise ValueError(f"No walk-forward window of {train_bars} training and {test_bars} test bars fits in the "
+                         f"{total_candles} bars of the data: wf_train_fraction must be below 1 and "
+                         f"wf_test_fraction above 0")
+    results = pool.map(optimize_window, windows, chunksize=1)
+
+    equity = stitch_equity([result.pop('equity') for result in results])
+    equity.to_csv('walk_forward_equity.csv')
+    pd.DataFrame(results).to_csv('walk_forward_windows.csv', index=False)
+
+    drawdown = (1 - equity / equity.cummax()).max() * 100
+    print('---Walk-forward out-of-sample---')
+    print(f"Windows: {len(windows)}")
+    print(f"Net Profit: {equity.iloc[-1] - starting_capital:.2f} / "
+          f"Net Profit Percentage: {(equity.iloc[-1] / starting_capital - 1) * 100:.2f}%")
     print(f"Drawdown: {-drawdown:.2f}")
-    print(f"Total Won: {won_trades} / Total Lost: {lost_trades}")
-    print(f"Win Rate: {win_rate:.2f}%")
-    print(f"Max Win Amount: {max_win:.2f} / Average Win Amount: {avg_win:.2f}")
-    print(f"Max Loss Amount: {max_loss:.2f} / Average Loss Amount: {avg_loss:.2f}")
-    print(
-        f"Average Trade Duration Bars: {avg_duration:.2f} - {avg_duration / 60:.2f} Hours - {avg_duration / 3600:.2f} Days")
-
-    # Save metrics to CSV
-    with open('best_metrics.csv', mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Parameter', 'Value'])
-        writer.writerow(['Donchian_Period', best_params[0]])
-        writer.writerow(['order_factor', best_params[1]])
-        writer.writerow(['ichimoku_trend_factor', best_params[2]])
-        writer.writerow(['risk_per_trade', best_params[3]])
-        writer.writerow(['stop_distance_factor', best_params[4]])
-        writer.writerow(['take_profit_distance_factor', best_params[5]])
-        writer.writerow(['take_profit_trigger_factor', best_params[6]])
-        writer.writerow(['Total Trades', total_trades])
-        writer.writerow(['Won Trades', won_trades])
-        writer.writerow(['Lost Trades', lost_trades])
-        writer.writerow(['Net Profit', net_profit])
-        writer.writerow(['Net Profit Percentage', f"{(net_profit / starting_capital * 100):.2f}%"])
-        writer.writerow(['Drawdown', f"{(-drawdown)}%"])
-        writer.writerow(['Win Rate', f"{win_rate:.2f}%"])
-        writer.writerow(['Max Win Amount', max_win])
-        writer.writerow(['Average Win Amount', avg_win])
-        writer.writerow(['Max Loss Amount', max_loss])
-        writer.writerow(['Average Loss Amount', avg_loss])
-        writer.writerow(['Average Trade Duration (Minutes)', avg_duration])
-        writer.writerow(['Average Trade Duration (Hours)', avg_duration / 60])
-        writer.writerow(['Average Trade Duration (Days)', avg_duration / 3600])
-
-    if total_trades > 0:
-        quantstats.reports.html(ret, output='stats.html', title='Backtest results')
-        # cerebro.plot()
 
 
 if __name__ == "__main__":
@@ -214,14 +933,39 @@ if __name__ == "__main__":
         multiprocessing.freeze_support()  # Required on Windows
     start_time = time.time()  # Start tracking time
 
-    # Use multiprocessing pool for parallel evaluations
-    pool = multiprocessing.Pool()
-    toolbox.register("map", pool.map)
-
-    main()
+    setup_database()
+    load_market_data()
+
+    # Use multiprocessing pool for parallel evaluations, with the market data in shared memory
+    context = worker_context()
+    shared_market_data, market_data_handle = market_data.share()
+    evaluation_cache = EvaluationCache.start(context=context)
+    if profile_evaluations:
+        evaluation_profiler = EvaluationProfiler.start(profile_every=profile_every)
+    if store_results:
+        results_store = ResultsStore(results_dir, dataset_hash(market_data), starting_capital, commission)
+    pool, startup_time = start_pool(pool_processes, market_data_handle, evaluation_cache, evaluation_profiler,
+                                    context, results_store)
+    print(f"Started the workers in {startup_time:.2f} seconds"
+          + (f", more than the {startup_target} seconds target" if startup_time > startup_target else ''))
+    toolbox.register("map", surrogate_map,
+                     functools.partial(multi_fidelity_map, functools.partial(batched_map, pool.map)))
+
+    report = None
+    if optimization_mode == 'walk_forward':
+        walk_forward(pool)
+    else:
+        report = main(pool)
 
     pool.close()
     pool.join()
+    shared_market_data.close()
+    shared_market_data.unlink()
+    evaluation_cache.close()
+    if evaluation_profiler is not None:
+        evaluation_profiler.close()
+    if report is not None:
+        report.join()
 
     end_time = time.time()  # End time after process finishes
     total_runs = n_population * n_gen  # Calculate total runs based on population and generations
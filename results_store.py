@@ -0,0 +1,296 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from events import COMPLETED, export_events, trade_summary
+from support import RESULTS_VERSION, MetricsAnalyzer, period_returns, return_ratios
+
+# Executions and closed trades as the store keeps them, the same for both engines. Datetimes are integer
+# microseconds since the Unix epoch
+ORDER_DTYPE = np.dtype([('datetime', 'i8'), ('size', 'f8'), ('price', 'f8'), ('commission', 'f8')])
+TRADE_DTYPE = np.dtype([('open_datetime', 'i8'), ('close_datetime', 'i8'), ('pnl', 'f8'), ('pnlcomm', 'f8'),
+                        ('commission', 'f8'), ('bars', 'i8')])
+
+# Periods per year of the daily returns, for the ratios
+DAILY_FACTOR = MetricsAnalyzer.RATEFACTORS[MetricsAnalyzer.params.timeframe]
+
+
+def dataset_hash(market):
+    """:return: sha256 of the 1-minute bars of a MarketData"""
+    digest = hashlib.sha256()
+    for column in (market.times, market.open, market.high, market.low, market.close, market.volume):
+        digest.update(np.ascontiguousarray(column).tobytes())
+    return digest.hexdigest()
+
+
+def backtest_events(result, index):
+    """
+    :param result: vector_engine BacktestResult
+    :param index: DatetimeIndex of the 1-minute bars it ran on, for the bars every trade was open
+    :return: (orders, trades) arrays of ORDER_DTYPE and TRADE_DTYPE
+    """
+    orders = np.array([(dt.value // 1000, size, price, comm) for dt, size, price, comm in result.orders],
+                      dtype=ORDER_DTYPE)
+    trades = np.array([(opened.value // 1000, closed.value // 1000, pnl, pnlcomm, pnl - pnlcomm,
+                        index.get_loc(closed) - index.get_loc(opened))
+                       for opened, closed, pnl, pnlcomm in result.trades], dtype=TRADE_DTYPE)
+    return orders, trades
+
+
+def recorder_events(recorder):
+    """:return: (orders, trades) arrays of ORDER_DTYPE and TRADE_DTYPE of the completed orders and closed trades of an EventRecorder"""
+    orders = recorder.orders[:recorder.order_count]
+    orders = orders[orders['status'] == COMPLETED]
+    trades = recorder.trades[:recorder.trade_count]
+    return ([np.array([tuple(row[name] for name in dtype.names) for row in events], dtype=dtype)
+             for events, dtype in ((orders, ORDER_DTYPE), (trades, TRADE_DTYPE))])
+
+
+class StoredResult:
+    """A run read from a ResultsStore: its parameters, metrics, daily values, executions and trades"""
+
+    def __init__(self, key, meta, daily, orders, trades):
+        self.key = key
+        self.meta = meta
+        self.params = meta['params']
+        self.metrics = meta['metrics']
+        self.daily = daily
+        self.orders = orders
+        self.trades = trades
+
+    def returns(self):
+        """:return: Series of the daily returns, as MetricsAnalyzer.returns"""
+        return period_returns(self.daily, self.metrics['start_value'])
+
+    def order_frame(self):
+        df = pd.DataFrame(self.orders)
+        df['datetime'] = pd.to_datetime(df['datetime'], unit='us')
+        return df
+
+    def trade_frame(self):
+        df = pd.DataFrame(self.trades)
+        for column in ('open_datetime', 'close_datetime'):
+            df[column] = pd.to_datetime(df[column], unit='us')
+        return df
+
+
+class ResultsStore:
+    """
+    Results of completed evaluations: the value at the end of every day, the executions and the closed trades,
+    with the metrics of the report computed from them. Every result is a compressed .npz file named after the
+    sha256 of what determines it, the version of the strategy and engines (support.RESULTS_VERSION), the dataset
+    hash, the parameters, the starting capital and the commission, so it is written once whoever evaluates it,
+    and the reports read it instead of running the backtest again. Both engines give the same results, so they
+    share the runs; a change to either bumps RESULTS_VERSION, which leaves the runs of the other versions out.
+    Files are written to a temporary name and renamed, so workers can share the store.
+    """
+
+    def __init__(self, directory='results_store', dataset='', starting_capital=10000, commission=0.00035):
+        self.directory = directory
+        self.dataset = dataset
+        self.starting_capital = starting_capital
+        self.commission = commission
+
+    def key(self, params):
+        """:param params: dict of the effective (quantized) MyStrategy parameters"""
+        content = json.dumps([RESULTS_VERSION, self.dataset, list(params.items()), self.starting_capital,
+                              self.commission])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def __contains__(self, params):
+        return os.path.exists(self.path(self.key(params)))
+
+    def put(self, params, final_value, max_drawdown, daily, orders, trades, **info):
+        """
+        Stores a completed run, unless it is stored already.
+
+        :param daily: Series of the value at the end of every day
+        :param orders: ORDER_DTYPE array of the executions
+        :param trades: TRADE_DTYPE array of the closed trades
+        :param info: anything else worth keeping in the metadata, like the engine
+        :return: the key
+        """
+        key = self.key(params)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+
+        returns = period_returns(daily, self.starting_capital).to_numpy()
+        metrics = {'start_value': self.starting_capital, 'final_value': final_value,
+                   'total_return': (final_value / self.starting_capital - 1) * 100, 'max_drawdown': max_drawdown,
+                   **return_ratios(returns, self.starting_capital, final_value, max_drawdown, factor=DAILY_FACTOR),
+                   'trades': trade_summary(trades)}
+        meta = {'params': params, 'version': RESULTS_VERSION, 'dataset': self.dataset,
+                'starting_capital': self.starting_capital,
+                'commission': self.commission, 'metrics': metrics, 'created': time.time(), **info}
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(meta)),
+                                days=daily.index.values.astype('datetime64[us]').astype(np.int64),
+                                values=daily.to_numpy(dtype=float), orders=orders, trades=trades)
+        os.replace(temporary, path)
+        return key
+
+    def get(self, params):
+        """:return: StoredResult of params, or None if they have not been stored"""
+        return self.load(self.key(params))
+
+    def load(self, key, meta_only=False):
+        """:return: StoredResult of a key, only with its metadata if meta_only, or None if it is not stored"""
+        try:
+            with np.load(self.path(key)) as npz:
+                meta = json.loads(str(npz['meta']))
+                if meta_only:
+                    return StoredResult(key, meta, None, None, None)
+                daily = pd.Series(npz['values'], index=pd.to_datetime(npz['days'], unit='us'), name='value')
+                return StoredResult(key, meta, daily, npz['orders'], npz['trades'])
+        except FileNotFoundError:
+            return None
+
+    def keys(self):
+        return [os.path.basename(path)[:-4] for path in glob.glob(os.path.join(self.directory, '*', '*.npz'))]
+
+    def metadata(self):
+        """:return: DataFrame of the parameters and metrics of every stored result of this version and dataset, by key"""
+        rows = {}
+        for key in self.keys():
+            meta = self.load(key, meta_only=True).meta
+            if meta.get('version') == RESULTS_VERSION and (meta['dataset'] == self.dataset or not self.dataset):
+                metrics = dict(meta['metrics'])
+                trades = metrics.pop('trades')
+                rows[key] = {**meta['params'], **metrics, **{f'trades_{name}': value for name, value in trades.items()}}
+        return pd.DataFrame.from_dict(rows, orient='index')
+
+
+def pareto_front(df, objectives=(('total_return', 1), ('max_drawdown', -1))):
+    """:return: the rows of df that no other row beats on every objective, (column, 1 to maximize or -1 to minimize)"""
+    values = np.column_stack([df[column].to_numpy(dtype=float) * sign for column, sign in objectives])
+    dominated = np.array([((values >= row).all(axis=1) & (values > row).any(axis=1)).any() for row in values],
+                         dtype=bool)
+    return df[~dominated]
+
+
+def write_report(result, metrics_file='best_metrics.csv', events_file='best_run.csv', html_file='stats.html'):
+    """
+    Prints the report of a StoredResult and writes its metrics, executions, trades and the QuantStats report,
+    all from the store.
+    """
+    metrics, trades = result.metrics, result.metrics['trades']
+    starting_capital = metrics['start_value']
+    drawdown = metrics['max_drawdown']
+    total_trades = trades['total']
+    won_trades = trades['won']
+    lost_trades = trades['lost']
+    net_profit = trades['net_profit']
+    win_rate = (won_trades / total_trades * 100) if total_trades > 0 else 0
+    avg_duration = trades['average_bars']
+
+    if events_file:
+        files = export_events({'orders': result.order_frame(), 'trades': result.trade_frame()}, events_file)
+        print(f"Orders and trades of the best run written to {', '.join(files)}")
+
+    print('---Best run---')
+    print(f"Net Profit: {net_profit:.2f} / Net Profit Percentage: {(net_profit / starting_capital * 100):.2f}%")
+    print(f"Drawdown: {-drawdown:.2f}")
+    print(f"Total Won: {won_trades} / Total Lost: {lost_trades}")
+    print(f"Win Rate: {win_rate:.2f}%")
+    print(f"Max Win Amount: {trades['max_win']:.2f} / Average Win Amount: {trades['average_win']:.2f}")
+    print(f"Max Loss Amount: {trades['max_loss']:.2f} / Average Loss Amount: {trades['average_loss']:.2f}")
+    print(
+        f"Average Trade Duration Bars: {avg_duration:.2f} - {avg_duration / 60:.2f} Hours - {avg_duration / 3600:.2f} Days")
+    print(f"Sortino Ratio: {metrics['sortino']} / Sharpe Ratio: {metrics['sharpe']} / Calmar Ratio: {metrics['calmar']}")
+    print(f"Total Commission: {trades['commission']:.2f}")
+
+    # Save metrics to CSV
+    with open(metrics_file, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Parameter', 'Value'])
+        for name, value in result.params.items():
+            writer.writerow([name, value])
+        writer.writerow(['Total Trades', total_trades])
+        writer.writerow(['Won Trades', won_trades])
+        writer.writerow(['Lost Trades', lost_trades])
+        writer.writerow(['Net Profit', net_profit])
+        writer.writerow(['Net Profit Percentage', f"{(net_profit / starting_capital * 100):.2f}%"])
+        writer.writerow(['Drawdown', f"{(-drawdown)}%"])
+        writer.writerow(['Win Rate', f"{win_rate:.2f}%"])
+        writer.writerow(['Max Win Amount', trades['max_win']])
+        writer.writerow(['Average Win Amount', trades['average_win']])
+        writer.writerow(['Max Loss Amount', trades['max_loss']])
+        writer.writerow(['Average Loss Amount', trades['average_loss']])
+        writer.writerow(['Average Trade Duration (Minutes)', avg_duration])
+        writer.writerow(['Average Trade Duration (Hours)', avg_duration / 60])
+        writer.writerow(['Average Trade Duration (Days)', avg_duration / 3600])
+        writer.writerow(['Sortino Ratio', metrics['sortino']])
+        writer.writerow(['Sharpe Ratio', metrics['sharpe']])
+        writer.writerow(['Calmar Ratio', metrics['calmar']])
+        writer.writerow(['Total Commission', trades['commission']])
+
+    if total_trades > 0 and html_file:
+        import quantstats  # Only the report needs it, so neither do the workers nor the forkserver
+        quantstats.reports.html(result.returns(), output=html_file, title='Backtest results')
+
+
+def write_pareto(results, file_name='pareto_front.csv'):
+    """Writes the parameters and metrics of StoredResults side by side, the best returns first. :return: the DataFrame"""
+    rows = {}
+    for result in results:
+        metrics = dict(result.metrics)
+        trades = metrics.pop('trades')
+        rows[result.key] = {**result.params, **metrics, 'trades': trades['total'], 'won': trades['won'],
+                            'net_profit': trades['net_profit']}
+    df = pd.DataFrame.from_dict(rows, orient='index').rename_axis('key')
+    if len(df):
+        df = df.sort_values('total_return', ascending=False)
+    df.to_csv(file_name)
+    return df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Reports on the runs kept in a results store, without running any backtest')
+    parser.add_argument('--store', default='results_store', help='Directory of the store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('list', help='Print the metrics of every stored run, the best returns first')
+    pareto = subparsers.add_parser('pareto', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                   help='Write the runs on the returns / drawdown Pareto front')
+    pareto.add_argument('--output', default='pareto_front.csv')
+    report = subparsers.add_parser('report', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                   help='Write the report of a stored run')
+    report.add_argument('key', help='Key of the run, as printed by list')
+    report.add_argument('--metrics', default='best_metrics.csv')
+    report.add_argument('--events', default='best_run.csv')
+    report.add_argument('--html', default='stats.html')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = ResultsStore(args.store)
+    if args.command == 'report':
+        result = store.load(args.key)
+        if result is None:
+            raise SystemExit(f"No run {args.key} in {args.store}")
+        write_report(result, args.metrics, args.events, args.html)
+    else:
+        df = store.metadata()
+        if args.command == 'pareto' and len(df):
+            write_pareto([store.load(key) for key in pareto_front(df).index], args.output)
+            print(f"Pareto front written to {args.output}")
+        elif len(df):
+            print(df.sort_values('total_return', ascending=False).to_string())
@@ -5,12 +5,22 @@ from backtrader.mathsupport import average, standarddev
 from backtrader.analyzers import TimeReturn, AnnualReturn
 import backtrader as bt
 import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
 import os
+import time
+import numpy as np
 import pandas as pd
-import requests
 from io import StringIO
+from queue import Empty
 import sqlite3
-from key import api_key
+from array import array
+from collections import deque
+
+from events import won_trades
+from indicator_store import rolling_max, rolling_min
 
 
 class DonchianChannels(Indicator):
@@ -40,14 +50,90 @@ class DonchianChannels(Indicator):
     )
 
     def __init__(self):
-        hi, lo = self.data.high, self.data.low
-        if self.p.lookback:  # move backwards as needed
-            hi, lo = hi(self.p.lookback), lo(self.p.lookback)
+        self.delay = -self.p.lookback  # bars between the newest bar of the window and the current one
+        self.addminperiod(self.p.period + self.delay)
+
+        # Indexes of the window bars in decreasing high / increasing low order, so the extremes are at the front
+        self.highs = deque()
+        self.lows = deque()
+        self.newest = -1
+
+    def prenext(self):
+        self._add_bar()
+
+    def next(self):
+        self._add_bar()
+        dch, dcl = self.highs[0][1], self.lows[0][1]
+        self.l.dch[0] = dch
+        self.l.dcl[0] = dcl
+        self.l.dcm[0] = (dch + dcl) / 2.0  # avg of the above
+
+    def _add_bar(self):
+        """Moves the window one bar forward, amortized O(1)"""
+        newest = len(self.data) - 1 - self.delay
+        if newest <= self.newest:
+            return  # No new bar, the indicator runs on every cycle of a faster feed too
+        self.newest = newest
+        high = self.data.high[-self.delay]
+        low = self.data.low[-self.delay]
+        while self.highs and self.highs[-1][1] <= high:
+            self.highs.pop()
+        self.highs.append((newest, high))
+        while self.lows and self.lows[-1][1] >= low:
+            self.lows.pop()
+        self.lows.append((newest, low))
+
+        oldest = newest - self.p.period + 1
+        while self.highs[0][0] < oldest:
+            self.highs.popleft()
+        while self.lows[0][0] < oldest:
+            self.lows.popleft()
+
+    def once(self, start, end):
+        highs = np.asarray(self.data.high.array[:end])
+        lows = np.asarray(self.data.low.array[:end])
+        dch = rolling_max(highs, self.p.period, self.delay)
+        dcl = rolling_min(lows, self.p.period, self.delay)
+        dcm = (dch + dcl) / 2.0
+
+        for line, values in ((self.l.dch, dch), (self.l.dcl, dcl), (self.l.dcm, dcm)):
+            line.array[start:end] = array('d', values[start:end].tobytes())
+
+
+class StoredLines(Indicator):
+    """
+    Serves lines precomputed in an IndicatorStore instead of calculating them bar by bar.
+    `values` holds one array per line, indexed by bar of the data the indicator is built on,
+    and `minperiod` is the minimum period of the indicator the values come from.
+    """
+
+    params = dict(
+        values=(),
+        minperiod=1,
+    )
+
+    def __init__(self):
+        self.addminperiod(self.p.minperiod)
+
+    def next(self):
+        i = len(self) - 1
+        for line, values in zip(self.lines, self.p.values):
+            line[0] = values[i]
+
+    def once(self, start, end):
+        for line, values in zip(self.lines, self.p.values):
+            array = line.array
+            for i in range(start, end):
+                array[i] = values[i]
+
+
+class StoredDonchianChannels(StoredLines):
+    lines = ('dch', 'dcl',)
+
+
+class StoredIchimoku(StoredLines):
+    lines = ('senkou_span_a', 'senkou_span_b',)
 
-        # noinspection PyArgumentList
-        self.l.dch = bt.ind.Highest(hi, period=self.p.period)
-        self.l.dcl = bt.ind.Lowest(lo, period=self.p.period)
-        self.l.dcm = (self.l.dch + self.l.dcl) / 2.0  # avg of the above
 
 class SortinoRatio(Analyzer):
 
@@ -157,6 +243,144 @@ class CommissionAnalyzer(Analyzer):
         return {'total_commission': sum(self.commissions),
                 'commissions': self.commissions}
 
+
+def period_returns(equity, start_value):
+    """:return: the returns of an equity Series of the value at the end of every period, the first one on start_value"""
+    return equity.pct_change().fillna(equity.iloc[0] / start_value - 1) if len(equity) else equity
+
+
+def return_ratios(returns, start_value, final_value, max_drawdown, riskfreerate=0.01, factor=None, convertrate=True,
+                  annualize=False, stddev_sample=False):
+    """
+    Sharpe and Sortino ratios of the period returns (as SortinoRatio and bt.analyzers.SharpeRatio compute them), and
+    the annual return and Calmar ratio of a run, with the parameters of MetricsAnalyzer.
+
+    :param factor: periods per year of the returns, None if unknown
+    :return: dict of sharpe, sortino, annual_return and calmar, None where they are undefined
+    """
+    rate = riskfreerate
+    if factor is not None:
+        if convertrate:
+            rate = pow(1.0 + rate, 1.0 / factor) - 1.0
+        else:
+            returns = np.power(1.0 + returns, factor) - 1.0
+    ddof = int(stddev_sample)
+    scale = math.sqrt(factor) if factor is not None and convertrate and annualize else 1.0
+    excess = returns - rate
+    downside = excess[excess < 0]
+
+    def ratio(deviation):
+        return float(excess.mean() / deviation * scale) if deviation else None
+
+    enough = len(returns) > ddof
+    ratios = {'sharpe': ratio(excess.std(ddof=ddof)) if enough else None,
+              'sortino': ratio(downside.std(ddof=ddof)) if enough and len(downside) > ddof else None}
+
+    # Calmar: annualized return over max drawdown, both in %
+    annual = None
+    if factor is not None and len(returns) and final_value > 0:
+        annual = ((final_value / start_value) ** (factor / len(returns)) - 1) * 100
+    ratios['annual_return'] = annual
+    ratios['calmar'] = annual / max_drawdown if annual is not None and max_drawdown else None
+    return ratios
+
+
+class MetricsAnalyzer(Analyzer):
+    """
+    Records the portfolio value of every cycle into a preallocated array and computes the metrics of
+    the run from it at stop(), vectorized: Sortino and Sharpe ratios of the timeframe returns (as
+    SortinoRatio and bt.analyzers.SharpeRatio do), max drawdown (as bt.analyzers.DrawDown), Calmar
+    ratio, win rate and commissions of the closed trades. Serves both the fitness and the report.
+    """
+
+    params = (
+        ('timeframe', TimeFrame.Days),
+        ('riskfreerate', 0.01),
+        ('factor', None),
+        ('convertrate', True),
+        ('annualize', False),
+        ('stddev_sample', False),
+    )
+
+    RATEFACTORS = SortinoRatio.RATEFACTORS
+    RESAMPLE_RULES = {
+        TimeFrame.Days: 'D',
+        TimeFrame.Weeks: 'W',
+        TimeFrame.Months: 'ME',
+        TimeFrame.Years: 'YE',
+    }
+
+    def start(self):
+        # The data is preloaded before the strategy starts, so its length is the number of cycles
+        size = max(self.data.buflen(), 1)
+        self.values = np.empty(size)
+        self.datetimes = np.empty(size)
+        self.count = 0
+        self.start_value = self._value = self.strategy.broker.getvalue()
+        self.pnls = array('d')  # Net profit of every closed trade
+        self.commissions = array('d')
+
+    def notify_fund(self, cash, value, fundvalue, shares):
+        self._value = value
+
+    def notify_trade(self, trade):
+        if trade.isclosed:
+            self.pnls.append(trade.pnlcomm)
+            self.commissions.append(trade.commission)
+
+    def next(self):
+        if self.count == len(self.values):
+            # Live data grows during the run
+            self.values = np.concatenate([self.values, np.empty_like(self.values)])
+            self.datetimes = np.concatenate([self.datetimes, np.empty_like(self.datetimes)])
+        self.values[self.count] = self._value
+        self.datetimes[self.count] = self.data.datetime[0]
+        self.count += 1
+
+    def equity(self):
+        """:return: Series of the portfolio value of every cycle, indexed by its datetime"""
+        # Backtrader datetimes are days since 0001-01-01, the Unix epoch is day 719163
+        microseconds = np.round((self.datetimes[:self.count] - 719163.0) * 86400e6).astype('int64')
+        return pd.Series(self.values[:self.count], index=pd.to_datetime(microseconds, unit='us'))
+
+    def period_equity(self):
+        """:return: Series of the portfolio value at the end of every timeframe period"""
+        equity = self.equity()
+        rule = self.RESAMPLE_RULES.get(self.p.timeframe)
+        if rule is not None:
+            equity = equity.resample(rule).last().dropna()
+        return equity
+
+    def returns(self):
+        """:return: Series of the returns of every timeframe period, the first one on the starting value"""
+        return period_returns(self.period_equity(), self.start_value)
+
+    def stop(self):
+        values = self.values[:self.count]
+        self.rets['start_value'] = self.start_value
+        self.rets['final_value'] = final_value = float(values[-1]) if len(values) else self.start_value
+        self.rets['total_return'] = (final_value / self.start_value - 1) * 100
+
+        # Drawdown of every cycle from the highest value before it, in % and in money
+        peaks = np.maximum.accumulate(values) if len(values) else values
+        moneydown = peaks - values
+        self.rets['max_drawdown'] = float((moneydown / peaks).max() * 100) if len(values) else 0.0
+        self.rets['max_moneydown'] = float(moneydown.max()) if len(values) else 0.0
+
+        factor = self.p.factor or self.RATEFACTORS.get(self.p.timeframe)
+        self.rets.update(return_ratios(self.returns().to_numpy(), self.start_value, final_value,
+                                       self.rets['max_drawdown'], self.p.riskfreerate, factor, self.p.convertrate,
+                                       self.p.annualize, self.p.stddev_sample))
+
+        pnls = np.frombuffer(self.pnls) if self.pnls else np.empty(0)
+        self.rets['trades'] = len(pnls)
+        self.rets['won'] = int(won_trades(pnls).sum())
+        self.rets['lost'] = len(pnls) - self.rets['won']
+        self.rets['win_rate'] = self.rets['won'] / len(pnls) * 100 if len(pnls) else 0.0
+        self.rets['net_profit'] = float(pnls.sum())
+        self.rets['total_commission'] = float(np.frombuffer(self.commissions).sum()) if self.commissions else 0.0
+
+
 class FixedRiskSizer(Sizer):
     def _getsizing(self, comminfo, cash, data, isbuy):
         capital_at_risk = self.broker.getvalue() * self.strategy.risk_per_trade  # Assuming risk_per_trade is set in strategy
@@ -195,13 +419,92 @@ def parse_args():
 
     return parser.parse_args()
 
+DATA_COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+
+
+def data_cache_dir(file_name):
+    """Directory of the columnar cache of a CSV file, next to it (AMZN_data.csv -> AMZN_data_cache)"""
+    return os.path.splitext(file_name)[0] + '_cache'
+
+
+def file_hash(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_data_cache(file_name):
+    """
+    Parses the CSV file once and stores every column as a .npy file plus a meta.json with the
+    row count and the size, mtime and hash of the CSV it was built from.
+
+    :return: the metadata
+    """
+    df = pd.read_csv(file_name, index_col='Date', parse_dates=True)
+    cache_dir = data_cache_dir(file_name)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    np.save(os.path.join(cache_dir, 'Date.npy'), df.index.values.astype('datetime64[ns]'))
+    for column in DATA_COLUMNS:
+        np.save(os.path.join(cache_dir, f'{column}.npy'), df[column].to_numpy(dtype=float))
+
+    stat = os.stat(file_name)
+    meta = {'rows': len(df), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(file_name)}
+    # Written last, so an interrupted build is never taken for a valid cache
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def data_cache_meta(file_name):
+    """
+    Metadata of the columnar cache of a CSV file, building the cache if it is missing or stale.
+    The cache is valid while the size and mtime of the CSV are unchanged, or if its hash still
+    matches after a touch or copy.
+
+    :return: the metadata
+    """
+    try:
+        with open(os.path.join(data_cache_dir(file_name), 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return build_data_cache(file_name)
+
+    stat = os.stat(file_name)
+    if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+        return meta
+    if meta['size'] == stat.st_size and meta['sha256'] == file_hash(file_name):
+        meta['mtime_ns'] = stat.st_mtime_ns
+        with open(os.path.join(data_cache_dir(file_name), 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return meta
+    return build_data_cache(file_name)
+
+
+def read_data_frame(file_name):
+    """
+    Loads the OHLCV data of a CSV file from its columnar cache, memory-mapping the columns
+    instead of parsing the CSV again. The columns of the frame are the read-only maps of the .npy
+    files themselves, only the index is read into memory.
+
+    :return: DataFrame indexed by 'Date' with the open, high, low, close and volume columns
+    """
+    data_cache_meta(file_name)
+    cache_dir = data_cache_dir(file_name)
+    index = pd.DatetimeIndex(np.load(os.path.join(cache_dir, 'Date.npy'), mmap_mode='r'), name='Date')
+    columns = {column: np.load(os.path.join(cache_dir, f'{column}.npy'), mmap_mode='r') for column in DATA_COLUMNS}
+    # Without copy=False pandas consolidates the columns into one new block, a copy of all of them
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
 def count_rows_in_csv(file_path):
-    df = pd.read_csv(file_path)
-    return len(df)
+    return data_cache_meta(file_path)['rows']
 
 def load_data(file_name):
     """Load data from CSV file."""
-    data = pd.read_csv(file_name, index_col='Date', parse_dates=True)
+    data = read_data_frame(file_name)
     data = bt.feeds.PandasData(
         dataname=data,
         datetime=None, # Backtrader will use the index as datetime
@@ -222,66 +525,167 @@ def define_data_alphavantage(ticker, start_year, start_month, months, interval):
 
     if not os.path.exists(file_name):
         print(f"CSV file not found. Downloading data for {ticker} from Alphavantage...")
-        fetch_intraday_data_from_alphavantage(ticker, start_year, start_month, months, interval)
-        print(f"CSV file found. Loading data from {file_name}...")
-        data = load_data(file_name)
-        total_candles = count_rows_in_csv(file_name)
-
+        if not fetch_intraday_data_from_alphavantage(ticker, start_year, start_month, months, interval):
+            raise RuntimeError(f"Could not download every month of {ticker} from Alphavantage, so {file_name} was "
+                               f"not written. Run again to download the missing months")
+        print(f"Loading data from {file_name}...")
     else:
         print(f"CSV file found. Loading data from {file_name}...")
-        data = load_data(file_name)
-        total_candles = count_rows_in_csv(file_name)
+    data = load_data(file_name)
+    total_candles = count_rows_in_csv(file_name)
     return data, total_candles
 
-def fetch_intraday_data_from_alphavantage(ticker, start_year, start_month, months, interval):
+ALPHAVANTAGE_URL = 'https://www.alphavantage.co/query'
+
+
+class RateLimiter:
+    """Lets at most `calls` requests start in any window of `period` seconds"""
+
+    def __init__(self, calls, period=60.0):
+        self.calls = calls
+        self.period = period
+        self.starts = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.starts and now - self.starts[0] >= self.period:
+                    self.starts.popleft()
+                if len(self.starts) < self.calls:
+                    self.starts.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self.starts[0]))
+
+
+def month_range(start_year, start_month, months):
+    """:return: list of the `months` months from start_year-start_month on, in 'YYYY-MM' format"""
+    first = start_year * 12 + start_month - 1
+    return [f'{m // 12}-{m % 12 + 1:02d}' for m in range(first, first + months)]
+
+
+def month_cache_file(cache_dir, ticker, interval, month):
+    return os.path.join(cache_dir, ticker, interval, f'{month}.csv')
+
+
+async def fetch_month(ticker, month, interval, apikey, base_url, limiter, semaphore, retries=3, backoff=2.0):
+    """
+    Downloads one month of intraday data, retrying failed requests with exponential backoff.
+
+    :return: DataFrame indexed by 'Date' in chronological order, or None if the month could not be retrieved.
+    """
+    import requests  # Only downloads need it, not the backtests or the workers
+
+    params = dict(function='TIME_SERIES_INTRADAY', symbol=ticker, interval=interval, apikey=apikey, month=month,
+                  outputsize='full', datatype='csv')
+    for attempt in range(retries + 1):
+        async with semaphore:
+            await limiter.acquire()
+            try:
+                response = await asyncio.to_thread(requests.get, base_url, params=params, timeout=60)
+                status, text = response.status_code, response.text
+            except requests.RequestException as e:
+                status, text = None, str(e)
+
+        if status == 200 and not text.lstrip().startswith('{'):
+            # Load the CSV data into a pandas DataFrame, oldest bar first
+            data = pd.read_csv(StringIO(text))
+            data.rename(columns={data.columns[0]: 'Date'}, inplace=True)
+            data.set_index('Date', inplace=True)
+            return data[::-1]
+        if status == 200 and '"Error Message"' in text:
+            break  # The request itself is wrong (unknown symbol, bad month), retrying won't help
+
+        # Server errors, network errors and quota notes are retried
+        if attempt < retries:
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+    print(f"Failed to retrieve data for {month}: {status if status != 200 else text.strip()[:200]}")
+    return None
+
+
+async def download_months(ticker, months, interval, apikey, base_url, cache_dir, concurrency, requests_per_minute,
+                          retries):
+    """
+    Loads every month from the month cache, downloading only the missing ones concurrently.
+    Downloaded months are cached unless they are not over yet, as later requests return more bars.
+
+    :return: dict of month -> DataFrame, None for the months that could not be retrieved
+    """
+    frames = {}
+    missing = []
+    for month in months:
+        file_name = month_cache_file(cache_dir, ticker, interval, month)
+        if os.path.exists(file_name):
+            frames[month] = pd.read_csv(file_name, index_col='Date')
+        else:
+            missing.append(month)
+    if not missing:
+        return frames
+
+    print(f"Downloading {len(missing)} of {len(months)} months for {ticker} from Alphavantage...")
+    limiter = RateLimiter(requests_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    downloaded = await asyncio.gather(*(fetch_month(ticker, month, interval, apikey, base_url, limiter, semaphore,
+                                                    retries) for month in missing))
+
+    current_month = time.strftime('%Y-%m')
+    for month, data in zip(missing, downloaded):
+        frames[month] = data
+        if data is not None and len(data) and month < current_month:
+            file_name = month_cache_file(cache_dir, ticker, interval, month)
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            data.to_csv(file_name + '.tmp')
+            os.replace(file_name + '.tmp', file_name)  # Never leave a partial month in the cache
+    return frames
+
+
+def fetch_intraday_data_from_alphavantage(ticker, start_year, start_month, months, interval, apikey=None,
+                                          base_url=ALPHAVANTAGE_URL, cache_dir='alphavantage_cache', concurrency=4,
+                                          requests_per_minute=5, retries=3):
     """
     Download 1-minute intraday historical data from Alpha Vantage API for multiple months and save it to a CSV file.
+    Months are cached per (ticker, month), so a failed download is resumed by calling it again.
 
     Parameters:
     - ticker (str): Stock symbol to fetch data for (e.g., 'AAPL')
     - interval (str): Interval for intraday data ('1min', '5min', '15min', '30min', '60min')
-    - months (list of str): List of months to fetch data for in 'YYYY-MM' format (e.g., ['2024-01', '2024-02'])
-    """
-    all_data = []
-    for _ in range(months):
-        if start_month > 12:
-            start_year = start_year + 1
-            start_month = 1
-        month = f'{start_year}-{start_month:02d}'
-        url = f'https://www.alphavantage.co/query?function=TIME_SERIES_INTRADAY&symbol={ticker}&interval={interval}&apikey={api_key}&month={month}&outputsize=full&datatype=csv'
-        start_month = start_month + 1
-        response = requests.get(url)
-
-        if response.status_code == 200:
-            # Load the CSV data into a pandas DataFrame
-            data = pd.read_csv(StringIO(response.text))
-
-            # Rename the first column to 'Date'
-            data.rename(columns={data.columns[0]: 'Date'}, inplace=True)
+    - start_year, start_month (int): First month to fetch
+    - months (int): Number of months to fetch
+    - base_url (str): Alpha Vantage endpoint, a local stub server in tests
+    - concurrency (int): Requests in flight at the same time
+    - requests_per_minute (int): API quota of the key
 
-            # Set the 'Date' column as the index
-            data.set_index('Date', inplace=True)
+    :return: True if every month was retrieved and {ticker}_data.csv was written
+    """
+    if apikey is None:
+        from key import api_key as apikey  # The key module is only needed to download
+    month_list = month_range(start_year, start_month, months)
+    frames = asyncio.run(download_months(ticker, month_list, interval, apikey, base_url, cache_dir,
+                                         concurrency, requests_per_minute, retries))
 
-            # Reverse the data if needed
-            data = data[::-1]
+    missing = [month for month in month_list if frames[month] is None]
+    if missing:
+        # No incomplete file: the next call only downloads the missing months
+        print(f"No data saved, missing months: {', '.join(missing)}")
+        return False
 
-            # Append the data to the list
-            all_data.append(data)
-        else:
-            print(f"Failed to retrieve data for {month}: {response.status_code}")
+    # Concatenate all data frames into a single DataFrame
+    combined_data = pd.concat([frames[month] for month in month_list])
 
+    # Save the combined DataFrame to a CSV file
+    output_file = f'{ticker}_data.csv'
+    combined_data.to_csv(output_file)
 
-    if all_data:
-        # Concatenate all data frames into a single DataFrame
-        combined_data = pd.concat(all_data)
+    print(f"Data successfully saved to {output_file}")
+    return True
 
-        # Save the combined DataFrame to a CSV file
-        output_file = f'{ticker}_data.csv'
-        combined_data.to_csv(output_file)
 
-        print(f"Data successfully saved to {output_file}")
-    else:
-        print("No data was retrieved.")
+# Version of the results in the cache database, kept as its user_version. Bump it whenever a change to MyStrategy or
+# the engines changes what a configuration evaluates to, and the rows of the other versions are dropped. Version 1
+# is the rows from before Donchian_Period took effect, evaluated with a period of 20 whatever their key says
+RESULTS_VERSION = 2
 
 
 # Database setup
@@ -291,7 +695,7 @@ def setup_database(db_file='hyperopt_cache.db'):
 
     # Enable performance optimizations
     c.execute('PRAGMA synchronous = OFF')  # Reduces disk writes, faster but less safe
-    c.execute('PRAGMA journal_mode = MEMORY')  # Faster in-memory journal
+    c.execute('PRAGMA journal_mode = MEMORY')  # Faster in-memory journal, unlike WAL not stored in the file
     c.execute('PRAGMA temp_store = MEMORY')  # Keep temp tables in memory
 
     # Create the table if it doesn't exist
@@ -309,6 +713,10 @@ def setup_database(db_file='hyperopt_cache.db'):
             PRIMARY KEY (param1, param2, param3, param4, param5, param6, param7)
         )
     ''')
+    if c.execute('PRAGMA user_version').fetchone()[0] != RESULTS_VERSION:
+        # Results of another version of the strategy, what their parameters evaluate to now is unknown
+        c.execute('DELETE FROM cache')
+        c.execute(f'PRAGMA user_version = {RESULTS_VERSION}')
     conn.commit()
     conn.close()
 
@@ -321,8 +729,8 @@ def load_cache_db(db_file='hyperopt_cache.db'):
 
     # Check if table exists before trying to load
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='cache'")
-    if not c.fetchone():
-        # If the table doesn't exist, return an empty cache
+    if not c.fetchone() or c.execute('PRAGMA user_version').fetchone()[0] != RESULTS_VERSION:
+        # If the table doesn't exist, or holds the results of another version, return an empty cache
         conn.close()
         return cache
 
@@ -335,17 +743,249 @@ def load_cache_db(db_file='hyperopt_cache.db'):
     return cache
 
 
-# Update the cache with new parameters and results
-def update_cache_db(params, results, db_file='hyperopt_cache.db'):
+# Persist the rows put on a queue in batched transactions, as the only writer of the cache table
+def cache_writer(rows_queue, db_file='hyperopt_cache.db', batch_size=100, interval=1.0):
     conn = sqlite3.connect(db_file)
-    c = conn.cursor()
+    # Only for this connection: WAL mode would be written into the tracked database file. The rows are only read
+    # when the cache starts, so nothing has to read while the writer writes
+    conn.execute('PRAGMA journal_mode = MEMORY')
+    conn.execute('PRAGMA synchronous = OFF')
+
+    done = False
+    while not done:
+        rows = []
+        deadline = time.time() + interval
+        while len(rows) < batch_size:
+            try:
+                row = rows_queue.get(timeout=max(0.0, deadline - time.time()))
+            except Empty:
+                break
+            if row is None:  # Sent by EvaluationCache.close
+                done = True
+                break
+            rows.append(row)
+
+        if rows:
+            with conn:  # One transaction per batch
+                conn.executemany('''
+                    INSERT OR REPLACE INTO cache
+                    (param1, param2, param3, param4, param5, param6, param7, returns, drawdown)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+    conn.close()
 
-    # Insert or replace into cache
-    c.execute('''
-        INSERT OR REPLACE INTO cache 
-        (param1, param2, param3, param4, param5, param6, param7, returns, drawdown)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (*params, *results))
 
-    conn.commit()
-    conn.close()
+class EvaluationCache:
+    """
+    Evaluation results shared by the main process and every pool worker through a manager dict,
+    so a result stored by one worker is seen by all of them. Parameters being evaluated are
+    claimed, and other workers asking for them wait for the result instead of evaluating them
+    again. New results are persisted by a single cache_writer process.
+    """
+
+    PENDING = 'pending'
+
+    def __init__(self, results, rows_queue, timeout=600, equity=None, completed=None):
+        self.results = results
+        self.rows_queue = rows_queue
+        self.timeout = timeout  # Seconds to wait for another worker before evaluating anyway
+        # Equity checkpoints of the runs that completed, kept in memory for pruning only
+        self.equity = {} if equity is None else equity
+        # (params, results) of every stored result in order, shared like results. Its length is the version of
+        # the results: readers only fetch the ones added since they last looked, and never see pending ones
+        self.completed = list(results.items()) if completed is None else completed
+
+        # Index of the evaluated parameters for nearest(), by key length, up to the first _version completed
+        self._index = {}
+        self._version = 0
+
+    @classmethod
+    def start(cls, db_file='hyperopt_cache.db', context=multiprocessing):
+        """
+        Starts the manager, loaded with the results in the database, and the writer process.
+
+        :param context: multiprocessing context of the workers, the queue to the writer must come from it
+        """
+        manager = context.Manager()
+        rows_queue = context.Queue()
+        writer = context.Process(target=cache_writer, args=(rows_queue, db_file), daemon=True)
+        writer.start()
+
+        results = load_cache_db(db_file)
+        cache = cls(manager.dict(results), rows_queue, equity=manager.dict(),
+                    completed=manager.list(results.items()))
+        cache._manager, cache._writer = manager, writer
+        return cache
+
+    def close(self):
+        """Flushes the remaining results to the database and stops the writer and the manager"""
+        self.rows_queue.put(None)
+        self._writer.join()
+        self._manager.shutdown()
+
+    def __getstate__(self):
+        # Workers only get the shared dicts and the queue
+        return {'results': self.results, 'rows_queue': self.rows_queue, 'timeout': self.timeout,
+                'equity': self.equity, 'completed': self.completed}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def claim(self, params):
+        """
+        :return: the cached (returns, drawdown) of params, or None if the caller has claimed
+            them and must evaluate them.
+        """
+        token = (self.PENDING, os.getpid())
+        deadline = time.time() + self.timeout
+        while True:
+            result = self.results.setdefault(params, token)  # Atomic in the manager
+            if result == token:
+                return None
+            if result[0] != self.PENDING:
+                return result
+            if time.time() > deadline:
+                return None
+            time.sleep(0.05)  # Another worker is evaluating them
+
+    def release(self, params):
+        """Drops the claim on params of an evaluation that failed, so the workers waiting for it evaluate them"""
+        if self.results.get(params) == (self.PENDING, os.getpid()):
+            self.results.pop(params, None)
+
+    def put(self, params, results, checkpoints=None, persist=True):
+        """
+        Stores the (returns, drawdown) of params, and the equity checkpoints of their run if it was recorded.
+        Results that are not persisted, like the ones on part of the data, are only shared for this run.
+        """
+        if checkpoints is not None:
+            self.equity[params] = checkpoints
+        self.results[params] = results
+        self.completed.append((params, results))
+        if persist:
+            self.rows_queue.put((*params, *results))
+
+    def update(self, results):
+        """Stores a dict of params: (returns, drawdown), like the results of a checkpoint, without persisting them"""
+        for params, value in results.items():
+            self.put(params, value, persist=False)
+
+    def checkpoints(self, params):
+        """:return: the equity checkpoints stored with the result of params, or None"""
+        return self.equity.get(params)
+
+    def nearest(self, params, tolerances):
+        """
+        :param tolerances: largest difference allowed on each parameter.
+        :return: the cached (returns, drawdown) of the closest evaluated parameters that are within
+            `tolerances` of params on every parameter, or None.
+        """
+        version = len(self.completed)
+        if version > self._version:
+            for key, value in self.completed[self._version:version]:  # One request for all the new results
+                if len(key) not in self._index:
+                    self._index[len(key)] = ParamIndex(len(key))
+                self._index[len(key)].add(key, value)
+            self._version = version
+        index = self._index.get(len(params))
+        if index is None or not index.values:
+            return None
+        keys, values = index.keys[:len(index.values)], index.values
+
+        tolerances = np.asarray(tolerances, dtype=float)
+        distances = np.abs(keys - np.asarray(params, dtype=float))
+        within = (distances <= tolerances * (1 + 1e-9)).all(axis=1)  # Keys are rounded, allow for float error
+        if not within.any():
+            return None
+        # Closest by the largest difference relative to its tolerance
+        scaled = (distances / np.where(tolerances > 0, tolerances, 1.0)).max(axis=1)
+        return values[int(np.argmin(np.where(within, scaled, np.inf)))]
+
+
+class ParamIndex:
+    """Parameters of one length and their results, in an array that doubles when it is full"""
+
+    def __init__(self, length, capacity=64):
+        self.keys = np.empty((capacity, length))
+        self.values = []
+        self.rows = {}  # key: its row
+
+    def add(self, key, value):
+        row = self.rows.get(key)
+        if row is not None:
+            self.values[row] = value  # Evaluated again
+            return
+        row = len(self.values)
+        if row == len(self.keys):
+            self.keys = np.concatenate([self.keys, np.empty_like(self.keys)])
+        self.keys[row] = key
+        self.rows[key] = row
+        self.values.append(value)
+
+
+class Surrogate:
+    """
+    Inverse-distance weighted k-nearest-neighbour regression of the (returns, drawdown) of parameters,
+    over the results evaluated so far. The model is the results themselves, so new ones are added
+    as they arrive without refitting anything.
+    """
+
+    def __init__(self, scale, k=5):
+        self.scale = np.asarray(scale, dtype=float)  # Range of every parameter, distances are relative to it
+        self.k = k
+        self.keys = np.empty((0, len(self.scale)))
+        self.values = np.empty((0, 2))
+        self.rows = {}  # key: its row
+        self.seen = 0  # Entries of the completed results already added by sync()
+
+    def __len__(self):
+        return len(self.values)
+
+    def sync(self, completed):
+        """
+        Adds the results of an EvaluationCache.completed list stored since the last sync. Results of other lengths,
+        like the ones on part of the data, are left out. Pending evaluations are not in the list, so every result
+        is added once it is stored, and a result stored again replaces the one before.
+        """
+        items = completed[self.seen:]
+        self.seen += len(items)
+        new = {}
+        for key, value in items:
+            if len(key) != len(self.scale):
+                continue
+            if key in self.rows:
+                self.values[self.rows[key]] = value
+            else:
+                new[key] = value
+        if new:
+            self.rows.update((key, len(self.values) + row) for row, key in enumerate(new))
+            self.keys = np.vstack([self.keys, np.array(list(new), dtype=float) / self.scale])
+            self.values = np.vstack([self.values, np.array(list(new.values()), dtype=float)])
+
+    def predict(self, params):
+        """:return: (mean, std) arrays of the predicted (returns, drawdown) of every parameter tuple of params"""
+        means, stds = [], []
+        k = min(self.k, len(self.values))
+        for point in np.asarray(params, dtype=float) / self.scale:
+            distances = np.sqrt(((self.keys - point) ** 2).sum(axis=1))
+            nearest = np.argpartition(distances, k - 1)[:k]
+            weights = 1.0 / (distances[nearest] + 1e-9)
+            weights /= weights.sum()
+            mean = weights @ self.values[nearest]
+            means.append(mean)
+            stds.append(np.sqrt(weights @ (self.values[nearest] - mean) ** 2))
+        return np.array(means), np.array(stds)
+
+
+def quantize_params(individual, param_space):
+    """
+    Effective parameters of an individual, each clamped to its range and rounded to its resolution.
+
+    :param param_space: (name, low, high, resolution) of every parameter, in the order of the individual
+    :return: tuple of the effective parameters, which is also their cache key
+    """
+    params = []
+    for value, (_, low, high, resolution) in zip(individual, param_space):
+        value = max(low, min(value, high))
+        params.append(round(round(value / resolution) * resolution, 10))
+    return tuple(params)
@@ -0,0 +1,45 @@
+import json
+import os
+
+import pytest
+
+from instrumentation import PHASES, EvaluationProfiler
+
+
+def test_collect_aggregates_the_records_of_a_generation(tmp_path):
+    log_file = str(tmp_path / 'evaluation_log.jsonl')
+    profiler = EvaluationProfiler([], log_file)
+    profiler.record(params=(20,), cache='hit', total=0.5, cache_lookup=0.5)
+    profiler.record(params=(21,), cache='miss', total=2.0, cache_lookup=0.25, bar_loop=1.5, cache_store=0.25)
+    profiler.record(params=(22,), cache='miss', total=1.5, bar_loop=1.5)
+
+    summary = profiler.collect(0, elapsed=2.0, processes=2)
+    assert (summary['evaluations'], summary['cache_hits'], summary['cache_misses']) == (3, 1, 2)
+    assert summary['cache_lookup_seconds'] == 0.75
+    assert summary['bar_loop_seconds'] == 3.0
+    assert summary['total_seconds'] == 4.0
+    assert summary['utilization'] == 1.0  # 4 seconds of evaluations over 2 seconds of 2 workers
+    assert set(f'{phase}_seconds' for phase in PHASES) <= set(summary)
+
+    # The next generation only gets the records added since
+    profiler.record(params=(23,), cache='hit', total=1.0)
+    assert profiler.collect(1, elapsed=1.0, processes=2)['evaluations'] == 1
+
+    with open(log_file) as f:
+        lines = [json.loads(line) for line in f]
+    assert [(line['type'], line['generation']) for line in lines] == [
+        ('evaluation', 0), ('evaluation', 0), ('evaluation', 0), ('generation', 0),
+        ('evaluation', 1), ('generation', 1)]
+    assert lines[1]['params'] == [21] and lines[1]['bar_loop'] == 1.5
+
+
+@pytest.mark.parametrize('profile_every, profiled', [(0, []), (2, [2, 4])])
+def test_profile_every(tmp_path, profile_every, profiled):
+    profiler = EvaluationProfiler([], str(tmp_path / 'log.jsonl'), profile_every, str(tmp_path / 'profiles'))
+    evaluations = []
+    for evaluation in range(1, 5):
+        profile = profiler.profile()
+        if profile is not None:
+            assert os.path.exists(profiler.save_profile(profile))
+            evaluations.append(evaluation)
+    assert evaluations == profiled
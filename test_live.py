@@ -0,0 +1,22 @@
+import pytest
+
+from live import LiveTrader, compare_with_backtest, format_bar, parse_bar, trade
+from test_vector_engine import PARAMS
+
+
+@pytest.mark.parametrize('params', PARAMS)
+def test_live_trader_matches_run_backtest(data_file, params):
+    assert compare_with_backtest(data_file, **params)
+
+
+def test_bar_lines_round_trip():
+    bar = (1704186000000000, 152.45, 152.86, 152.12, 152.5, 2047.0)
+    assert parse_bar(format_bar(*bar))[:6] == bar
+
+
+def test_trade_reads_the_lines_of_a_stream():
+    lines = [format_bar(1704186000000000 + k * 60000000, 100.0, 101.0, 99.0, 100.5, 10.0) for k in range(10)]
+    trader = LiveTrader()
+    stats = trade(lines, trader)
+    assert stats.summary()['bars'] == 10
+    assert trader.value == 10000
@@ -0,0 +1,126 @@
+import os
+import pickle
+import queue
+import random
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
+import pytest
+
+import main_program
+from main_program import stitch_equity, walk_forward_windows
+from support import EvaluationCache, load_data
+from vector_engine import MarketData
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(scope='module')
+def market(data_file):
+    return MarketData(load_data(data_file).p.dataname)
+
+
+@pytest.fixture
+def optimizer(market, monkeypatch):
+    """main_program set up in this process: the evaluations run one by one, with a cache that persists nothing"""
+    monkeypatch.setattr(main_program, 'market_data', market, raising=False)
+    monkeypatch.setattr(main_program, 'total_candles', len(market), raising=False)
+    monkeypatch.setattr(main_program, 'evaluation_cache', None, raising=False)
+    main_program.toolbox.register('evaluate', main_program.evaluate)
+
+
+def start_cache():
+    """:return: new empty EvaluationCache of main_program, whose rows for the writer are left on a queue"""
+    cache = EvaluationCache({}, queue.Queue())
+    main_program.evaluation_cache = cache
+    return cache
+
+
+def fitnesses(individuals):
+    return [ind.fitness.values for ind in individuals]
+
+
+def test_walk_forward_windows_roll_over_the_data():
+    windows = walk_forward_windows(100, 45, 15)
+    assert windows == [(0, 45, 60), (15, 60, 75), (30, 75, 90), (45, 90, 100)]
+    # Every window trains on the bars right before its test range, and the test ranges follow each other
+    assert all(test_start - train_start == 45 for train_start, test_start, _ in windows)
+    assert all(previous[2] == window[1] for previous, window in zip(windows, windows[1:]))
+    assert windows[-1][2] == 100
+
+
+def test_walk_forward_needs_a_window(monkeypatch):
+    monkeypatch.setattr(main_program, 'total_candles', 100, raising=False)  # Set by load_market_data
+    monkeypatch.setattr(main_program, 'wf_train_fraction', 1.0)
+    with pytest.raises(ValueError, match='No walk-forward window'):
+        main_program.walk_forward(None)
+    monkeypatch.setattr(main_program, 'wf_train_fraction', 0.45)
+    monkeypatch.setattr(main_program, 'wf_test_fraction', 0.0)
+    with pytest.raises(ValueError, match='No walk-forward window'):
+        main_program.walk_forward(None)
+
+
+def test_stitch_equity_carries_the_capital_over():
+    first = pd.Series([10000.0, 11000.0], index=pd.to_datetime(['2024-01-02', '2024-01-03']))
+    second = pd.Series([10000.0, 9000.0], index=pd.to_datetime(['2024-01-04', '2024-01-05']))
+    stitched = stitch_equity([first, second])
+    assert list(stitched) == [10000.0, 11000.0, 11000.0, 9900.0]
+
+
+def test_optimize_resumes_exactly(optimizer, tmp_path, monkeypatch):
+    random.seed(1)
+    start_cache()
+    population, hof, logbook = main_program.optimize(6, 3)
+    random_state = random.getstate()
+
+    # Interrupted once the checkpoint of generation 1 is saved
+    checkpoint = str(tmp_path / 'checkpoint.pkl')
+    save_checkpoint = main_program.save_checkpoint
+
+    def interrupt(file_name, state):
+        save_checkpoint(file_name, state)
+        if state['gen'] == 2:
+            raise Interrupted
+
+    random.seed(1)
+    cache = start_cache()
+    monkeypatch.setattr(main_program, 'save_checkpoint', interrupt)
+    with pytest.raises(Interrupted):
+        main_program.optimize(6, 3, checkpoint=checkpoint)
+
+    # The checkpoint keeps every result of the run, as the writer may not have stored them
+    with open(checkpoint, 'rb') as f:
+        assert pickle.load(f)['results'] == dict(cache.completed)
+
+    # A new process, whose database got none of them, with another random state
+    random.seed(2)
+    start_cache()
+    resumed_population, resumed_hof, resumed_logbook = main_program.optimize(6, 3, checkpoint=checkpoint)
+    assert resumed_population == population and fitnesses(resumed_population) == fitnesses(population)
+    assert list(resumed_hof) == list(hof) and fitnesses(resumed_hof) == fitnesses(hof)
+    assert [entry['nevals'] for entry in resumed_logbook] == [entry['nevals'] for entry in logbook]
+    assert random.getstate() == random_state
+    assert not os.path.exists(checkpoint)
+
+
+def test_steady_state_keeps_the_best_population(monkeypatch):
+    evaluated = []
+
+    def evaluate(individual):
+        evaluated.append(list(individual))
+        return sum(individual), 0.0  # Returns that rank every individual, the same drawdown
+
+    monkeypatch.setattr(main_program.toolbox, 'evaluate', evaluate)
+    random.seed(1)
+    with ThreadPool(2) as pool:
+        population, hof, logbook = main_program.optimize_steady_state(4, 14, pool, processes=2)
+
+    assert len(evaluated) == 14
+    # Every evaluation replaces the worst individual when it is better, and the population keeps its size
+    assert len(population) == 4
+    best = sorted((sum(individual) for individual in evaluated), reverse=True)
+    assert sorted((ind.fitness.values[0] for ind in population), reverse=True) == best[:4]
+    assert hof[0].fitness.values[0] == best[0]
+    assert [entry['evals'] for entry in logbook] == [4, 8, 12, 14]
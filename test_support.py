@@ -0,0 +1,153 @@
+import asyncio
+import functools
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import backtrader as bt
+import numpy as np
+import pytest
+
+import support
+from events import trade_summary
+from main_program import trade_counts
+
+FAILING_MONTH = '2024-02'
+
+
+def month_csv(month):
+    """Alpha Vantage CSV of two bars of the month, newest first"""
+    return (f'timestamp,open,high,low,close,volume\n'
+            f'{month}-02 09:31:00,101.0,102.0,100.5,101.5,200\n'
+            f'{month}-02 09:30:00,100.0,101.0,99.5,100.5,100\n')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves month_csv for every month but FAILING_MONTH, which gets a server error"""
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        month = query['month'][0]
+        self.server.requests.append(month)
+        if month == FAILING_MONTH:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = month_csv(month).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stub_url(server):
+    return f'http://127.0.0.1:{server.server_port}/query'
+
+
+@pytest.fixture
+def stub_download(server, tmp_path, monkeypatch):
+    """define_data_alphavantage downloads from the stub server, into tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(support, 'fetch_intraday_data_from_alphavantage', functools.partial(
+        support.fetch_intraday_data_from_alphavantage, apikey='key', base_url=stub_url(server),
+        requests_per_minute=1000, retries=0))
+
+
+def download(server, cache_dir, months):
+    return asyncio.run(support.download_months('TEST', months, '1min', 'key', stub_url(server), str(cache_dir),
+                                               concurrency=2, requests_per_minute=1000, retries=0))
+
+
+def test_download_months_caches_every_month(server, tmp_path):
+    months = ['2024-03', '2024-04']
+    frames = download(server, tmp_path, months)
+    assert sorted(server.requests) == months
+    for month in months:
+        assert list(frames[month].index) == [f'{month}-02 09:30:00', f'{month}-02 09:31:00']  # Oldest first
+        assert os.path.exists(support.month_cache_file(str(tmp_path), 'TEST', '1min', month))
+
+    # Cached months are not downloaded again
+    frames = download(server, tmp_path, months)
+    assert len(server.requests) == 2
+    assert list(frames['2024-04']['close']) == [100.5, 101.5]
+
+
+def test_failed_month_is_not_cached(server, tmp_path):
+    frames = download(server, tmp_path, ['2024-01', FAILING_MONTH])
+    assert frames[FAILING_MONTH] is None
+    assert frames['2024-01'] is not None
+    assert not os.path.exists(support.month_cache_file(str(tmp_path), 'TEST', '1min', FAILING_MONTH))
+
+
+def test_define_data_raises_when_a_month_fails(server, stub_download):
+    with pytest.raises(RuntimeError, match='Run again'):
+        support.define_data_alphavantage('TEST', 2024, 1, 2, '1min')
+    assert not os.path.exists('TEST_data.csv')
+    assert sorted(server.requests) == ['2024-01', FAILING_MONTH]
+
+
+def test_define_data_downloads_and_loads(stub_download):
+    data, total_candles = support.define_data_alphavantage('TEST', 2024, 3, 2, '1min')
+    assert total_candles == 4
+    assert list(data.p.dataname['close']) == [100.5, 101.5, 100.5, 101.5]
+
+
+def test_read_data_frame_memory_maps_the_columns(data_file, monkeypatch):
+    support.data_cache_meta(data_file)  # Built before np.load is recorded
+    mapped = {}
+    load = np.load
+
+    def recording_load(file, *args, **kwargs):
+        array = load(file, *args, **kwargs)
+        mapped[os.path.splitext(os.path.basename(file))[0]] = array
+        return array
+
+    monkeypatch.setattr(np, 'load', recording_load)
+    df = support.read_data_frame(data_file)
+    for column in support.DATA_COLUMNS:
+        assert isinstance(mapped[column], np.memmap)
+        assert np.shares_memory(df[column].to_numpy(), mapped[column])
+    assert len(df) == support.count_rows_in_csv(data_file)
+
+
+class BreakEvenStrategy(bt.Strategy):
+    """Buys one share at the open of the second bar and sells it at the open of the third, at the same price"""
+
+    def next(self):
+        if len(self) == 1:
+            self.buy(size=1)
+        elif len(self) == 2:
+            self.close()
+
+
+def test_break_even_trade_is_won(data_file):
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(support.load_data(data_file))
+    cerebro.addstrategy(BreakEvenStrategy)
+    cerebro.addanalyzer(support.MetricsAnalyzer, _name='metrics')
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades')
+    strategy = cerebro.run()[0]
+
+    trades = strategy.analyzers.trades.get_analysis()
+    assert trades.total.closed == 1 and trades.pnl.net.total == 0.0 and trades.won.total == 1
+    assert strategy.analyzers.metrics.get_analysis()['won'] == 1
+
+    closed = np.zeros(1, dtype=[('pnlcomm', 'f8'), ('bars', 'i8'), ('commission', 'f8')])
+    assert trade_summary(closed)['won'] == 1
+    assert trade_counts([(0, 0, 0, 0.0)]) == {'trades': 1, 'won': 1}
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from support import load_data
+from vector_engine import MarketData, compare_with_cerebro, run_backtest, run_backtests
+
+PARAMS = (
+    {},
+    dict(Donchian_Period=20, risk_per_trade=0.01, stop_distance_factor=0.01, take_profit_distance_factor=0.01),
+)
+PRUNE_INTERVAL = 1000  # Divides the bars of the data, so the last checkpoint falls on its last bar
+
+
+@pytest.fixture(scope='module')
+def market(data_file):
+    return MarketData(load_data(data_file).p.dataname)
+
+
+@pytest.mark.parametrize('params', PARAMS)
+def test_run_backtest_matches_cerebro(data_file, params):
+    assert compare_with_cerebro(data_file, **params)
+
+
+def test_run_backtests_matches_run_backtest(market):
+    params = list(PARAMS) + [dict(Donchian_Period=period, risk_per_trade=0.008) for period in range(20, 51, 5)]
+    for batched, strategy_params in zip(run_backtests(market, params, daily=True), params):
+        single = run_backtest(market, daily=True, **strategy_params)
+        assert batched.final_value == single.final_value
+        assert batched.max_drawdown == single.max_drawdown
+        assert batched.orders == single.orders
+        assert batched.trades == single.trades
+        assert batched.daily.equals(single.daily)
+
+
+def test_daily_values_are_the_last_of_every_day(market):
+    result = run_backtest(market, equity=True, daily=True, **PARAMS[1])
+    assert len(result.orders) > 0
+    expected = result.equity.resample('D').last().dropna()
+    assert np.array_equal(result.daily.to_numpy(), expected.to_numpy())
+    assert (result.daily.index == expected.index).all()
+
+
+@pytest.fixture(scope='module')
+def pruning(market):
+    """:return: pruning parameters of PARAMS[1] that stop it by drawdown, record checkpoints, and stop it at a floor"""
+    checkpoints = run_backtest(market, total_candles=len(market), prune_interval=PRUNE_INTERVAL,
+                               **PARAMS[1]).checkpoints
+    floor = [min(checkpoints) + 0.01] * len(checkpoints)  # Reached at the lowest checkpoint, after a trade opened
+    return [dict(prune_drawdown=0.2), dict(prune_interval=PRUNE_INTERVAL),
+            dict(prune_interval=PRUNE_INTERVAL, prune_floor=floor)]
+
+
+def test_pruned_runs_match_cerebro(data_file, market, pruning):
+    for prune in pruning:
+        assert compare_with_cerebro(data_file, **PARAMS[1], **prune)
+    pruned = [run_backtest(market, total_candles=len(market), **PARAMS[1], **prune).pruned for prune in pruning]
+    assert pruned == [True, False, True]
+
+
+def test_pruned_run_backtests_match_run_backtest(market, pruning):
+    for prune in pruning:
+        params = list(PARAMS) + [dict(Donchian_Period=period, risk_per_trade=0.008) for period in range(20, 51, 10)]
+        batched = run_backtests(market, params, total_candles=len(market), **prune)
+        for result, strategy_params in zip(batched, params):
+            single = run_backtest(market, total_candles=len(market), **strategy_params, **prune)
+            assert result.pruned == single.pruned
+            assert result.checkpoints == single.checkpoints
+            assert result.final_value == single.final_value
+            assert result.orders == single.orders
+
+
+def test_one_checkpoint_per_interval(market):
+    # The cycle that flushes the resampled bars at the end repeats the last 1-minute bar, which must not record
+    # its checkpoint again. compare_with_cerebro checks that MyStrategy records the same ones
+    assert len(market.cycle_0) == len(market) + 1 and len(market) % PRUNE_INTERVAL == 0
+    result = run_backtest(market, total_candles=len(market), prune_interval=PRUNE_INTERVAL, **PARAMS[1])
+    assert len(result.checkpoints) == len(market) // PRUNE_INTERVAL
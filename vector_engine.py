@@ -0,0 +1,952 @@
+import inspect
+import math
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from indicator_store import IndicatorStore
+
+# The higher timeframes MyStrategy runs on, in the same order as in main_program.create_data
+COMPRESSIONS = (15, 60)
+
+MINUTE = 60 * 1000000  # timestamps are handled as integer microseconds
+DAY = 24 * 60 * MINUTE
+SESSION_END = DAY - 10  # backtrader's default sessionend is 23:59:59.999990
+
+
+def _minute_of_day(t):
+    return (t % DAY) // MINUTE
+
+
+def _session_end(t):
+    return t - t % DAY + SESSION_END
+
+
+class Resampler:
+    """
+    Resamples a stream of 1-minute bars into bars of `compression` minutes, one bar at a time, the same
+    way cerebro.resampledata does with its default parameters (bar2edge, adjbartime and rightedge),
+    including where bars are cut at gaps and session changes and the timestamps they are delivered with.
+    Timestamps are integer microseconds.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.bar = None  # [datetime, open, high, low, close, volume] of the bar being built
+        self.next_eos = None
+        self.last_eos = None
+
+    def _update(self, t, o, h, l, c, v):
+        bar = self.bar
+        if bar is None:
+            self.bar = [t, o, h, l, c, v]
+            return
+        bar[0] = t
+        if h > bar[2]:
+            bar[2] = h
+        if l < bar[3]:
+            bar[3] = l
+        bar[4] = c
+        bar[5] += v
+
+    def add(self, t, o, h, l, c, v):
+        """
+        Adds the next 1-minute bar.
+
+        :return: the [datetime, open, high, low, close, volume] bar it completed, or None
+        """
+        compression = self.compression
+
+        # Bars sitting on a boundary are added to the current bar and close it
+        if self.next_eos is None:
+            self.next_eos = _session_end(t)
+        if t == self.next_eos:
+            self.last_eos, self.next_eos = self.next_eos, None
+            on_edge = True
+        else:
+            on_edge = t % MINUTE == 0 and _minute_of_day(t) % compression == 0
+
+        if on_edge:
+            self._update(t, o, h, l, c, v)
+
+        bar = self.bar
+        deliver = bar is not None
+        if deliver and not on_edge:
+            if self.next_eos is None:
+                self.next_eos = _session_end(t)
+            if t > self.next_eos and bar[0] <= self.next_eos:
+                self.last_eos, self.next_eos = self.next_eos, None
+            elif t == self.next_eos:
+                self.last_eos, self.next_eos = self.next_eos, None
+            elif t < bar[0]:
+                deliver = False
+            else:
+                point = _minute_of_day(bar[0])
+                barpoint = _minute_of_day(t)
+                deliver = barpoint > point and (compression == 1 or barpoint // compression > point // compression)
+
+        if deliver:
+            if not on_edge:
+                if self.next_eos is None:
+                    adjusted = self.last_eos
+                else:
+                    adjusted = bar[0] - bar[0] % DAY + (_minute_of_day(bar[0]) // compression + 1) * compression * MINUTE
+                if adjusted > bar[0]:
+                    bar[0] = adjusted
+            self.bar = None
+        else:
+            bar = None
+
+        if not on_edge:
+            self._update(t, o, h, l, c, v)
+        return bar
+
+    def flush(self):
+        """:return: the bar still open when the data ends, stamped as resampledata does, or None"""
+        bar, self.bar = self.bar, None
+        if bar is not None:
+            if self.next_eos is None:
+                bar[0] = self.last_eos
+            else:
+                bar[0] = bar[0] - bar[0] % DAY + (_minute_of_day(bar[0]) // self.compression + 1) * self.compression * MINUTE
+        return bar
+
+
+def resample_minutes(times, opens, highs, lows, closes, volumes, compression):
+    """
+    Resamples 1-minute bars with a Resampler.
+
+    :return: (times, opens, highs, lows, closes, volumes, delivered) arrays of the resampled
+        bars, where `delivered` is the index of the 1-minute bar that completed each bar
+        (len(times) for the bar flushed when the data ends).
+    """
+    out = []
+    resampler = Resampler(compression)
+    columns = [column.tolist() for column in (times, opens, highs, lows, closes, volumes)]
+    for i, row in enumerate(zip(*columns)):
+        bar = resampler.add(*row)
+        if bar is not None:
+            out.append(bar + [i])
+    bar = resampler.flush()
+    if bar is not None:
+        out.append(bar + [len(times)])
+
+    columns = list(zip(*out)) if out else [()] * 7
+    return ((np.array(columns[0], dtype=np.int64),) + tuple(np.array(c, dtype=float) for c in columns[1:6])
+            + (np.array(columns[6], dtype=np.int64),))
+
+
+class MarketData:
+    """
+    The 1-minute series plus its resampled timeframes, aligned the way Cerebro steps
+    through them. Every element of the `cycle_*` arrays is one call of the strategy,
+    holding the index of the current bar on each feed (-1 before the first bar), so the
+    first len(self) elements of `cycle_frames` map each 1-minute bar to the last completed
+    bar of every resampled timeframe.
+
+    Resampling makes Cerebro run in next mode with the 1-minute feed as the clock:
+    there is one cycle per 1-minute bar, and a resampled bar becomes visible in the
+    cycle of the 1-minute bar that completed it. Bars still open when the data ends
+    are flushed in one extra cycle in which the 1-minute feed does not move.
+    """
+
+    def __init__(self, df):
+        times = df.index.values.astype('datetime64[us]').astype(np.int64)
+        columns = [df[column].to_numpy(dtype=float) for column in ('open', 'high', 'low', 'close', 'volume')]
+        frames = [resample_minutes(times, *columns, compression) for compression in COMPRESSIONS]
+
+        n = len(times)
+        flush = any(len(frame[6]) and frame[6][-1] == n for frame in frames)
+        steps = np.arange(n + 1 if flush else n)
+        cycle_0 = np.minimum(steps, n - 1)
+        cycle_frames = [np.searchsorted(frame[6], steps, side='right') - 1 for frame in frames]
+
+        self._setup(times, columns, frames, cycle_0, cycle_frames)
+
+    def _setup(self, times, columns, frames, cycle_0, cycle_frames):
+        self.times = times
+        self.index = pd.DatetimeIndex(times.astype('datetime64[us]'), name='Date')
+        self.open, self.high, self.low, self.close, self.volume = columns
+        self.frames = frames
+        self.cycle_0 = cycle_0
+        self.cycle_frames = cycle_frames
+
+        # Indicator lines of the resampled feeds, shared by every run on this data
+        self.indicators = IndicatorStore({compression: (frame[2], frame[3])
+                                          for compression, frame in zip(COMPRESSIONS, self.frames)})
+        self._active = {}
+        self._resampled = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def _arrays(self):
+        arrays = [self.times, self.open, self.high, self.low, self.close, self.volume, self.cycle_0]
+        for frame, cycle in zip(self.frames, self.cycle_frames):
+            arrays.extend(frame)
+            arrays.append(cycle)
+        return arrays
+
+    def share(self):
+        """
+        Copies the arrays into a single shared memory block that worker processes can attach to
+        with MarketData.attach instead of loading and resampling the data themselves. The caller
+        owns the block: it must stay open while workers use it and be unlinked afterwards.
+
+        :return: (SharedMemory, handle) where the handle is the picklable argument of attach
+        """
+        arrays = self._arrays()
+        layout = []
+        size = 0
+        for array in arrays:
+            layout.append((array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // 8) * 8  # keep every array 8-byte aligned
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for array, (dtype, shape, offset) in zip(arrays, layout):
+            np.ndarray(shape, dtype, buffer=memory.buf, offset=offset)[:] = array
+        return memory, (memory.name, layout)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        MarketData whose arrays are read-only views of the shared memory block created by share().
+
+        :return: MarketData
+        """
+        name, layout = handle
+        memory = shared_memory.SharedMemory(name=name)
+        arrays = []
+        for dtype, shape, offset in layout:
+            array = np.ndarray(shape, dtype, buffer=memory.buf, offset=offset)
+            array.flags.writeable = False
+            arrays.append(array)
+
+        market = cls.__new__(cls)
+        market._memory = memory  # keeps the block mapped as long as the views are in use
+        columns, cycle_0 = arrays[1:6], arrays[6]
+        frames, cycle_frames = [], []
+        for k in range(len(COMPRESSIONS)):
+            start = 7 + k * 8
+            frames.append(tuple(arrays[start:start + 7]))
+            cycle_frames.append(arrays[start + 7])
+        market._setup(arrays[0], columns, frames, cycle_0, cycle_frames)
+        return market
+
+    def feeds(self):
+        """
+        Ready-made data feeds for Cerebro: the 1-minute data followed by the resampled
+        timeframes, added in place of cerebro.resampledata. Runs with them are identical to
+        resampling in the run, except for the datetimes of bars completed after a gap.
+
+        :return: list of PandasData feeds, the 1-minute one and one per compression in COMPRESSIONS.
+        """
+        import backtrader as bt
+
+        if self._resampled is None:
+            # Resampled bars are stamped with the time they become available so that plain feeds
+            # step in the same cycles as resampledata. Flushed bars come one minute after the data.
+            n = len(self.times)
+            self._resampled = {}
+            for compression, frame in zip(COMPRESSIONS, self.frames):
+                delivered = frame[6]
+                available = np.where(delivered < n, self.times[np.minimum(delivered, n - 1)], self.times[-1] + MINUTE)
+                self._resampled[compression] = pd.DataFrame(
+                    {'open': frame[1], 'high': frame[2], 'low': frame[3], 'close': frame[4], 'volume': frame[5]},
+                    index=pd.DatetimeIndex(available.astype('datetime64[us]'), name='Date'))
+
+        minutes = pd.DataFrame({'open': self.open, 'high': self.high, 'low': self.low, 'close': self.close,
+                                'volume': self.volume}, index=self.index)
+        return ([bt.feeds.PandasData(dataname=minutes, datetime=None, timeframe=bt.TimeFrame.Minutes, compression=1)]
+                + [bt.feeds.PandasData(dataname=self._resampled[compression], datetime=None,
+                                       timeframe=bt.TimeFrame.Minutes, compression=compression)
+                   for compression in COMPRESSIONS])
+
+    def active(self, donchian_period):
+        """
+        :return: boolean array of the cycles in which next() runs, which is once the indicators
+            MyStrategy builds on every feed have their minimum period.
+        """
+        if donchian_period not in self._active:
+            minperiod = max(IndicatorStore.minperiod('ichimoku'), IndicatorStore.minperiod('donchian', donchian_period))
+            self._active[donchian_period] = np.logical_and.reduce(
+                [cycle >= minperiod - 1 for cycle in self.cycle_frames] + [self.cycle_0 >= 0])
+        return self._active[donchian_period]
+
+    def window(self, start, stop):
+        """
+        :return: MarketWindow of the 1-minute bars start to stop (excluded), sharing the arrays and
+            indicators of this data.
+        """
+        return MarketWindow(self, start, stop)
+
+
+class MarketWindow:
+    """
+    The cycles of a range of 1-minute bars of a MarketData, for run_backtest. Nothing is sliced
+    or resampled again: the window keeps the bar indices of the whole series, so its indicators
+    are the ones of the whole series and are already warmed up by the bars before the window.
+    Pass `end` as total_candles to close the last trade at the end of the window.
+    """
+
+    def __init__(self, market, start, stop):
+        self.market = market
+        self.start = start
+        self.end = min(stop, len(market))
+        # The last window also gets the cycle in which the bars still open at the end are flushed
+        self.cycles = slice(start, self.end if self.end < len(market) else None)
+
+        self.index, self.open, self.close = market.index, market.open, market.close
+        self.indicators = market.indicators
+        self.cycle_0 = market.cycle_0[self.cycles]
+        self.cycle_frames = [cycle[self.cycles] for cycle in market.cycle_frames]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def active(self, donchian_period):
+        return self.market.active(donchian_period)[self.cycles]
+
+
+class BacktestResult:
+    def __init__(self, final_value, max_drawdown, orders, trades, equity=None, checkpoints=None, pruned=False,
+                 timings=None, daily=None):
+        self.final_value = final_value
+        self.max_drawdown = max_drawdown
+        self.orders = orders  # (datetime, size, price, commission) of every execution
+        self.trades = trades  # (open datetime, close datetime, pnl, pnlcomm) of every closed trade
+        self.equity = equity  # Series of the broker value at every 1-minute bar, if it was recorded
+        self.checkpoints = checkpoints  # broker value every prune_interval bars, if it was recorded
+        self.pruned = pruned  # stopped early by prune_drawdown or prune_floor
+        self.timings = timings  # seconds spent getting the indicators and in the bar loop
+        self.daily = daily  # Series of the broker value at the end of every day, if it was recorded
+
+
+def _split(position, size):
+    """Parts of an order size that close and open a position, as bt.Position.update splits them."""
+    new_size = position + size
+    if not new_size:
+        return 0, size
+    if not position or (position > 0) == (size > 0):
+        return size, 0
+    if (new_size > 0) == (position > 0):
+        return 0, size
+    return new_size, -position
+
+
+def _day_ends(market):
+    """:return: (list of whether every cycle of market is the last one of its day, datetimes of those days)"""
+    days = market.index.values[market.cycle_0].astype('datetime64[D]')
+    ends = np.ones(len(days), dtype=bool)
+    ends[:-1] = days[:-1] != days[1:]
+    return ends.tolist(), pd.DatetimeIndex(days[ends].astype('datetime64[us]'))
+
+
+def run_backtest(market, starting_capital=10000, commission=0.00035, total_candles=0,
+                 risk_per_trade=0.003, stop_distance_factor=0.01, take_profit_distance_factor=0.01,
+                 take_profit_trigger_factor=0.4, Donchian_Period=40, equity=False,
+                 prune_drawdown=None, prune_floor=None, prune_interval=None, daily=False, **_):
+    """
+    Runs MyStrategy with FixedRiskSizer on a BackBroker equivalent in a single pass over
+    the precomputed cycles of `market`, a MarketData or MarketWindow. The parameters mirror the
+    MyStrategy params; the ones MyStrategy does not read (order_factor, ...) are accepted and ignored.
+    With equity=True the result also has the equity curve, and with daily=True the value at the end of every
+    day, the last one of every day of the equity curve.
+
+    :return: BacktestResult with the same final value, max drawdown (in percent) and executions as Cerebro.
+    """
+    start_time = time.perf_counter()
+    # Plain lists are a lot faster than NumPy arrays for element access in the loop below
+    opens, closes = market.open.tolist(), market.close.tolist()
+    donchian_period = int(Donchian_Period)
+    dch, dcl = (line.tolist() for line in market.indicators.get(COMPRESSIONS[0], 'donchian', donchian_period))
+    span_a, span_b = (line.tolist() for line in market.indicators.get(COMPRESSIONS[0], 'ichimoku'))
+    cycle_0, cycle_1 = market.cycle_0.tolist(), market.cycle_frames[0].tolist()
+    active = market.active(donchian_period).tolist()
+    loop_time = time.perf_counter()
+
+    cash = value = float(starting_capital)
+    position = 0
+    position_price = 0.0
+    has_position_entry = False  # the broker values positions once an order has been seen
+    max_value = float('-inf')
+    max_drawdown = 0.0
+
+    submitted = []  # (size, creation bar, creation close) waiting for the broker's cash check
+    pending = []
+    order = False  # MyStrategy.order is set
+    stop_price = take_profit_price = trailing_profit_price = None
+
+    orders = []
+    trades = []
+    trade_open = None
+    trade_size = 0
+    trade_price = trade_pnl = trade_comm = 0.0
+    values = [] if equity else None
+    daily_values = [] if daily else None
+    day_end, days = _day_ends(market) if daily else (None, None)
+    checkpoints = [] if prune_interval else None
+    pruned = False
+    bars = len(market)
+
+    for k in range(len(cycle_0)):
+        i = cycle_0[k]
+        completed = False
+
+        # Broker: accept submitted orders if the cash allows it at the creation price
+        if submitted:
+            has_position_entry = True
+            check_cash = cash
+            check_position = position
+            for size, created, price in submitted:
+                opened, closed = _split(check_position, size)
+                check_position += size
+                if closed:
+                    check_cash += -closed * price
+                    check_cash -= abs(closed) * commission * price
+                if opened:
+                    check_cash -= opened * price
+                    check_cash -= abs(opened) * commission * price
+                if check_cash >= 0.0:
+                    pending.append((size, created, price))
+                else:
+                    completed = True
+            submitted = []
+
+        # Broker: execute market orders at the open of the next 1-minute bar
+        if pending:
+            waiting = []
+            for size, created, price in pending:
+                if i <= created:
+                    waiting.append((size, created, price))
+                    continue
+
+                price = opens[i]
+                opened, closed = _split(position, size)
+                pnl = -closed * (price - position_price) * 1.0
+                closed_comm = opened_comm = 0.0
+                if closed:
+                    cash += -closed * position_price + pnl
+                    closed_comm = abs(closed) * commission * price
+                    cash -= closed_comm
+                if opened:
+                    opened_cash = cash - opened * price
+                    opened_comm = abs(opened) * commission * price
+                    opened_cash -= opened_comm
+                    if opened_cash < 0.0:
+                        opened = 0
+                        opened_comm = 0.0
+                    else:
+                        cash = opened_cash
+
+                executed = closed + opened
+                if executed:
+                    # Order and trade prices are averaged the way bt.Order and bt.Trade do it
+                    dt = market.index[i]
+                    orders.append((dt, executed, executed * price / executed, closed_comm + opened_comm))
+                    if closed:
+                        trade_comm += closed_comm
+                        trade_size += closed
+                        trade_pnl += -closed * (price - trade_price) * 1.0
+                        if not trade_size:
+                            trades.append((trade_open, dt, trade_pnl, trade_pnl - trade_comm))
+                            trade_open = None
+                    if opened:
+                        if trade_open is None:
+                            trade_open = dt
+                            trade_size = 0
+                            trade_price = trade_pnl = trade_comm = 0.0
+                        trade_comm += opened_comm
+                        trade_price = (trade_size * trade_price + opened * price) / (trade_size + opened)
+                        trade_size += opened
+
+                    new_position = position + executed
+                    if not new_position:
+                        position_price = 0.0
+                    elif not position or (position > 0) != (new_position > 0):
+                        position_price = price
+                    elif (executed > 0) == (position > 0):
+                        position_price = (position_price * position + executed * price) / new_position
+                    position = new_position
+                completed = True
+            pending = waiting
+
+        if has_position_entry:
+            close = closes[i]
+            position_value = position * close
+            unrealized = position * (close - position_price) * 1.0
+            if position_value > 0:
+                value = cash + ((position_value - unrealized) / 1.0 + unrealized)
+            else:
+                value = cash + (0.0 + position_value)
+        else:
+            value = cash
+
+        if completed:
+            order = False
+        if values is not None:
+            values.append(value)
+        if daily_values is not None and day_end[k]:
+            daily_values.append(value)
+
+        # DrawDown analyzer
+        max_value = max(max_value, value)
+        max_drawdown = max(max_drawdown, 100.0 * (max_value - value) / max_value)
+
+        if prune_drawdown is not None and max_drawdown > prune_drawdown:
+            pruned = True
+            break
+        if checkpoints is not None and k < bars and (k + 1) % prune_interval == 0:
+            checkpoint = len(checkpoints)
+            checkpoints.append(value)
+            if prune_floor is not None and checkpoint < len(prune_floor) and value < prune_floor[checkpoint]:
+                pruned = True
+                break
+
+        if not active[k] or order:
+            continue
+
+        close = closes[i]
+        j = cycle_1[k]
+
+        if not position:
+            if close > max(span_a[j], span_b[j]):
+                stop_price = dcl[j] * (1 - stop_distance_factor)
+                take_profit_price = dch[j] * (1 + take_profit_distance_factor)
+                stop_loss_distance = close - stop_price
+                size = 0
+                if stop_loss_distance > 0:
+                    size = value * risk_per_trade / stop_loss_distance
+                    if size > value:
+                        size = value / close
+                    size = math.floor(size)
+                if size:
+                    submitted.append((size, i, close))
+                    order = True
+                continue
+            elif close < min(span_a[j], span_b[j]):
+                stop_price = dch[j] * (1 + stop_distance_factor)
+                take_profit_price = dcl[j] * (1 - take_profit_distance_factor)
+                stop_loss_distance = stop_price - close
+                size = 0
+                if stop_loss_distance > 0:
+                    size = value * risk_per_trade / stop_loss_distance
+                    if size > value:
+                        size = value / close
+                    size = math.floor(size)
+                if size:
+                    submitted.append((-size, i, close))
+                    order = True
+                continue
+
+        # Stop loss
+        if position > 0 and close <= stop_price or position < 0 and close >= stop_price:
+            submitted.append((-position, i, close))
+            continue
+
+        # Trailing take profit
+        if position > 0:
+            if take_profit_price:
+                if close >= take_profit_price * (1 - take_profit_trigger_factor):
+                    take_profit_price = close
+                    trailing_profit_price = take_profit_price - (take_profit_price * take_profit_distance_factor)
+            if trailing_profit_price:
+                if close <= trailing_profit_price:
+                    submitted.append((-position, i, close))
+                    trailing_profit_price = take_profit_price = None
+                    continue
+        elif position < 0:
+            if take_profit_price:
+                if close <= take_profit_price * (1 + take_profit_trigger_factor):
+                    take_profit_price = close
+                    trailing_profit_price = take_profit_price + (take_profit_price * take_profit_distance_factor)
+            if trailing_profit_price:
+                if close >= trailing_profit_price:
+                    submitted.append((-position, i, close))
+                    trailing_profit_price = take_profit_price = None
+                    continue
+
+        # Close the last trade to not influence final results with an open trade
+        if i + 1 == total_candles - 1 and position:
+            submitted.append((-position, i, close))
+            order = True
+
+    timings = {'indicators': loop_time - start_time, 'bar_loop': time.perf_counter() - loop_time}
+    curve = None
+    if values is not None:
+        # The flush cycle repeats the last bar, its value is the one at the end of the data
+        curve = pd.Series(values, index=market.index[market.cycle_0[:len(values)]], name='value')
+        curve = curve[~curve.index.duplicated(keep='last')]
+    if daily_values is not None:
+        daily_values = pd.Series(daily_values, index=days[:len(daily_values)], name='value')
+    return BacktestResult(value, max_drawdown, orders, trades, curve, checkpoints, pruned, timings, daily_values)
+
+
+def run_backtests(market, params, starting_capital=10000, commission=0.00035, total_candles=0,
+                  prune_drawdown=None, prune_floor=None, prune_interval=None, daily=False):
+    """
+    run_backtest of many parameter sets in a single pass over the cycles of `market`. The state of every
+    run (cash, position, stop and take profit prices, drawdown) is an array indexed by run, updated for
+    all runs at once, and the Donchian channels are shared by the runs with the same period. The Ichimoku
+    entry signals do not depend on the parameters and are computed for all cycles up front. Only the runs
+    with orders in flight go through the broker one by one, and the cycles in which no run holds a
+    position, has an order or gets an entry signal are skipped.
+
+    :param params: list of dicts of run_backtest parameters, one per run
+    :return: list of BacktestResult, one per parameter set and equal to what run_backtest returns for it,
+        without equity curves but with the daily values if daily is set. The timings are the share of each run
+        in the timings of the batch.
+    """
+    start_time = time.perf_counter()
+    defaults = {name: parameter.default for name, parameter in inspect.signature(run_backtest).parameters.items()}
+
+    def column(name):
+        return np.array([run.get(name, defaults[name]) for run in params], dtype=float)
+
+    n = len(params)
+    risk_per_trade = column('risk_per_trade')
+    stop_distance_factor = column('stop_distance_factor')
+    take_profit_distance_factor = column('take_profit_distance_factor')
+    take_profit_trigger_factor = column('take_profit_trigger_factor')
+    periods, period_row = np.unique(column('Donchian_Period').astype(int), return_inverse=True)
+
+    # Lines of every distinct Donchian period, and the active cycles of every run as rows by cycle
+    dch = np.array([market.indicators.get(COMPRESSIONS[0], 'donchian', int(period))[0] for period in periods])
+    dcl = np.array([market.indicators.get(COMPRESSIONS[0], 'donchian', int(period))[1] for period in periods])
+    active = np.ascontiguousarray(np.array([market.active(int(period)) for period in periods])[period_row].T)
+
+    # Entry signals, with the NaN handling of the builtin max() and min() in run_backtest
+    span_a, span_b = market.indicators.get(COMPRESSIONS[0], 'ichimoku')
+    cycle_0, cycle_1 = market.cycle_0, market.cycle_frames[0]
+    cycle_closes = market.close[cycle_0]
+    a, b = span_a[cycle_1], span_b[cycle_1]
+    long_signal = cycle_closes > np.where(b > a, b, a)
+    short_signal = ~long_signal & (cycle_closes < np.where(b < a, b, a))
+    signal = (long_signal | short_signal).tolist()
+    long_signal = long_signal.tolist()
+    opens, closes = market.open.tolist(), market.close.tolist()
+    cycle_0, cycle_1 = cycle_0.tolist(), cycle_1.tolist()
+    loop_time = time.perf_counter()
+
+    cash = np.full(n, float(starting_capital))
+    value = cash.copy()
+    position = np.zeros(n)
+    position_price = np.zeros(n)
+    max_value = value.copy()
+    max_drawdown = np.zeros(n)
+    order = np.zeros(n, dtype=bool)  # MyStrategy.order is set
+    stop_price = np.zeros(n)
+    take_profit_price = np.zeros(n)  # 0.0 stands for None, as both are falsy in MyStrategy
+    trailing_profit_price = np.zeros(n)
+    alive = np.ones(n, dtype=bool)  # not pruned
+
+    books = {}  # run: [submitted, pending] orders, as in run_backtest
+    orders = [[] for _ in range(n)]
+    trades = [[] for _ in range(n)]
+    trade_state = [[None, 0, 0.0, 0.0, 0.0] for _ in range(n)]  # trade_open, size, price, pnl, comm
+    checkpoint_values = []  # value of every run at every checkpoint
+    daily_values = []  # value of every run at the end of every day, with daily
+    day_end, days = _day_ends(market) if daily else ([False] * len(cycle_0), None)
+    checkpoint_counts = np.zeros(n, dtype=int)
+    bars = len(market)
+
+    def broker(run, i):
+        """The broker part of a run_backtest cycle for one run. :return: True if an order completed"""
+        submitted, pending = books[run]
+        run_cash = float(cash[run])
+        run_position = int(position[run])
+        run_position_price = float(position_price[run])
+        completed = False
+
+        if submitted:
+            check_cash = run_cash
+            check_position = run_position
+            for size, created, price in submitted:
+                opened, closed = _split(check_position, size)
+                check_position += size
+                if closed:
+                    check_cash += -closed * price
+                    check_cash -= abs(closed) * commission * price
+                if opened:
+                    check_cash -= opened * price
+                    check_cash -= abs(opened) * commission * price
+                if check_cash >= 0.0:
+                    pending.append((size, created, price))
+                else:
+                    completed = True
+            submitted.clear()
+
+        if pending:
+            waiting = []
+            trade = trade_state[run]
+            for size, created, price in pending:
+                if i <= created:
+                    waiting.append((size, created, price))
+                    continue
+
+                price = opens[i]
+                opened, closed = _split(run_position, size)
+                pnl = -closed * (price - run_position_price) * 1.0
+                closed_comm = opened_comm = 0.0
+                if closed:
+                    run_cash += -closed * run_position_price + pnl
+                    closed_comm = abs(closed) * commission * price
+                    run_cash -= closed_comm
+                if opened:
+                    opened_cash = run_cash - opened * price
+                    opened_comm = abs(opened) * commission * price
+                    opened_cash -= opened_comm
+                    if opened_cash < 0.0:
+                        opened = 0
+                        opened_comm = 0.0
+                    else:
+                        run_cash = opened_cash
+
+                executed = closed + opened
+                if executed:
+                    dt = market.index[i]
+                    orders[run].append((dt, executed, executed * price / executed, closed_comm + opened_comm))
+                    if closed:
+                        trade[4] += closed_comm
+                        trade[1] += closed
+                        trade[3] += -closed * (price - trade[2]) * 1.0
+                        if not trade[1]:
+                            trades[run].append((trade[0], dt, trade[3], trade[3] - trade[4]))
+                            trade[0] = None
+                    if opened:
+                        if trade[0] is None:
+                            trade[:] = [dt, 0, 0.0, 0.0, 0.0]
+                        trade[4] += opened_comm
+                        trade[2] = (trade[1] * trade[2] + opened * price) / (trade[1] + opened)
+                        trade[1] += opened
+
+                    new_position = run_position + executed
+                    if not new_position:
+                        run_position_price = 0.0
+                    elif not run_position or (run_position > 0) != (new_position > 0):
+                        run_position_price = price
+                    elif (executed > 0) == (run_position > 0):
+                        run_position_price = (run_position_price * run_position + executed * price) / new_position
+                    run_position = new_position
+                completed = True
+            pending[:] = waiting
+
+        cash[run], position[run], position_price[run] = run_cash, run_position, run_position_price
+        if not pending:
+            del books[run]
+        return completed
+
+    def submit(runs, sizes, i, close):
+        for run, size in zip(runs.tolist(), sizes.tolist()):
+            books.setdefault(run, [[], []])[0].append((int(size), i, close))
+
+    def positions_changed():
+        """:return: direction (1 long, -1 short, 0 flat), signed take profit distance and trigger factors"""
+        direction = np.sign(position)
+        return direction, -direction * take_profit_distance_factor, 1 - direction * take_profit_trigger_factor
+
+    def prune(runs):
+        # A pruned run keeps its value as cash without a position, and never gets ready again
+        alive[runs] = False
+        order[runs] = True
+        for run in np.flatnonzero(runs).tolist():
+            books.pop(run, None)
+        cash[runs] = value[runs]
+        position[runs] = 0
+
+    # np.count_nonzero is the fastest test of a mask. The comparisons of the long and the short runs are made
+    # one by multiplying differences by the direction, which keeps their sign exactly.
+    any_of = np.count_nonzero
+    direction, signed_factor, trigger = positions_changed()
+    holding = False  # some run has a position
+
+    for k in range(len(cycle_0)):
+        checkpoint = prune_interval and k < bars and (k + 1) % prune_interval == 0
+        if not books and not holding and not signal[k] and not checkpoint and not day_end[k]:
+            continue  # Nothing can change in this cycle
+        i = cycle_0[k]
+        close = closes[i]
+
+        # Broker, then the value and drawdown of every run, which only changes for the brokered and holding runs
+        brokered = bool(books)
+        if brokered:
+            for run in list(books):
+                if broker(run, i):
+                    order[run] = False
+            direction, signed_factor, trigger = positions_changed()
+            holding = bool(any_of(direction))
+        if brokered or holding:
+            position_value = position * close
+            unrealized = position * (close - position_price)
+            value = np.where(position_value > 0, cash + ((position_value - unrealized) + unrealized),
+                             cash + position_value)
+            np.maximum(max_value, value, out=max_value)
+            np.maximum(max_drawdown, 100.0 * (max_value - value) / max_value, out=max_drawdown)
+
+            if prune_drawdown is not None:
+                pruned = alive & (max_drawdown > prune_drawdown)
+                if any_of(pruned):
+                    prune(pruned)
+                    direction, signed_factor, trigger = positions_changed()
+                    holding = bool(any_of(direction))
+                    if not any_of(alive):
+                        break
+        if day_end[k]:
+            daily_values.append(value.copy())
+        if checkpoint:
+            checkpoint = len(checkpoint_values)
+            checkpoint_values.append(value.copy())
+            checkpoint_counts[alive] += 1
+            if prune_floor is not None and checkpoint < len(prune_floor):
+                pruned = alive & (value < prune_floor[checkpoint])
+                if any_of(pruned):
+                    prune(pruned)
+                    direction, signed_factor, trigger = positions_changed()
+                    holding = bool(any_of(direction))
+                    if not any_of(alive):
+                        break
+
+        ready = active[k] & ~order
+        j = cycle_1[k]
+
+        if signal[k]:
+            entering = np.flatnonzero(ready & (direction == 0))
+            if len(entering):
+                row = period_row[entering]
+                if long_signal[k]:
+                    stop_price[entering] = dcl[row, j] * (1 - stop_distance_factor[entering])
+                    take_profit_price[entering] = dch[row, j] * (1 + take_profit_distance_factor[entering])
+                    stop_loss_distance = close - stop_price[entering]
+                else:
+                    stop_price[entering] = dch[row, j] * (1 + stop_distance_factor[entering])
+                    take_profit_price[entering] = dcl[row, j] * (1 - take_profit_distance_factor[entering])
+                    stop_loss_distance = stop_price[entering] - close
+                run_value = value[entering]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    size = run_value * risk_per_trade[entering] / stop_loss_distance
+                size = np.floor(np.where(size > run_value, run_value / close, size))
+                size = np.where(stop_loss_distance > 0, size, 0.0)
+                sized = size != 0
+                submit(entering[sized], size[sized] if long_signal[k] else -size[sized], i, close)
+                order[entering[sized]] = True
+
+        if not holding:
+            continue
+        ready &= direction != 0
+
+        # Stop loss
+        stopped = ready & ((close - stop_price) * direction <= 0)
+        if any_of(stopped):
+            runs = np.flatnonzero(stopped)
+            submit(runs, -position[runs], i, close)
+            ready &= ~stopped
+
+        # Trailing take profit. The take profit moves to the close whenever it reaches the trigger
+        triggered = ready & (take_profit_price != 0) & ((close - take_profit_price * trigger) * direction >= 0)
+        if any_of(triggered):
+            take_profit_price[triggered] = close
+            trailing_profit_price[triggered] = (close + close * signed_factor)[triggered]
+        taken = ready & (trailing_profit_price != 0) & ((trailing_profit_price - close) * direction >= 0)
+        if any_of(taken):
+            runs = np.flatnonzero(taken)
+            submit(runs, -position[runs], i, close)
+            trailing_profit_price[runs] = take_profit_price[runs] = 0.0
+            ready &= ~taken
+
+        # Close the last trade to not influence final results with an open trade
+        if i + 1 == total_candles - 1 and any_of(ready):
+            runs = np.flatnonzero(ready)
+            submit(runs, -position[runs], i, close)
+            order[runs] = True
+
+    timings = {'indicators': (loop_time - start_time) / max(n, 1),
+               'bar_loop': (time.perf_counter() - loop_time) / max(n, 1)}
+    checkpoint_values = np.array(checkpoint_values).reshape(-1, n)
+    daily_values = np.array(daily_values).reshape(-1, n)
+    return [BacktestResult(float(value[run]), float(max_drawdown[run]), orders[run], trades[run], None,
+                           checkpoint_values[:checkpoint_counts[run], run].tolist() if prune_interval else None,
+                           not alive[run], dict(timings),
+                           pd.Series(daily_values[:, run], index=days[:len(daily_values)], name='value')
+                           if daily else None)
+            for run in range(n)]
+
+
+def compare_with_cerebro(file_name, **params):
+    """
+    Runs MyStrategy through Cerebro and run_backtest on the same CSV file and reports
+    any difference in final value, max drawdown, executions, closed trades or, with the
+    pruning parameters, in the pruning and its checkpoints.
+
+    :return: True if both engines agree.
+    """
+    import backtrader as bt
+    from Strat import MyStrategy
+    from support import FixedRiskSizer, load_data, count_rows_in_csv
+
+    class RecordingStrategy(MyStrategy):
+        def __init__(self):
+            super().__init__()
+            self.executions = []
+            self.closed_trades = []
+
+        def notify_order(self, order):
+            if order.status == order.Completed:
+                self.executions.append((self.data.datetime.datetime(0), order.executed.size,
+                                        order.executed.price, order.executed.comm))
+            super().notify_order(order)
+
+        def notify_trade(self, trade):
+            super().notify_trade(trade)
+            if trade.isclosed:
+                self.closed_trades.append((trade.pnl, trade.pnlcomm))
+
+    data = load_data(file_name)
+    total_candles = count_rows_in_csv(file_name)
+
+    cerebro = bt.Cerebro()
+    cerebro.adddata(data)
+    for compression in COMPRESSIONS:
+        cerebro.resampledata(data, timeframe=bt.TimeFrame.Minutes, compression=compression)
+    cerebro.broker.setcash(10000)
+    cerebro.broker.setcommission(commission=0.00035)
+    cerebro.addsizer(FixedRiskSizer)
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')
+    cerebro.addstrategy(RecordingStrategy, total_candles=total_candles, printlog=False, **params)
+    strategy = cerebro.run()[0]
+
+    result = run_backtest(MarketData(data.p.dataname), starting_capital=10000, commission=0.00035,
+                          total_candles=total_candles, **params)
+
+    expected = {
+        'final value': strategy.broker.getvalue(),
+        'max drawdown': strategy.analyzers.drawdown.get_analysis().max.drawdown,
+        'executions': strategy.executions,
+        'trades': strategy.closed_trades,
+        'pruned': strategy.pruned,
+        'checkpoints': strategy.checkpoints,
+    }
+    actual = {
+        'final value': result.final_value,
+        'max drawdown': result.max_drawdown,
+        'executions': [(dt.to_pydatetime(), size, price, comm) for dt, size, price, comm in result.orders],
+        'trades': [(pnl, pnlcomm) for _, _, pnl, pnlcomm in result.trades],
+        'pruned': result.pruned,
+        'checkpoints': result.checkpoints,
+    }
+
+    equal = True
+    for key in expected:
+        if expected[key] != actual[key]:
+            print(f"{key} differs: cerebro {expected[key]} / vector {actual[key]}")
+            equal = False
+    print(f"{file_name}: {len(result.orders)} executions, final value {result.final_value:.2f}, "
+          f"max drawdown {result.max_drawdown:.2f}% - {'equivalent' if equal else 'NOT equivalent'}")
+    return equal
+
+
+if __name__ == "__main__":
+    # Equivalence check against MyStrategy: python vector_engine.py [csv file]
+    file_name = sys.argv[1] if len(sys.argv) > 1 else 'AMZN_data.csv'
+    sys.exit(0 if compare_with_cerebro(file_name) else 1)